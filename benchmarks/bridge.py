@@ -0,0 +1,239 @@
+"""
+Measure the bridge between the Tk main thread and the asyncio loop thread,
+idle and while a metadata crawl runs:
+- dispatch: Tk callback to the start of its coroutine, through ``async_callback``
+- widget: widget update made from the loop thread, as coroutines of the app do
+- after: loop thread to a Tk ``after`` callback, as the console log handler does
+- hop: round trip of a no-op through each executor pool with ``delegate``
+- lag: oversleep of the event loop
+
+Needs a display; on a headless machine run it under ``xvfb-run``.
+
+Run from the repository root:
+    python -m benchmarks.bridge [--samples N] [--pages N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Callable
+
+# keep the benchmark's settings and index apart from the user's
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="flydesk-bridge-")
+
+import tkinter as tk  # noqa: E402
+
+from flying_desktop.__main__ import loop_worker  # noqa: E402
+from flying_desktop.buckets import FilledBucket  # noqa: E402
+from flying_desktop.providers import PhotoProvider, Photo  # noqa: E402
+from flying_desktop.tracing import percentile  # noqa: E402
+from flying_desktop.utils import loop, async_callback, delegate, POOL_SIZES  # noqa: E402
+
+PAGE_SIZE = 100
+# seconds the event loop is asked to sleep between lag samples
+LAG_INTERVAL = 0.005
+# seconds waited for a single sample before the benchmark gives up
+SAMPLE_TIMEOUT = 10
+
+
+class CrawlProvider(PhotoProvider):
+    """
+    Provider of generated metadata pages, each after a short simulated request
+    """
+
+    storage = client_secrets = scope = None
+    pages = 100
+    delay = 0.002
+
+    def __init__(self):
+        super().__init__(credentials=None)
+
+    def refresh_credentials(self):
+        pass
+
+    async def download_meta_photos(self, since=None, query=None, cursor=None):
+        for page in range(self.pages):
+            await asyncio.sleep(self.delay)
+            yield [
+                {"id": f"{page}-{i}", "width": 1920 + i, "height": 1080}
+                for i in range(PAGE_SIZE)
+            ]
+
+    async def download_photo(self, meta_photo: dict, max_size=None) -> Photo:
+        # a stub PNG header, so the provider also works where photos are downloaded
+        return Photo("png", b"\x89PNG\r\n\x1a\n")
+
+    @staticmethod
+    def dimensions(meta_photo: dict):
+        return meta_photo["width"], meta_photo["height"]
+
+    @staticmethod
+    def created_time(meta_photo: dict):
+        return None
+
+
+class Bridge:
+    """
+    Samples of bridge latencies, taken from a driver thread
+    while Tk runs its main loop in the main thread
+    """
+
+    def __init__(self, root: tk.Tk, samples: int):
+        self.root = root
+        self.samples = samples
+        self.label = tk.Label(root)
+        self.label.pack()
+        self.results: Dict[str, List[float]] = {}
+
+    def record(self, name: str, seconds: float):
+        self.results.setdefault(name, []).append(seconds)
+
+    def run_coroutine(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(SAMPLE_TIMEOUT)
+
+    def dispatch(self, phase: str):
+        done = threading.Event()
+
+        @async_callback
+        async def probe(started: float):
+            self.record(f"dispatch {phase}", time.perf_counter() - started)
+            done.set()
+
+        for _ in range(self.samples):
+            done.clear()
+            self.root.after(0, lambda: probe(time.perf_counter()))
+            if not done.wait(SAMPLE_TIMEOUT):
+                raise TimeoutError("dispatch sample")
+
+    async def widget(self, phase: str):
+        for i in range(self.samples):
+            started = time.perf_counter()
+            self.label["text"] = str(i)
+            self.record(f"widget {phase}", time.perf_counter() - started)
+            await asyncio.sleep(0)
+
+    async def after(self, phase: str):
+        for _ in range(self.samples):
+            done = asyncio.Event()
+            started = time.perf_counter()
+
+            def callback():
+                self.record(f"after {phase}", time.perf_counter() - started)
+                loop.call_soon_threadsafe(done.set)
+
+            self.root.after(0, callback)
+            await asyncio.wait_for(done.wait(), SAMPLE_TIMEOUT)
+
+    async def hop(self, phase: str):
+        for pool in POOL_SIZES:
+            for _ in range(self.samples):
+                started = time.perf_counter()
+                await delegate(time.perf_counter, pool=pool)
+                self.record(f"hop {pool} {phase}", time.perf_counter() - started)
+
+    async def lag(self, phase: str, stop: threading.Event):
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.record(f"lag {phase}", time.perf_counter() - started - LAG_INTERVAL)
+
+    async def crawl(self, bucket: FilledBucket, stop: threading.Event):
+        """
+        Crawl metadata over and over, updating the window after every page like the app
+        """
+        while not stop.is_set():
+            bucket.index.clear()
+            async for _ in bucket.download():
+                self.label["text"] = f"{len(bucket.photos)} photos fetched"
+                if stop.is_set():
+                    return
+
+    def phase(self, name: str, bucket: FilledBucket = None):
+        """
+        Take all samples, with a crawl running if ``bucket`` is given
+        """
+        stop = threading.Event()
+        background = [
+            asyncio.run_coroutine_threadsafe(self.lag(name, stop), loop),
+        ]
+        if bucket is not None:
+            background.append(
+                asyncio.run_coroutine_threadsafe(self.crawl(bucket, stop), loop)
+            )
+        try:
+            self.dispatch(name)
+            for measure in self.widget, self.after, self.hop:
+                self.run_coroutine(measure(name))
+        finally:
+            stop.set()
+            for future in background:
+                future.result(SAMPLE_TIMEOUT)
+
+
+def report(results: Dict[str, List[float]]) -> str:
+    lines = [f"{'measure':<24}{'count':>7}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"]
+    for name, values in results.items():
+        values = sorted(values)
+        lines.append(
+            f"{name:<24}{len(values):>7}"
+            + "".join(
+                f"{percentile(values, fraction) * 1e3:>10.3f}"
+                for fraction in (0.5, 0.9, 0.99)
+            )
+            + f"{values[-1] * 1e3:>10.3f}"
+        )
+    return "\n".join(lines) + "\n(milliseconds)"
+
+
+def in_thread(root: tk.Tk, target: Callable[[], None]) -> List[BaseException]:
+    """
+    Run ``target`` in a driver thread, quitting Tk's main loop when it returns
+    :return: list receiving the exception raised by ``target``, if any
+    """
+    errors = []
+
+    def run():
+        try:
+            target()
+        except BaseException as ex:
+            errors.append(ex)
+        finally:
+            root.after(0, root.quit)
+
+    threading.Thread(target=run, daemon=True).start()
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument("--pages", type=int, default=100, help="pages per crawl")
+    parser.add_argument(
+        "--delay", type=float, default=0.002, help="simulated request time per page"
+    )
+    args = parser.parse_args()
+    CrawlProvider.pages = args.pages
+    CrawlProvider.delay = args.delay
+
+    threading.Thread(target=loop_worker, args=(loop,), daemon=True).start()
+    root = tk.Tk()
+    bridge = Bridge(root, args.samples)
+    bucket = FilledBucket(name="Bridge", description="", client=CrawlProvider())
+
+    def run():
+        bridge.phase("idle")
+        bridge.phase("crawl", bucket)
+
+    errors = in_thread(root, run)
+    root.mainloop()
+    if errors:
+        raise errors[0]
+    print(report(bridge.results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
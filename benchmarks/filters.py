@@ -0,0 +1,91 @@
+"""
+Time filtering a large photo index, uncached and cached, with both index types.
+
+Run from the repository root:
+    python -m benchmarks.filters [--photos N]
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from flying_desktop.filters import PhotoFilter
+from flying_desktop.index import PhotoIndex
+from flying_desktop.mapped_index import MappedIndex
+
+START = datetime(2010, 1, 1, tzinfo=timezone.utc)
+FILTERS = (
+    PhotoFilter(min_width=1000),
+    PhotoFilter(min_width=1920, min_height=1080, orientation="landscape"),
+    PhotoFilter(min_aspect=1.5, max_aspect=1.8, date_from=START + timedelta(days=1000)),
+)
+
+
+class FakeProvider:
+    """
+    Stand-in for a provider, reading dimensions and times of generated photos
+    """
+
+    @staticmethod
+    def dimensions(photo: dict):
+        return photo["width"], photo["height"]
+
+    @staticmethod
+    def created_time(photo: dict):
+        return START + timedelta(days=photo["day"])
+
+
+def generate(count: int):
+    rng = random.Random(0)
+    return [
+        {
+            "id": f"photo-{i}",
+            "width": rng.randrange(200, 6000),
+            "height": rng.randrange(200, 6000),
+            "day": rng.randrange(0, 3650),
+        }
+        for i in range(count)
+    ]
+
+
+def timed(func, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--photos", type=int, default=500_000)
+    args = parser.parse_args()
+
+    photos = generate(args.photos)
+    for index_type in PhotoIndex, MappedIndex:
+        index = index_type("benchmark-filters", FakeProvider())
+        index.clear()
+        start = time.perf_counter()
+        for batch in range(0, len(photos), 10_000):
+            index.merge(photos[batch : batch + 10_000])
+        print(f"{index_type.__name__}: indexed {len(photos)} photos in {time.perf_counter() - start:.1f}s")
+        for photo_filter in FILTERS:
+            columns = index.select(photo_filter).columns
+            uncached = timed(lambda: photo_filter.mask(columns).nonzero())
+            cached = timed(lambda: index.select(photo_filter))
+            selected = len(index.select(photo_filter))
+            print(
+                f"  {selected:>7} selected  uncached {uncached * 1e3:7.2f}ms"
+                f"  cached {cached * 1e6:7.1f}us  {photo_filter}"
+            )
+        exclude = np.arange(1000, dtype=np.uint64)
+        uncached = timed(lambda: index.select(FILTERS[0], exclude), repeat=1)
+        print(f"  excluding {len(exclude)} hashes  uncached {uncached * 1e3:7.2f}ms")
+        index.clear()
+
+
+if __name__ == "__main__":
+    main()
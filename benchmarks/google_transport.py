@@ -0,0 +1,185 @@
+"""
+Compare the Google crawl over a fresh connection per request
+with the crawl over the pooled transport, against a local stand-in for the API.
+
+Run from the repository root:
+    python -m benchmarks.google_transport [--pages N] [--delay SECONDS]
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from httplib2 import Http
+
+from flying_desktop.providers.google import GooglePhotos
+from flying_desktop.providers.transport import PooledHttp
+from flying_desktop.utils import loop
+
+PAGE_SIZE = GooglePhotos.max_batch_size
+
+
+def discovery_document(root_url: str) -> dict:
+    """
+    Minimal discovery document describing the methods used by ``GooglePhotos``
+    """
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "name": "photoslibrary",
+        "version": "v1",
+        "rootUrl": root_url,
+        "servicePath": "",
+        "baseUrl": root_url,
+        "batchPath": "batch",
+        "parameters": {
+            "fields": {"type": "string", "location": "query"},
+            "alt": {"type": "string", "location": "query", "default": "json"},
+        },
+        "schemas": {
+            "SearchMediaItemsRequest": {"id": "SearchMediaItemsRequest", "type": "object"},
+            "SearchMediaItemsResponse": {"id": "SearchMediaItemsResponse", "type": "object"},
+            "MediaItem": {"id": "MediaItem", "type": "object"},
+        },
+        "resources": {
+            "mediaItems": {
+                "methods": {
+                    "search": {
+                        "id": "photoslibrary.mediaItems.search",
+                        "path": "v1/mediaItems:search",
+                        "httpMethod": "POST",
+                        "parameters": {},
+                        "request": {"$ref": "SearchMediaItemsRequest"},
+                        "response": {"$ref": "SearchMediaItemsResponse"},
+                    },
+                    "get": {
+                        "id": "photoslibrary.mediaItems.get",
+                        "path": "v1/mediaItems/{+mediaItemId}",
+                        "httpMethod": "GET",
+                        "parameters": {
+                            "mediaItemId": {
+                                "type": "string",
+                                "location": "path",
+                                "required": True,
+                            }
+                        },
+                        "parameterOrder": ["mediaItemId"],
+                        "response": {"$ref": "MediaItem"},
+                    },
+                }
+            }
+        },
+    }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves the discovery document and pages of fake media items
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    pages = 0
+    delay = 0.0
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def log_message(self, *_):
+        pass
+
+    def send_json(self, value: dict):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        root_url = f"http://{self.headers['Host']}/"
+        self.send_json(discovery_document(root_url))
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        page = int(request.get("pageToken", 0))
+        time.sleep(self.delay)
+        items = [
+            {
+                "id": f"{page}-{i}",
+                "mediaMetadata": {
+                    "creationTime": "2020-01-01T00:00:00Z",
+                    "width": "4000",
+                    "height": "3000",
+                },
+            }
+            for i in range(PAGE_SIZE)
+        ]
+        result = {"mediaItems": items}
+        if page + 1 < self.pages:
+            result["nextPageToken"] = str(page + 1)
+        self.send_json(result)
+
+
+class FreshHttp:
+    """
+    Creates a new ``Http`` for every request, like the transport this benchmark replaces
+    """
+
+    def request(self, *args, **kwargs):
+        return Http().request(*args, **kwargs)
+
+
+class Credentials:
+    """
+    Credentials which never expire
+    """
+
+    token_expiry = None
+
+
+async def crawl(provider: GooglePhotos) -> int:
+    items = 0
+    async for batch in provider.download_meta_photos():
+        items += len(batch)
+    return items
+
+
+def measure(name: str, http, port: int):
+    GooglePhotos.discovery_url = f"http://127.0.0.1:{port}/discovery/{{api}}/{{apiVersion}}"
+    StandInHandler.connections = 0
+    provider = GooglePhotos(Credentials(), http=http)
+    started = time.perf_counter()
+    items = asyncio.run_coroutine_threadsafe(crawl(provider), loop).result()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{name:>8}: {items} items in {elapsed:.3f}s "
+        f"({StandInHandler.pages / elapsed:.1f} pages/s, "
+        f"{StandInHandler.connections} connections)"
+    )
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--delay", type=float, default=0.0, help="server latency per page")
+    args = parser.parse_args()
+    StandInHandler.pages = args.pages
+    StandInHandler.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    port = server.server_address[1]
+    fresh = measure("fresh", FreshHttp(), port)
+    pooled = measure("pooled", PooledHttp(Http), port)
+    print(f"speedup: {fresh / pooled:.2f}x")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
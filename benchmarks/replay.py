@@ -0,0 +1,87 @@
+"""
+Crawl and download through a real provider from a recorded cassette, with no network
+or account, and report how long parsing, pagination and downloads take.
+The crawl stops where the recording did.
+
+Record a cassette first with:
+    python -m flying_desktop.providers.cassette {google,facebook} FILE
+
+Run from the repository root:
+    python -m benchmarks.replay {google,facebook} FILE [--time-scale X] [--photos N]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# keep the benchmark's settings apart from the user's
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="flydesk-replay-")
+
+from flying_desktop.providers.cassette import Cassette, NotRecorded, use_cassette  # noqa: E402
+from flying_desktop.providers.facebook import FacebookPhotos  # noqa: E402
+from flying_desktop.providers.google import GooglePhotos  # noqa: E402
+from flying_desktop.utils import loop  # noqa: E402
+
+PROVIDERS = {"google": GooglePhotos, "facebook": FacebookPhotos}
+
+
+class Credentials:
+    """
+    Credentials which never expire, standing in for the scrubbed ones
+    """
+
+    access_token = "replayed"
+    token_expiry = None
+
+
+async def replay(provider, photos: int):
+    pages = items = downloads = 0
+    meta_photos = []
+    started = time.perf_counter()
+    try:
+        async for batch in provider.download_meta_photos():
+            pages += 1
+            items += len(batch)
+            meta_photos.extend(batch)
+    except NotRecorded:
+        # the recording stopped crawling here
+        pass
+    crawled = time.perf_counter()
+    for meta_photo in meta_photos[:photos]:
+        try:
+            await provider.download_photo(meta_photo)
+        except NotRecorded:
+            break
+        provider.dimensions(meta_photo)
+        provider.created_time(meta_photo)
+        downloads += 1
+    done = time.perf_counter()
+    print(f"crawl: {pages} pages, {items} items in {crawled - started:.3f}s")
+    print(f"downloads: {downloads} photos in {done - crawled:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("provider", choices=PROVIDERS)
+    parser.add_argument("path", type=Path)
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=0.0,
+        help="factor of recorded latencies, 0 to replay as fast as possible",
+    )
+    parser.add_argument("--photos", type=int, default=5, help="photos to download")
+    args = parser.parse_args()
+    cassette = Cassette(args.path, time_scale=args.time_scale)
+    use_cassette(cassette)
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    provider = PROVIDERS[args.provider](Credentials())
+    asyncio.run_coroutine_threadsafe(replay(provider, args.photos), loop).result()
+    print(f"{len(cassette.interactions)} recorded exchanges")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Drive thousands of wallpaper switches through the main window against a fake provider
+served from a local HTTP server, and fail if memory, Tk widgets, pending Tk callbacks
+or open sockets keep growing.
+
+Every switch downloads its photo: prefetching is off and the bucket bypasses the photo cache.
+Needs a display; on a headless machine run it under ``xvfb-run``.
+
+Run from the repository root:
+    python -m benchmarks.soak [--switches N] [--max-rss-growth MB]
+"""
+import argparse
+import asyncio
+import gc
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import suppress
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+# keep the soak's settings, index and caches apart from the user's
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="flydesk-soak-")
+
+import tkinter as tk  # noqa: E402
+
+from flying_desktop.app import main_window  # noqa: E402
+from flying_desktop.app.main_window import AppWindow  # noqa: E402
+from flying_desktop.buckets import FilledBucket, Selection  # noqa: E402
+from flying_desktop.providers import PhotoProvider, Photo  # noqa: E402
+from flying_desktop.settings import SETTINGS  # noqa: E402
+from flying_desktop.utils import loop  # noqa: E402
+
+PHOTOS = 10_000
+
+
+def png() -> bytes:
+    """
+    Small valid PNG, so the photo passes for a real one
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\x89PNG\r\n\x1a\n"
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "teal").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class PhotoHandler(BaseHTTPRequestHandler):
+    """
+    Serves the same photo at every path
+    """
+
+    protocol_version = "HTTP/1.1"
+    body = b""
+
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+class FakeProvider(PhotoProvider):
+    """
+    Provider of generated photo metadata, downloading photos from the local server
+    """
+
+    storage = client_secrets = scope = None
+
+    def __init__(self, port: int):
+        super().__init__(credentials=None)
+        self.port = port
+
+    def refresh_credentials(self):
+        pass
+
+    async def download_meta_photos(self, since=None, query=None, cursor=None):
+        yield [{"id": str(i), "width": 1920, "height": 1080} for i in range(PHOTOS)]
+
+    async def download_photo(self, meta_photo: dict, max_size=None) -> Photo:
+        return await self._download_from_url(
+            f"http://127.0.0.1:{self.port}/{meta_photo['id']}"
+        )
+
+    @staticmethod
+    def dimensions(meta_photo: dict):
+        return meta_photo["width"], meta_photo["height"]
+
+    @staticmethod
+    def created_time(meta_photo: dict):
+        return None
+
+
+class SoakBucket(FilledBucket):
+    """
+    Bucket downloading every photo, bypassing the photo cache
+    """
+
+    async def fetch_photo(self, meta_photo: dict) -> Photo:
+        return await self.download_photo(meta_photo)
+
+
+class SoakWindow(AppWindow):
+    """
+    Main window fed by a single fake bucket, downloading a photo on every switch
+    """
+
+    bucket: SoakBucket = None
+
+    @property
+    def active_buckets(self):
+        return [self.bucket]
+
+    def select(self):
+        # every photo of the bucket, cached or not
+        selection = Selection()
+        selection.add(self.bucket, self.bucket.select(self.photo_filter))
+        return selection
+
+    def schedule_prefetch(self):
+        pass
+
+    def schedule_cache_fill(self):
+        pass
+
+    def change_wallpaper_and_schedule(self):
+        pass
+
+
+def rss() -> int:
+    """
+    Resident set size in bytes
+    """
+    with suppress(FileNotFoundError):
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    import resource
+
+    # peak, not current, where /proc is unavailable
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def sockets() -> int:
+    """
+    Amount of open sockets, or 0 where they cannot be counted
+    """
+    count = 0
+    with suppress(FileNotFoundError):
+        for fd in Path("/proc/self/fd").iterdir():
+            with suppress(FileNotFoundError):
+                count += os.readlink(fd).startswith("socket:")
+    return count
+
+
+def widgets(widget: tk.Misc) -> int:
+    return 1 + sum(widgets(child) for child in widget.winfo_children())
+
+
+def pending_callbacks(root: tk.Tk) -> int:
+    return len(root.tk.splitlist(root.tk.call("after", "info")))
+
+
+def switch(root: tk.Tk, app: SoakWindow):
+    """
+    Change wallpaper once, processing Tk events until the change is done
+    """
+    future = asyncio.run_coroutine_threadsafe(
+        AppWindow.change_wallpaper.__wrapped__(app), loop
+    )
+    while not future.done():
+        root.update()
+        time.sleep(0.001)
+    future.result()
+    root.update()
+
+
+def sample(root: tk.Tk) -> dict:
+    gc.collect()
+    return {
+        "rss": rss(),
+        "widgets": widgets(root),
+        "callbacks": pending_callbacks(root),
+        "sockets": sockets(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--switches", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--max-rss-growth", type=float, default=10, help="MB")
+    args = parser.parse_args()
+
+    PhotoHandler.body = png()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PhotoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    # the desktop is left alone, only the wallpaper file is written
+    main_window.change_wallpaper = lambda path: None
+
+    SETTINGS["Soak/checked"] = True
+    SETTINGS["period/change_at"] = (datetime.now() + timedelta(days=1)).isoformat()
+    root = tk.Tk()
+    SoakWindow.bucket = SoakBucket(
+        name="Soak", description="", client=FakeProvider(server.server_address[1])
+    )
+
+    async def fill():
+        async for _ in SoakWindow.bucket.download():
+            pass
+
+    asyncio.run_coroutine_threadsafe(fill(), loop).result()
+    app = SoakWindow(loop, root)
+    app.pack()
+
+    for _ in range(args.warmup):
+        switch(root, app)
+    before = sample(root)
+    for done in range(1, args.switches + 1):
+        switch(root, app)
+        if done % 500 == 0:
+            print(f"{done} switches: {sample(root)}", flush=True)
+    after = sample(root)
+    server.shutdown()
+
+    growth = {key: after[key] - before[key] for key in before}
+    print(f"before: {before}\nafter:  {after}\ngrowth: {growth}")
+    failures = [
+        key for key in ("widgets", "callbacks", "sockets") if growth[key] > 0
+    ]
+    if growth["rss"] > args.max_rss_growth * 2 ** 20:
+        failures.append("rss")
+    if failures:
+        print(f"FAIL: {', '.join(failures)} grew")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
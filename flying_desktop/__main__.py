@@ -1,35 +1,159 @@
 """
 Run the Flying Desktop application.
+If it is already running, forward a command to the running instance instead.
 """
-import asyncio
+import argparse
+import multiprocessing
 import sys
 import threading
-import tkinter as tk
+from pathlib import Path
+from typing import Coroutine, Any
 
-from .log import logging_setup
-logging_setup()
+from . import instance
 
+COMMANDS = {
+    "show": "show the running instance's window",
+    "next": "change wallpaper now",
+    "serve": "serve photos to other desktops, without a window",
+    "mirror": "download photos matching the filters into DIRECTORY, without a window",
+}
+# commands run on their own, rather than by the window
+HEADLESS = ("serve", "mirror")
 
-from .utils import loop
-from flying_desktop.app.main_window import AppWindow
 
-
-def loop_worker(loop_: asyncio.AbstractEventLoop):
+def loop_worker(loop_: "asyncio.AbstractEventLoop"):
     """
     Thread for running the asyncio event loop
     """
+    import asyncio
+
     asyncio.set_event_loop(loop_)
     loop_.run_forever()
 
 
-def main():
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="flydesk", description=__doc__.strip())
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="show",
+        choices=COMMANDS,
+        help="; ".join(f"{name}: {help_}" for name, help_ in COMMANDS.items()),
+    )
+    parser.add_argument("directory", nargs="?", type=Path, help="target folder of mirror")
+    args = parser.parse_args(argv)
+    if (args.command == "mirror") != (args.directory is not None):
+        parser.error("the mirror command takes a directory, and only it does")
+    return args
+
+
+def main(argv=None):
+    multiprocessing.freeze_support()
+    args = parse_args(argv)
+    if instance.acquire_lock():
+        if args.command == "serve":
+            from .service import run_service
+
+            return run_headless(run_service())
+        if args.command == "mirror":
+            from .mirror import run_mirror
+
+            return run_headless(run_mirror(args.directory))
+        return run(args.command)
+    if args.command in HEADLESS:
+        print("flydesk is already running", file=sys.stderr)
+        return 1
+    reply = instance.send(args.command)
+    if reply is None:
+        print("flydesk is running but does not respond", file=sys.stderr)
+        return 1
+    if reply != "ok":
+        print(reply, file=sys.stderr)
+        return 1
+    return 0
+
+
+def run(command: str):
+    """
+    Start the application as the running instance
+    :param command: command given on the command line
+    """
+    # imported here so forwarding a command doesn't pay for asyncio, Tk and the providers
+    import asyncio
+    import tkinter as tk
+
+    from .log import logging_setup
+    from .providers.cassette import cassette_setup
+    from .tracing import tracing_setup
+
+    logging_setup()
+    tracing_setup()
+    cassette_setup()
+
+    from .app.main_window import AppWindow
+    from .memprof import memprof_setup
+    from .providers import close_http_session
+    from .utils import loop, monitor_pools, error_handler
+
     loop_thread = threading.Thread(target=loop_worker, args=(loop,), daemon=True)
     loop_thread.start()
+    asyncio.run_coroutine_threadsafe(monitor_pools(), loop)
     root = tk.Tk()
     app = AppWindow(loop, root)
     app.pack(fill="both", expand=True)
+    memprof_setup(root, lambda: app.filled_buckets)
+
+    def show():
+        root.deiconify()
+        root.lift()
+        root.focus_force()
+
+    # commands are received on the event loop, and handed over to Tk's thread
+    commands = {
+        "show": lambda: root.after(0, show),
+        "next": lambda: root.after(0, app.change_wallpaper_and_schedule),
+    }
+    asyncio.run_coroutine_threadsafe(instance.serve(commands), loop).add_done_callback(
+        error_handler
+    )
+    if command == "next":
+        app.change_wallpaper_and_schedule()
 
     root.mainloop()
+    # stops provider workers, which save their recordings
+    for bucket in app.filled_buckets:
+        bucket.client.close()
+    asyncio.run_coroutine_threadsafe(close_http_session(), loop).result(timeout=5)
+
+
+def run_headless(command: Coroutine[Any, Any, int]) -> int:
+    """
+    Run a command without a window, as the running instance.
+    On interrupt the command is cancelled, and is expected to return its exit status.
+    :param command: coroutine running the command, returning its exit status
+    """
+    import asyncio
+
+    from .log import logging_setup
+    from .providers import close_http_session
+    from .providers.cassette import cassette_setup
+    from .tracing import tracing_setup
+    from .utils import loop
+
+    logging_setup()
+    tracing_setup()
+    cassette_setup()
+    asyncio.set_event_loop(loop)
+    # the window's commands don't apply, but later launches get an answer
+    loop.run_until_complete(instance.serve({}))
+    task = asyncio.ensure_future(command, loop=loop)
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        return loop.run_until_complete(task)
+    finally:
+        loop.run_until_complete(close_http_session())
 
 
 if __name__ == "__main__":
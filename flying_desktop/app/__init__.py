@@ -2,10 +2,10 @@
 Various app widgets
 """
 import tkinter as tk
-from tkinter import Spinbox, IntVar
+from tkinter import Spinbox, IntVar, StringVar
 from tkinter import ttk
 
-from typing import Callable
+from typing import Callable, Sequence, Optional
 
 
 def make_button(parent: tk.BaseWidget, text: str, callback: Callable, **kw):
@@ -22,9 +22,9 @@ def make_button(parent: tk.BaseWidget, text: str, callback: Callable, **kw):
     return button_
 
 
-class WidthFilter(Spinbox):
+class DimensionFilter(Spinbox):
     """
-    Spinbox for filtering images by width
+    Spinbox for filtering images by width or height
     """
 
     def __init__(self, parent, command, default=1000):
@@ -39,12 +39,44 @@ class WidthFilter(Spinbox):
         )
 
 
+class OrientationFilter(tk.OptionMenu):
+    """
+    Drop-down menu for filtering images by orientation
+    """
+
+    ANY = "any"
+
+    def __init__(
+        self, parent, command, options: Sequence[str], default: Optional[str] = None
+    ):
+        """
+        :param parent: parent widget
+        :param command: callback for selection changes
+        :param options: orientations to choose from, besides any orientation
+        :param default: initially selected orientation, ``None`` for any orientation
+        """
+        self.value = StringVar(None, value=default or self.ANY)
+        super().__init__(
+            parent, self.value, self.ANY, *options, command=lambda _: command()
+        )
+
+    def get(self) -> Optional[str]:
+        """
+        Return selected orientation, or ``None`` for any orientation
+        """
+        value = self.value.get()
+        return None if value == self.ANY else value
+
+
 class Progressbar(ttk.Progressbar):
     """
-    Progress bar with a label and a cancel button
+    Progress bar with a label and a cancel button.
+    Created once and shown again for every operation, so widgets don't pile up.
     """
 
-    def __init__(self, parent: tk.Widget, text: str, cancel_callback: Callable):
+    def __init__(
+        self, parent: tk.Widget, text: str = "", cancel_callback: Optional[Callable] = None
+    ):
         """
         :param parent: parent widget
         :param text: progress bar text
@@ -54,6 +86,24 @@ class Progressbar(ttk.Progressbar):
         self.text = tk.Label(parent, text=text)
         self.cancel_button = make_button(parent, "cancel", cancel_callback)
 
+    def show(self, text: str, cancel_callback: Callable):
+        """
+        Show widgets for a new operation and start the animation
+        :param text: progress bar text
+        :param cancel_callback: callback for cancelling the operation
+        """
+        self.text["text"] = text
+        self.cancel_button["command"] = cancel_callback
+        self.pack()
+        self.start(50)
+
+    def hide(self):
+        """
+        Stop the animation and hide widgets
+        """
+        self.stop()
+        self.pack_forget()
+
     def pack(self):
         """
         Show widgets
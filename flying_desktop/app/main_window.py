@@ -5,31 +5,50 @@ import asyncio
 import logging
 import os
 import random
-import tempfile
+import time
 import tkinter as tk
 # noinspection PyPep8Naming
 import tkinter.scrolledtext as ScrolledText
 import traceback
-from datetime import datetime
-from typing import Sequence, Iterable, Tuple, Callable
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Sequence, Iterable, Callable
 
-from flying_desktop import PRETTY_NAME, APP_NAME
-from flying_desktop.app import WidthFilter, make_button, Progressbar
+import attr
+
+from flying_desktop import PRETTY_NAME
+from flying_desktop.app import DimensionFilter, OrientationFilter, make_button, Progressbar
 from flying_desktop.app.period import Period
 from flying_desktop.app.providers_dialog import ProvidersDialog
-from flying_desktop.buckets import FilledBucket
-from flying_desktop.log import LOG_FILE, LOG_FORMAT
+from flying_desktop.budget import BUDGET, BudgetLevel, BudgetExhausted
+from flying_desktop.buckets import FilledBucket, Selection, select_photos
+from flying_desktop.filters import PhotoFilter, ORIENTATIONS, MIN_WIDTH, MIN_HEIGHT
+from flying_desktop.health import CircuitOpen
+from flying_desktop.log import LOG_FILE, LOG_FORMAT, add_handler
 from flying_desktop.providers import BadResponse
-from flying_desktop.settings import SETTINGS
+from flying_desktop.settings import SETTINGS, CACHE_DIR
+from flying_desktop.tracing import traced, detached
 from flying_desktop.utils import (
     save_photo,
     delegate,
     change_wallpaper,
     async_callback,
+    error_handler,
+    DESKTOP_POOL,
+    DISK_POOL,
+    Chain,
 )
 
 log = logging.getLogger(__name__)
 
+WALLPAPER_DIR = CACHE_DIR / "wallpapers"
+# seconds between checks for fetched photos while waiting to prefetch a wallpaper
+PREFETCH_POLL = 1
+# random picks tried per bucket when looking for a photo to cache in the background
+CACHE_FILL_ATTEMPTS = 10
+# log lines kept in the console, older ones are dropped
+CONSOLE_LINES = 1000
+
 
 class TextHandler(logging.Handler):
     """
@@ -37,11 +56,12 @@ class TextHandler(logging.Handler):
     Adapted from Moshe Kaplan: https://gist.github.com/moshekaplan/c425f861de7bbf28ef06
     """
 
-    def __init__(self, text):
+    def __init__(self, text, max_lines: int = CONSOLE_LINES):
         # run the regular Handler __init__
         super().__init__()
         # Store a reference to the Text it will log to
         self.text = text
+        self.max_lines = max_lines
 
     def emit(self, record):
         """
@@ -55,6 +75,10 @@ class TextHandler(logging.Handler):
             """
             self.text.configure(state="normal")
             self.text.insert(tk.END, msg + "\n")
+            # the last line is always empty
+            lines = int(self.text.index(tk.END).split(".")[0]) - 1
+            if lines > self.max_lines:
+                self.text.delete("1.0", f"{lines - self.max_lines + 1}.0")
             self.text.configure(state="disabled")
             # Autoscroll to the bottom
             self.text.yview(tk.END)
@@ -73,19 +97,26 @@ class AppWindow(tk.Frame):
         """
         Return photo metadata from all buckets
         """
-        return [photo for bucket in self.active_buckets for photo in bucket.photos]
+        return Chain([bucket.photos for bucket in self.active_buckets])
 
     @property
-    def active_buckets(self) -> Iterable[FilledBucket]:
+    def filled_buckets(self) -> Iterable[FilledBucket]:
         """
-        Return all logged in, checked buckets
+        Return all logged in buckets
         """
         return [
             bucket
             for bucket in self.providers_dialog.buckets.values()
-            if isinstance(bucket, FilledBucket) and bucket.checked
+            if isinstance(bucket, FilledBucket)
         ]
 
+    @property
+    def active_buckets(self) -> Iterable[FilledBucket]:
+        """
+        Return all logged in, checked buckets
+        """
+        return [bucket for bucket in self.filled_buckets if bucket.checked]
+
     def __init__(self, loop: asyncio.AbstractEventLoop, parent: tk.Tk):
         super().__init__(parent)
         self.loop = loop
@@ -96,7 +127,10 @@ class AppWindow(tk.Frame):
         )
         self.label = tk.Label(self, text="Download not started")
         self.label.pack()
-        self.width = self.add_width_filter()
+        self.budget_label = tk.Label(self, text=f"Data: {BUDGET}")
+        self.budget_label.pack()
+        BUDGET.screen = (parent.winfo_screenwidth(), parent.winfo_screenheight())
+        self.width, self.height, self.orientation = self.add_filters()
         self.providers_dialog = ProvidersDialog(self, self.update_photo_status)
         self.providers_dialog.hide()
         self.login_button = tk.Button(
@@ -104,14 +138,20 @@ class AppWindow(tk.Frame):
         )
         self.login_button.pack()
         self.next_change_handle = None
+        self.progress = Progressbar(self)
+        self._changing = False
+        self._prefetching = False
+        self._filling_cache = False
+        WALLPAPER_DIR.mkdir(parents=True, exist_ok=True)
         self.period = Period(self, self.on_period_change)
         self.console = self.init_console()
         now = datetime.now()
         if self.change_at < now:
             self.change_wallpaper_and_schedule()
-        self.change_at = now + self.period.get()
+        self.change_at = now + self.effective_period()
         self.next_change_handle = self.parent.after(
-            int(self.period.get().total_seconds()) * 1000, self.change_wallpaper_and_schedule
+            int(self.effective_period().total_seconds()) * 1000,
+            self.change_wallpaper_and_schedule,
         )
 
     def change_wallpaper_and_schedule(self):
@@ -130,11 +170,18 @@ class AppWindow(tk.Frame):
         log.debug("on_period_change")
         if self.next_change_handle:
             self.parent.after_cancel(self.next_change_handle)
-        self.change_at = datetime.now() + self.period.get()
+        self.change_at = datetime.now() + self.effective_period()
         self.next_change_handle = self.parent.after(
-            int(self.period.get().total_seconds()) * 1000, self.change_wallpaper_and_schedule
+            int(self.effective_period().total_seconds()) * 1000,
+            self.change_wallpaper_and_schedule,
         )
 
+    def effective_period(self) -> timedelta:
+        """
+        Period between wallpaper changes, stretched while the data budget is low
+        """
+        return self.period.get() * BUDGET.period_factor
+
     def init_console(self):
         """
         Create a scrolled text widget containing log messages
@@ -147,7 +194,7 @@ class AppWindow(tk.Frame):
         handler = TextHandler(console)
         handler.setLevel(logging.DEBUG)
         handler.setFormatter(LOG_FORMAT)
-        logging.getLogger(APP_NAME).addHandler(handler)
+        add_handler(handler)
         log.debug("hello")
 
         def show():
@@ -162,18 +209,50 @@ class AppWindow(tk.Frame):
         show_button.pack()
         return console
 
-    def add_width_filter(self):
+    def add_filters(self):
         """
-        Add photo width filter spinbox to window
-        :return: push button and label
+        Add photo filter widgets to window
+        :return: width and height spinboxes and orientation menu
         """
-        frame = tk.LabelFrame(self, text="Width", padx=5, pady=5)
-        label = tk.Label(frame, text="Minimum width")
-        label.pack()
-        width = WidthFilter(frame, self.update_photo_status)
-        width.pack()
+        frame = tk.LabelFrame(self, text="Filters", padx=5, pady=5)
+        tk.Label(frame, text="Minimum width").grid(row=0, column=0)
+        width = DimensionFilter(
+            frame, self.on_filter_change, default=SETTINGS.get("filter/min_width", MIN_WIDTH)
+        )
+        width.grid(row=0, column=1)
+        tk.Label(frame, text="Minimum height").grid(row=1, column=0)
+        height = DimensionFilter(
+            frame, self.on_filter_change, default=SETTINGS.get("filter/min_height", MIN_HEIGHT)
+        )
+        height.grid(row=1, column=1)
+        tk.Label(frame, text="Orientation").grid(row=2, column=0)
+        orientation = OrientationFilter(
+            frame, self.on_filter_change, ORIENTATIONS, SETTINGS.get("filter/orientation")
+        )
+        orientation.grid(row=2, column=1)
         frame.pack()
-        return width
+        return width, height, orientation
+
+    def on_filter_change(self):
+        """
+        Keep filter widgets' values in settings, for commands running without the window
+        """
+        SETTINGS["filter/min_width"] = self.width.value.get()
+        SETTINGS["filter/min_height"] = self.height.value.get()
+        SETTINGS["filter/orientation"] = self.orientation.get()
+        self.update_photo_status()
+
+    @property
+    def photo_filter(self) -> PhotoFilter:
+        """
+        Photo predicates set by the filter widgets, and date range set in settings
+        """
+        return attr.evolve(
+            PhotoFilter.from_settings(),
+            min_width=self.width.value.get(),
+            min_height=self.height.value.get(),
+            orientation=self.orientation.get(),
+        )
 
     def add_button(self, text: str, on_click: Callable = None, **kw) -> tk.Button:
         """
@@ -194,12 +273,17 @@ class AppWindow(tk.Frame):
         self.label[
             "text"
         ] = f"{len(self.meta_photos)} photos fetched\n{len(self.select())} matching photos"
+        self.budget_label["text"] = f"Data: {BUDGET}"
+        if not SETTINGS.get("wallpaper/next") and self.meta_photos:
+            self.schedule_prefetch()
 
     async def get_photo_and_change(
         self, bar: Progressbar, bucket: FilledBucket, meta_photo: dict, retry: int = 3,
     ) -> None:
         """
-        Change wallpaper to photo represented by ``meta_photo`` metadata
+        Change wallpaper to photo represented by ``meta_photo`` metadata.
+        If the download fails, a photo is picked again; the failure counts against the
+        bucket's health, so a failing bucket drops out of the selection.
         :param bar: progress dialog
         :param bucket: bucket of photos to which ``meta_photo`` belongs
         :param meta_photo: metadata of photo to set wallpaper to
@@ -207,18 +291,27 @@ class AppWindow(tk.Frame):
         """
         try:
             self.change_button["state"] = tk.DISABLED
-            meta_photo = await bucket.client.download_photo(meta_photo)
-            photo_path = await save_photo(
-                meta_photo, tempfile.gettempdir(), "wallpaper"
-            )
-            bar.text["text"] = "Changing wallpaper"
-            await delegate(change_wallpaper, photo_path)
-        except BadResponse as e:
-            if not retry:
+            try:
+                photo = await bucket.fetch_photo(meta_photo)
+            except asyncio.CancelledError:
                 raise
-            log.error("".join(traceback.format_exc()))
-            log.error(f"Bad response: {e.response}")
-            return await self.get_photo_and_change(bar, bucket, meta_photo, retry - 1)
+            except Exception as e:
+                if not retry:
+                    raise
+                if isinstance(e, BadResponse):
+                    log.error("".join(traceback.format_exc()))
+                    log.error(f"Bad response: {e.response}")
+                else:
+                    log.warning("cannot download from %s: %r", bucket.name, e)
+                filtered_photos = self.select()
+                if not filtered_photos:
+                    raise
+                return await self.get_photo_and_change(
+                    bar, *random.choice(filtered_photos), retry - 1
+                )
+            photo_path = await save_photo(photo, WALLPAPER_DIR, "current")
+            bar.text["text"] = "Changing wallpaper"
+            await delegate(change_wallpaper, photo_path, pool=DESKTOP_POOL)
         finally:
             self.change_button["state"] = tk.NORMAL
 
@@ -236,22 +329,128 @@ class AppWindow(tk.Frame):
     def change_at(self, value: datetime):
         SETTINGS["period/change_at"] = value.isoformat()
 
-    def select(self) -> Sequence[Tuple[FilledBucket, dict]]:
+    @traced("select")
+    def select(self) -> Selection:
         """
-        Return all meta photos for which filters apply
+        Return all meta photos for which filters apply.
+        Photos with the same perceptual hash are returned once.
         """
-        return [
-            (bucket, photo)
-            for bucket in self.active_buckets
-            for photo in bucket.select(self.width.value.get())
-        ]
+        return select_photos(self.active_buckets, self.photo_filter)
+
+    def schedule_cache_fill(self) -> None:
+        """
+        Cache more photos in the background, from any thread,
+        unless the data budget is low
+        """
+        if SETTINGS.get("offline/cache_first", True) and BUDGET.level is BudgetLevel.NORMAL:
+            with detached():
+                future = asyncio.run_coroutine_threadsafe(self.fill_cache(), self.loop)
+            future.add_done_callback(error_handler)
+
+    @traced("cache_fill")
+    async def fill_cache(self) -> None:
+        """
+        Download an uncached photo of every active bucket into the photo cache.
+        Downloads from degraded buckets also probe whether they recovered.
+        """
+        if self._filling_cache:
+            return
+        self._filling_cache = True
+        try:
+            for bucket in self.active_buckets:
+                photos = bucket.select(self.photo_filter)
+                if not photos:
+                    continue
+                for _ in range(CACHE_FILL_ATTEMPTS):
+                    meta_photo = random.choice(photos)
+                    if not bucket.is_cached(meta_photo):
+                        try:
+                            await bucket.fetch_photo(meta_photo)
+                        except asyncio.CancelledError:
+                            raise
+                        except (CircuitOpen, BudgetExhausted) as e:
+                            log.info(f"cannot fill photo cache: {e}")
+                        except Exception as e:
+                            log.warning("cannot fill photo cache from %s: %r", bucket.name, e)
+                        break
+        finally:
+            self._filling_cache = False
+
+    def schedule_prefetch(self) -> None:
+        """
+        Prefetch the next wallpaper in the background, from any thread
+        """
+        with detached():
+            future = asyncio.run_coroutine_threadsafe(self.prefetch_next(), self.loop)
+        future.add_done_callback(error_handler)
+
+    @traced("prefetch")
+    async def prefetch_next(self) -> None:
+        """
+        Download the next wallpaper in advance and remember it in settings,
+        so it can be applied at once, even right after launch
+        """
+        if self._prefetching:
+            return
+        self._prefetching = True
+        try:
+            while not self.meta_photos:
+                await asyncio.sleep(PREFETCH_POLL)
+            filtered_photos = self.select()
+            if not filtered_photos:
+                return
+            bucket, meta_photo = random.choice(filtered_photos)
+            photo = await bucket.fetch_photo(meta_photo)
+            path = await save_photo(photo, WALLPAPER_DIR, "next")
+            SETTINGS["wallpaper/next"] = {
+                "path": str(path),
+                "bucket": bucket.name,
+                "id": meta_photo["id"],
+            }
+        except BadResponse as e:
+            log.error(f"cannot prefetch wallpaper: bad response: {e.response}")
+        except (CircuitOpen, BudgetExhausted) as e:
+            log.info(f"cannot prefetch wallpaper: {e}")
+        finally:
+            self._prefetching = False
+
+    @traced("apply_prefetched")
+    async def apply_prefetched(self) -> bool:
+        """
+        Set the prefetched wallpaper, if there is one
+        :return: whether the wallpaper was changed
+        """
+        prefetched = SETTINGS.get("wallpaper/next")
+        if not prefetched:
+            return False
+        started = time.monotonic()
+        SETTINGS["wallpaper/next"] = None
+        path = Path(prefetched["path"])
+        current = path.with_name(f"current{path.suffix}")
+        try:
+            await delegate(os.replace, path, current, pool=DISK_POOL)
+        except FileNotFoundError:
+            log.warning("prefetched wallpaper %s is missing", path)
+            return False
+        await delegate(change_wallpaper, current, pool=DESKTOP_POOL)
+        log.info(
+            "changed to prefetched wallpaper in %.0fms", (time.monotonic() - started) * 1000
+        )
+        return True
 
     @async_callback
+    @traced("switch")
     async def change_wallpaper(self):
         """
-        Select a photo from filtered photos and set it as wallpaper
+        Select a photo from filtered photos and set it as wallpaper.
+        A prefetched wallpaper is used if there is one,
+        which needs neither the network nor fetched metadata.
         """
         log.debug("changing wallpaper")
+        if await self.apply_prefetched():
+            self.schedule_prefetch()
+            self.schedule_cache_fill()
+            return
         if not self.meta_photos:
             log.info("no meta photos")
             keys = ("borderwidth", "highlightbackground", "highlightcolor")
@@ -267,22 +466,27 @@ class AppWindow(tk.Frame):
         if not filtered_photos:
             log.warning("no matching photos")
             return
+        if self._changing:
+            log.info("wallpaper change already in progress")
+            return
 
         def cancel():
-            bar.pack_forget()
+            self.progress.hide()
             if not coro.done():
                 self.loop.call_soon_threadsafe(coro.cancel)
 
-        bar = Progressbar(self, "Downloading photo...", cancel)
-        bar.pack()
-        bar.start(50)
-
+        self._changing = True
+        self.progress.show("Downloading photo...", cancel)
         coro = self.loop.create_task(
-            self.get_photo_and_change(bar, *random.choice(filtered_photos))
+            self.get_photo_and_change(self.progress, *random.choice(filtered_photos))
         )
         try:
             await coro
+            self.schedule_prefetch()
+            self.schedule_cache_fill()
         except asyncio.CancelledError:
             pass
         finally:
             cancel()
+            self._changing = False
+            self.budget_label["text"] = f"Data: {BUDGET}"
@@ -1,22 +1,23 @@
 """
 Dialog for logging in to different providers
 """
+import asyncio
 import logging
 import tkinter as tk
-from typing import Sequence, Dict, cast, Callable, Optional, TypeVar, Generic
+from typing import Dict, cast, Callable, Optional, TypeVar, Generic
 
 import attr
 
 from flying_desktop.buckets import (
     BucketFactory,
-    Google,
-    Facebook,
     PhotoBucket,
     FilledBucket,
     EmptyBucket,
+    REFRESH_PERIOD,
 )
+from flying_desktop.registry import bucket_factories
 from flying_desktop.settings import SETTINGS
-from flying_desktop.utils import async_callback
+from flying_desktop.utils import async_callback, loop
 
 log = logging.getLogger(__name__)
 
@@ -72,17 +73,16 @@ class ProvidersDialog:
     Dialog for connecting to photos providers
     """
 
-    BUCKETS: Sequence[BucketFactory] = [Google, Facebook]
-
     def __init__(self, parent: tk.BaseWidget, callback):
         """
         :param parent: parent widget
         """
         self.callback = callback
+        self.factories = bucket_factories()
         top = self.top = tk.Toplevel(parent)
 
         ok = tk.Button(top, text="OK", command=self.ok)
-        ok.grid(row=len(self.BUCKETS), columnspan=2)
+        ok.grid(row=len(self.factories), columnspan=2)
         ok["width"] = 20
         self.top.protocol("WM_DELETE_WINDOW", self.ok)
 
@@ -91,7 +91,7 @@ class ProvidersDialog:
         self.logout: Optional[Callable] = None
         self.login_buckets: Dict[str, BucketLogin] = {
             bucket.name: self.add_provider(i, bucket)
-            for i, bucket in enumerate(self.BUCKETS)
+            for i, bucket in enumerate(self.factories)
         }
         for bucket in self.login_buckets.values():
             if (
@@ -163,13 +163,22 @@ class ProvidersDialog:
             async for _ in filled_bucket.download():
                 self.callback()
             provider.log_in_out_button["command"] = logout
+            await filled_bucket.hash_photos()
+            self.callback()
+            while self.buckets[factory.name] is filled_bucket:
+                await asyncio.sleep(REFRESH_PERIOD.total_seconds())
+                async for _ in filled_bucket.download():
+                    self.callback()
+                await filled_bucket.hash_photos()
+                self.callback()
 
         def logout(*_):
             """
             Empty bucket
             """
             filled_bucket = cast(FilledBucket, self.buckets[factory.name])
-            filled_bucket.empty()
+            # the index is cleared on the thread which merges into it
+            loop.call_soon_threadsafe(filled_bucket.empty)
             # noinspection PyArgumentList
             self.login_buckets[factory.name] = self.login_buckets[factory.name].evolve(
                 bucket=factory.new()
@@ -2,17 +2,50 @@
 A bucket is a combination of the means to fetch remote photos
 and the metadata of the photos already fetched.
 """
-from typing import Sequence, Callable
+import asyncio
+import importlib
+import logging
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Sequence, Optional, Tuple, Iterator, Type, Iterable, Dict
 
 import attr
+import numpy as np
 
-from .providers import PhotoProvider
-from .providers.facebook import FacebookPhotos
-from .providers.google import GooglePhotos
+from . import dedup
+from .budget import BUDGET, BudgetLevel, BudgetExhausted
+from .filters import PhotoFilter, IndexedView, NO_HASHES
+from .health import ProviderHealth, CircuitOpen, CircuitState
+from .index import PhotoIndex
+from .mapped_index import MappedIndex
+from .photo_cache import PHOTO_CACHE
+from .providers import PhotoProvider, Photo, CrawlQuery, CursorExpired
+from .providers.worker import IsolatedProvider
 from .settings import SETTINGS
-from .utils import delegate
+from .tracing import traced
+from .utils import delegate, AUTH_POOL, DISK_POOL
 
+log = logging.getLogger(__name__)
 attrs = attr.s(auto_attribs=True, kw_only=True)
+# time between syncs of a filled bucket
+REFRESH_PERIOD = timedelta(days=1)
+# overlap between consecutive incremental syncs, covering clock skew and late uploads
+SYNC_OVERLAP = timedelta(hours=1)
+# default seconds before a photo download is given up, overridable by ``health/timeout``
+DOWNLOAD_TIMEOUT = 30
+# default download latency, in seconds, above which cached photos are preferred,
+# overridable by ``offline/latency_threshold``
+LATENCY_THRESHOLD = 5
+
+
+def import_provider(path: str) -> Type[PhotoProvider]:
+    """
+    Import provider class
+    :param path: import path of the form ``package.module:Class``
+    """
+    module, _, name = path.partition(":")
+    return getattr(importlib.import_module(module), name)
 
 
 @attr.s(auto_attribs=True, frozen=True)
@@ -21,12 +54,13 @@ class BucketFactory:
     Factory for making empty buckets.
     :param name: Name of method for fetching remote photos
     :param description: description of said method
-    :param init: coroutine yielding a ``PhotoProvider``
+    :param provider: import path of the ``PhotoProvider`` subclass, as ``module:Class``.
+        The module is only imported once a bucket is filled.
     """
 
     name: str
     description: str
-    init: Callable[[], PhotoProvider]
+    provider: str
 
     def new(self, **kwargs):
         """
@@ -58,21 +92,231 @@ class FilledBucket(PhotoBucket):
 
     def __attrs_post_init__(self):
         super().__attrs_post_init__()
-        self._photos = []
+        if SETTINGS.get("index/mapped", False):
+            self.index = MappedIndex(self.name, self.client)
+        else:
+            self.index = PhotoIndex(self.name, self.client)
+        self._photos = self.index.photos
+        self._index_loaded = False
+        self._emptied = False
+        self.health = ProviderHealth()
+        # positions of photos by the digest naming them in the photo cache,
+        # extended as photos are added and dropped when the index renumbers them
+        self._digests: Dict[str, int] = {}
+        self._digested = 0
+        self._cached: Optional[Tuple[tuple, np.ndarray]] = None
 
     async def download(self):
         """
-        Accumulate photos' metadata
+        Accumulate photos' metadata.
+        Only photos added since the last sync are fetched,
+        unless a full reconciliation crawl is due.
+        Progress is checkpointed, so an interrupted crawl resumes where it stopped.
         """
-        async for batch in self.client.download_meta_photos():
-            self._photos += batch
+        if not self._index_loaded:
+            await delegate(self.index.load, pool=DISK_POOL)
+            self._forget_positions()
+            self._index_loaded = True
+            if self._photos:
+                yield
+        query = CrawlQuery.from_settings()
+        if self.index.query is not None and self.index.query != query.dump():
+            log.info("%s: crawl query changed, fetching photos again", self.name)
+            await delegate(self.index.clear, pool=DISK_POOL)
+            self._forget_positions()
             yield
+        checkpoint = self.index.resumable(query.dump(), datetime.now())
+        if checkpoint:
+            log.info(
+                "%s: resuming crawl after %d photos", self.name, checkpoint["items"]
+            )
+            started = datetime.fromisoformat(checkpoint["started"])
+            reconcile = checkpoint["full"]
+            since = checkpoint["since"] and datetime.fromisoformat(checkpoint["since"])
+            cursor, items = checkpoint["cursor"], checkpoint["items"]
+        else:
+            started = datetime.now()
+            reconcile = self.index.needs_reconcile(started)
+            since = None if reconcile else self.index.synced_at - SYNC_OVERLAP
+            cursor, items = None, 0
+        if reconcile:
+            self.index.begin_full_sync(resume=bool(checkpoint))
+        batches = self.client.download_meta_photos(since=since, query=query, cursor=cursor)
+        pages = 0
+        try:
+            async for batch in batches:
+                self.index.merge(batch)
+                items += len(batch)
+                pages += 1
+                cursor = getattr(batch, "cursor", None)
+                if cursor and pages % self.index.checkpoint_pages == 0:
+                    self.index.checkpoint = {
+                        "cursor": cursor,
+                        "items": items,
+                        "at": datetime.now().isoformat(),
+                        "started": started.isoformat(),
+                        "since": since and since.isoformat(),
+                        "full": reconcile,
+                        "query": query.dump(),
+                    }
+                    await delegate(self.index.save, pool=DISK_POOL)
+                yield
+                if self._emptied:
+                    return
+        except CursorExpired:
+            log.info("%s: crawl checkpoint expired, starting over", self.name)
+            self.index.checkpoint = None
+            async for _ in self.download():
+                yield
+            return
+        if reconcile:
+            self.index.end_full_sync()
+            self._forget_positions()
+            self.index.reconciled_at = started
+        self.index.synced_at = started
+        self.index.query = query.dump()
+        self.index.checkpoint = None
+        await delegate(self.index.save, pool=DISK_POOL)
+        yield
+
+    async def hash_photos(self, concurrency: int = 4, chunk_size: int = 100):
+        """
+        Compute perceptual hashes of photos which don't have one yet,
+        for detecting duplicates across buckets
+        :param concurrency: maximum amount of thumbnails downloaded at once
+        :param chunk_size: amount of photos hashed between saves of the index
+        """
+        if not SETTINGS.get("dedup/enabled", True) or not self.client.hashable:
+            return
+        if not dedup.available():
+            log.warning("Pillow is not installed, duplicate detection is disabled")
+            return
+        if BUDGET.level >= BudgetLevel.CRITICAL:
+            log.info("data budget is low, not hashing %s photos", self.name)
+            return
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def hash_photo(photo: dict, resolved: dict):
+            async with semaphore:
+                try:
+                    thumbnail = await self.client.download_thumbnail(resolved)
+                    BUDGET.record(len(thumbnail.data))
+                    self.index.set_photo_hash(
+                        photo, await dedup.perceptual_hash(thumbnail.data)
+                    )
+                except Exception as e:
+                    log.warning("cannot hash photo %s: %s", photo["id"], e)
+
+        missing = iter(self.index.unhashed())
+        while not self._emptied:
+            chunk = list(islice(missing, chunk_size))
+            if not chunk:
+                break
+            try:
+                resolved = await self.client.resolve_thumbnails(chunk)
+            except Exception as e:
+                log.warning("cannot look up %s thumbnails: %s", self.name, e)
+                resolved = chunk
+            await asyncio.gather(*map(hash_photo, chunk, resolved))
+            if not self._emptied:
+                await delegate(self.index.save, pool=DISK_POOL)
+
+    @traced("fetch_photo")
+    async def fetch_photo(self, meta_photo: dict) -> Photo:
+        """
+        Return photo from the photo cache, or download and cache it.
+        Renditions are chosen by the data budget.
+        Only original photos are cached, so a downscaled rendition isn't shown once
+        the budget allows originals again.
+        """
+        photo = await PHOTO_CACHE.get(self.name, meta_photo["id"])
+        if photo is not None:
+            return photo
+        max_size = BUDGET.rendition_size()
+        photo = await self.download_photo(meta_photo, max_size)
+        if max_size is None:
+            await PHOTO_CACHE.put(self.name, meta_photo["id"], photo)
+        return photo
+
+    async def download_photo(
+        self, meta_photo: dict, max_size: Optional[Tuple[int, int]] = None
+    ) -> Photo:
+        """
+        Download photo, regardless of the photo cache.
+        Downloads are timed and failures counted in the bucket's health;
+        they are refused while its circuit is open, and time out after ``health/timeout``.
+        The data budget refuses downloads once spent.
+        :param meta_photo: photo metadata
+        :param max_size: size of the rendition to download, the original photo if ``None``
+        """
+        if BUDGET.level is BudgetLevel.EXHAUSTED:
+            raise BudgetExhausted(str(BUDGET))
+        if not self.health.allow_request():
+            raise CircuitOpen(f"{self.name}: {self.health}")
+        started = time.monotonic()
+        try:
+            photo = await asyncio.wait_for(
+                self.client.download_photo(meta_photo, max_size=max_size),
+                SETTINGS.get("health/timeout", DOWNLOAD_TIMEOUT),
+            )
+        except asyncio.CancelledError:
+            self.health.record_cancelled()
+            raise
+        except Exception:
+            self.health.record_failure()
+            log.warning("%s download failed: %s", self.name, self.health)
+            raise
+        self.health.record_success(time.monotonic() - started)
+        BUDGET.record(len(photo.data))
+        return photo
+
+    def is_cached(self, meta_photo: dict) -> bool:
+        """
+        Whether photo is in the photo cache
+        """
+        return PHOTO_CACHE.contains(self.name, meta_photo["id"])
+
+    def _forget_positions(self):
+        self._digests.clear()
+        self._digested = 0
+        self._cached = None
+
+    def cached_positions(self) -> np.ndarray:
+        """
+        Return index positions of the photos in the photo cache
+        """
+        for position in range(self._digested, len(self._photos)):
+            self._digests[PHOTO_CACHE.digest(self._photos[position]["id"])] = position
+        self._digested = len(self._photos)
+        key = (PHOTO_CACHE.version, self._digested)
+        if self._cached is None or self._cached[0] != key:
+            positions = [
+                self._digests[digest]
+                for digest in PHOTO_CACHE.digests(self.name)
+                if digest in self._digests
+            ]
+            self._cached = key, np.array(positions, dtype=np.int64)
+        return self._cached[1]
+
+    def find(self, photo_id: str) -> Optional[dict]:
+        """
+        Return metadata of the photo with ``photo_id``, if the bucket has it
+        """
+        return self.index.find(photo_id)
 
-    def select(self, min_width):
+    def photo_hash(self, photo: dict) -> Optional[str]:
         """
-        Return photos which satisfy minimum width requirement
+        Return perceptual hash of photo, if computed
         """
-        return self.client.filter_meta_photos(self.photos, min_width)
+        return self.index.photo_hash(photo)
+
+    def select(self, photo_filter: PhotoFilter, exclude: np.ndarray = NO_HASHES) -> IndexedView:
+        """
+        Return photos matching ``photo_filter``
+        :param photo_filter: predicates to match
+        :param exclude: perceptual hashes of photos to leave out
+        """
+        return self.index.select(photo_filter, exclude)
 
     @property
     def photos(self) -> Sequence[dict]:
@@ -80,10 +324,85 @@ class FilledBucket(PhotoBucket):
 
     def empty(self):
         """
-        Empty the bucket
+        Empty the bucket.
+        Must be called from the event loop's thread, where the index is changed.
         """
         SETTINGS[self._credentials_key] = False
+        self._emptied = True
+        self.client.close()
         self.client.clear()
+        self.index.clear()
+        self._forget_positions()
+
+
+class Selection(Sequence[Tuple[FilledBucket, dict]]):
+    """
+    Selected photos of several buckets, paired with their buckets.
+    Buckets' selections are not copied, so lazy selections stay lazy.
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def add(self, bucket: FilledBucket, photos: Sequence[dict]):
+        """
+        Add photos selected from ``bucket``
+        """
+        self.parts.append((bucket, photos))
+
+    def __len__(self) -> int:
+        return sum(len(photos) for _, photos in self.parts)
+
+    def __getitem__(self, index: int) -> Tuple[FilledBucket, dict]:
+        if index < 0:
+            index += len(self)
+        for bucket, photos in self.parts:
+            if 0 <= index < len(photos):
+                return bucket, photos[index]
+            index -= len(photos)
+        raise IndexError(index)
+
+    def __iter__(self) -> Iterator[Tuple[FilledBucket, dict]]:
+        for bucket, photos in self.parts:
+            for photo in photos:
+                yield bucket, photo
+
+
+def cache_first(bucket: FilledBucket, photos: IndexedView) -> IndexedView:
+    """
+    Restrict photos of an unreachable or slow bucket to cached ones,
+    as well as photos of any bucket once the data budget is spent.
+    A slow bucket, or any bucket while the data budget is low,
+    keeps all of its photos if none are cached.
+    """
+    level = BUDGET.level
+    if bucket.health.state is CircuitState.OPEN or level is BudgetLevel.EXHAUSTED:
+        return photos.subset(np.isin(photos.indices, bucket.cached_positions()))
+    threshold = SETTINGS.get("offline/latency_threshold", LATENCY_THRESHOLD)
+    degraded = level >= BudgetLevel.LOW or bucket.health.degraded(threshold)
+    if not SETTINGS.get("offline/cache_first", True) or not degraded:
+        return photos
+    cached = photos.subset(np.isin(photos.indices, bucket.cached_positions()))
+    return cached or photos
+
+
+def select_photos(
+    buckets: Iterable[FilledBucket], photo_filter: PhotoFilter, prefer_cached: bool = True
+) -> Selection:
+    """
+    Return photos of ``buckets`` matching ``photo_filter``.
+    Photos with the same perceptual hash are returned once.
+    :param prefer_cached: whether to prefer cached photos of degraded buckets
+    """
+    selection = Selection()
+    hashes = NO_HASHES
+    for bucket in buckets:
+        photos = bucket.select(photo_filter, exclude=hashes)
+        if prefer_cached:
+            photos = cache_first(bucket, photos)
+        selection.add(bucket, photos)
+        hashes = np.concatenate([hashes, photos.hashes])
+    return selection
 
 
 @attrs
@@ -91,7 +410,7 @@ class EmptyBucket(PhotoBucket):
     """
     A bucket with no available photos
     """
-    _init: Callable[[], PhotoProvider]
+    provider: str
 
     @property
     def photos(self):
@@ -102,11 +421,13 @@ class EmptyBucket(PhotoBucket):
         Fill the bucket with photos
         """
         SETTINGS[self._credentials_key] = True
-        return FilledBucket(
-            name=self.name,
-            description=self.description,
-            client=await delegate(self._init),
-        )
+        provider = await delegate(import_provider, self.provider, pool=AUTH_POOL)
+        if SETTINGS.get("providers/isolated", False):
+            client = await IsolatedProvider.start(provider)
+        else:
+            client = await delegate(provider.from_code_grant, pool=AUTH_POOL)
+            client.refresher.start()
+        return FilledBucket(name=self.name, description=self.description, client=client)
 
     def has_credentials(self):
         """
@@ -114,15 +435,3 @@ class EmptyBucket(PhotoBucket):
         """
         return SETTINGS.get(self._credentials_key, False)
 
-
-Google = BucketFactory(
-    name="Google",
-    description="Connect to Google Photos",
-    init=GooglePhotos.from_code_grant,
-)
-
-Facebook = BucketFactory(
-    name="Facebook",
-    description="Connect to your Facebook photos",
-    init=FacebookPhotos.from_code_grant,
-)
@@ -0,0 +1,177 @@
+"""
+Daily and monthly budget of bytes downloaded, for metered connections.
+As the budget drains the application degrades: it downloads smaller renditions,
+prefers cached photos, changes wallpaper less often, and finally only uses cached photos.
+"""
+import atexit
+import enum
+import logging
+import threading
+import time
+from datetime import date
+from typing import Optional, Tuple
+
+from .settings import SETTINGS
+
+# seconds between writes of the usage to settings
+SAVE_INTERVAL = 10
+log = logging.getLogger(__name__)
+
+
+class BudgetExhausted(Exception):
+    """
+    A download was refused because the data budget is spent
+    """
+
+
+class BudgetLevel(enum.IntEnum):
+    """
+    Degradation levels, by remaining budget
+    """
+
+    NORMAL = 0
+    # at most half the budget left: screen-sized renditions, cached photos preferred
+    LOW = 1
+    # at most a tenth left: half screen-sized renditions, period stretched
+    CRITICAL = 2
+    # nothing left: cached photos only
+    EXHAUSTED = 3
+
+
+# remaining fraction of the budget at or below which each level starts
+THRESHOLDS = (
+    (0.0, BudgetLevel.EXHAUSTED),
+    (0.1, BudgetLevel.CRITICAL),
+    (0.5, BudgetLevel.LOW),
+)
+# multiplier of the wallpaper change period at each level
+PERIOD_FACTORS = {
+    BudgetLevel.NORMAL: 1,
+    BudgetLevel.LOW: 2,
+    BudgetLevel.CRITICAL: 4,
+    BudgetLevel.EXHAUSTED: 4,
+}
+
+
+class Budget:
+    """
+    Bytes downloaded today and this month, against the limits set by
+    ``budget/daily_mb`` and ``budget/monthly_mb``. Unset limits are unlimited.
+    Usage is kept in ``budget/usage``.
+    """
+
+    def __init__(self):
+        usage = SETTINGS.get("budget/usage") or {}
+        self.day: str = usage.get("day", "")
+        self.day_bytes: int = usage.get("day_bytes", 0)
+        self.month: str = usage.get("month", "")
+        self.month_bytes: int = usage.get("month_bytes", 0)
+        # size of the screen, for choosing renditions
+        self.screen: Optional[Tuple[int, int]] = None
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+        self._level = BudgetLevel.NORMAL
+        self._roll_over()
+
+    def _roll_over(self):
+        today = date.today()
+        if self.day != today.isoformat():
+            self.day, self.day_bytes = today.isoformat(), 0
+        if self.month != today.strftime("%Y-%m"):
+            self.month, self.month_bytes = today.strftime("%Y-%m"), 0
+
+    def record(self, size: int):
+        """
+        Count downloaded bytes
+        :param size: amount of bytes downloaded
+        """
+        with self._lock:
+            self._roll_over()
+            self.day_bytes += size
+            self.month_bytes += size
+        level = self.level
+        if level is not self._level:
+            log.warning("data budget: %s, level %s", self, level.name.lower())
+            self._level = level
+            self.save()
+        elif time.monotonic() - self._saved_at > SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """
+        Write usage to settings
+        """
+        self._saved_at = time.monotonic()
+        SETTINGS["budget/usage"] = {
+            "day": self.day,
+            "day_bytes": self.day_bytes,
+            "month": self.month,
+            "month_bytes": self.month_bytes,
+        }
+
+    @staticmethod
+    def _limit(key: str) -> Optional[int]:
+        megabytes = SETTINGS.get(key)
+        return int(megabytes * 2 ** 20) if megabytes else None
+
+    @property
+    def remaining(self) -> float:
+        """
+        Remaining fraction of the tightest budget, 1 when there are no limits
+        """
+        self._roll_over()
+        fractions = [
+            max(0.0, 1 - used / limit)
+            for used, limit in (
+                (self.day_bytes, self._limit("budget/daily_mb")),
+                (self.month_bytes, self._limit("budget/monthly_mb")),
+            )
+            if limit
+        ]
+        return min(fractions, default=1.0)
+
+    @property
+    def level(self) -> BudgetLevel:
+        remaining = self.remaining
+        for threshold, level in THRESHOLDS:
+            if remaining <= threshold:
+                return level
+        return BudgetLevel.NORMAL
+
+    def rendition_size(self) -> Optional[Tuple[int, int]]:
+        """
+        Largest photo size worth downloading at the current level,
+        ``None`` for original photos
+        """
+        level = self.level
+        if level is BudgetLevel.NORMAL or not self.screen:
+            return None
+        width, height = self.screen
+        if level is BudgetLevel.LOW:
+            return width, height
+        return width // 2, height // 2
+
+    @property
+    def period_factor(self) -> int:
+        """
+        Multiplier of the wallpaper change period
+        """
+        return PERIOD_FACTORS[self.level]
+
+    def __str__(self):
+        parts = []
+        for name, used, key in (
+            ("today", self.day_bytes, "budget/daily_mb"),
+            ("this month", self.month_bytes, "budget/monthly_mb"),
+        ):
+            limit = self._limit(key)
+            parts.append(
+                f"{used / 2 ** 20:.1f}"
+                + (f"/{limit / 2 ** 20:.0f}" if limit else "")
+                + f" MB {name}"
+            )
+        return ", ".join(parts)
+
+
+BUDGET = Budget()
+atexit.register(BUDGET.save)
@@ -0,0 +1,69 @@
+"""
+Perceptual hashing of photo thumbnails, used for detecting
+the same photo uploaded to more than one provider.
+Hashing runs in a process pool, so this module is kept free of
+application imports to stay cheap to load in worker processes.
+"""
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# hashes are HASH_SIZE * HASH_SIZE bits long
+HASH_SIZE = 8
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def dhash(data: bytes) -> str:
+    """
+    Compute the difference hash of an image:
+    a bit per pixel of a tiny grayscale copy, set if the pixel is brighter than its right neighbour
+    :param data: encoded image
+    :return: hash as a hex string
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE))
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            bits = bits << 1 | (left > pixels[row * (HASH_SIZE + 1) + column + 1])
+    return f"{bits:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+
+def available() -> bool:
+    """
+    Whether the image library needed for hashing is installed
+    """
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def process_pool(max_workers: int = 2) -> ProcessPoolExecutor:
+    """
+    Return the process pool for hashing, creating it on first use
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+async def perceptual_hash(data: bytes) -> str:
+    """
+    Compute the perceptual hash of an image in the process pool
+    :param data: encoded image, preferably a small thumbnail
+    """
+    return await asyncio.get_running_loop().run_in_executor(process_pool(), dhash, data)
@@ -0,0 +1,236 @@
+"""
+Vectorized photo filtering over columnar metadata.
+Both index types expose their metadata as a structured NumPy array with the
+fields of ``COLUMNS``, so every predicate is evaluated over whole columns at once.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Sequence, Iterator, Tuple
+
+import attr
+import numpy as np
+
+from .providers import parse_setting_time
+from .settings import SETTINGS
+
+# flag set in the ``flags`` column of photos with a perceptual hash
+HAS_HASH = 1
+COLUMNS = np.dtype(
+    [
+        ("width", "<u4"),
+        ("height", "<u4"),
+        ("flags", "<u4"),
+        ("created", "<i8"),
+        ("phash", "<u8"),
+    ]
+)
+ORIENTATIONS = ("landscape", "portrait", "square")
+NO_HASHES = np.empty(0, dtype=np.uint64)
+# defaults of the ``filter`` settings, kept by the main window's filter widgets
+MIN_WIDTH = 1000
+MIN_HEIGHT = 0
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class PhotoFilter:
+    """
+    Combination of photo predicates. Unset bounds match every photo.
+    :param min_width: minimum width
+    :param max_width: maximum width
+    :param min_height: minimum height
+    :param max_height: maximum height
+    :param min_aspect: minimum ratio of width to height
+    :param max_aspect: maximum ratio of width to height
+    :param orientation: one of ``ORIENTATIONS``
+    :param date_from: earliest creation time; photos with unknown times never match dates
+    :param date_to: latest creation time
+    """
+
+    min_width: int = 0
+    max_width: Optional[int] = None
+    min_height: int = 0
+    max_height: Optional[int] = None
+    min_aspect: Optional[float] = None
+    max_aspect: Optional[float] = None
+    orientation: Optional[str] = None
+    date_from: Optional[datetime] = None
+    date_to: Optional[datetime] = None
+
+    @classmethod
+    def from_settings(cls) -> "PhotoFilter":
+        """
+        Build filter from the ``filter`` settings, as last set in the main window
+        """
+        return cls(
+            min_width=SETTINGS.get("filter/min_width", MIN_WIDTH),
+            min_height=SETTINGS.get("filter/min_height", MIN_HEIGHT),
+            orientation=SETTINGS.get("filter/orientation"),
+            date_from=parse_setting_time(SETTINGS.get("filter/date_from")),
+            date_to=parse_setting_time(SETTINGS.get("filter/date_to")),
+        )
+
+    def mask(self, columns: np.ndarray) -> np.ndarray:
+        """
+        Return boolean mask of matching photos
+        :param columns: photo metadata, with the fields of ``COLUMNS``
+        """
+        width = columns["width"]
+        height = columns["height"]
+        mask = (width >= self.min_width) & (height >= self.min_height)
+        if self.max_width is not None:
+            mask &= width <= self.max_width
+        if self.max_height is not None:
+            mask &= height <= self.max_height
+        if self.min_aspect is not None or self.max_aspect is not None:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                aspect = width / height
+            if self.min_aspect is not None:
+                mask &= aspect >= self.min_aspect
+            if self.max_aspect is not None:
+                mask &= aspect <= self.max_aspect
+        if self.orientation == "landscape":
+            mask &= width > height
+        elif self.orientation == "portrait":
+            mask &= width < height
+        elif self.orientation == "square":
+            mask &= width == height
+        if self.date_from or self.date_to:
+            created = columns["created"]
+            mask &= created != 0
+            if self.date_from:
+                mask &= created >= int(self.date_from.timestamp())
+            if self.date_to:
+                mask &= created <= int(self.date_to.timestamp())
+        return mask
+
+
+class FilterCache:
+    """
+    Indices of matching photos by predicate, for the most recently used predicates
+    """
+
+    def __init__(self, size: int = 16):
+        self.size = size
+        self._results: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+
+    def clear(self):
+        self._results.clear()
+
+    def select(
+        self,
+        columns: np.ndarray,
+        version: int,
+        photo_filter: PhotoFilter,
+        exclude: np.ndarray = NO_HASHES,
+    ) -> np.ndarray:
+        """
+        Return indices of photos matching ``photo_filter``
+        :param columns: photo metadata, with the fields of ``COLUMNS``
+        :param version: changes whenever ``columns`` change, invalidating cached results
+        :param photo_filter: predicates to match
+        :param exclude: perceptual hashes of photos to leave out
+        """
+        key = (photo_filter, version, len(exclude), hash(exclude.tobytes()))
+        try:
+            self._results.move_to_end(key)
+            return self._results[key]
+        except KeyError:
+            pass
+        mask = photo_filter.mask(columns)
+        if len(exclude):
+            mask &= ~(
+                (columns["flags"] & HAS_HASH).astype(bool)
+                & np.isin(columns["phash"], exclude)
+            )
+        indices = np.flatnonzero(mask)
+        self._results[key] = indices
+        while len(self._results) > self.size:
+            self._results.popitem(last=False)
+        return indices
+
+
+class IndexedView(Sequence[dict]):
+    """
+    Selected photos, referring to the index's photos by position without copying them
+    """
+
+    def __init__(self, photos: Sequence[dict], indices: np.ndarray, columns: np.ndarray):
+        """
+        :param photos: all photos of the index
+        :param indices: positions of selected photos
+        :param columns: metadata of all photos
+        """
+        self.photos = photos
+        self.indices = indices
+        self.columns = columns
+
+    @property
+    def hashes(self) -> np.ndarray:
+        """
+        Perceptual hashes of the selected photos which have one
+        """
+        hashed = (self.columns["flags"][self.indices] & HAS_HASH).astype(bool)
+        return self.columns["phash"][self.indices[hashed]]
+
+    def subset(self, keep: Sequence[bool]) -> "IndexedView":
+        """
+        Return view of the selected photos for which ``keep`` is true
+        """
+        return IndexedView(
+            self.photos, self.indices[np.asarray(keep, dtype=bool)], self.columns
+        )
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index: int) -> dict:
+        return self.photos[int(self.indices[index])]
+
+    def __iter__(self) -> Iterator[dict]:
+        for position in self.indices:
+            yield self.photos[int(position)]
+
+
+class Columns:
+    """
+    Growable photo metadata columns, parallel to a list of photos
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._data = np.zeros(capacity, dtype=COLUMNS)
+        self.length = 0
+        # incremented on every change
+        self.version = 0
+
+    @property
+    def view(self) -> np.ndarray:
+        """
+        Columns of all photos
+        """
+        return self._data[: self.length]
+
+    def clear(self):
+        self.length = 0
+        self.version += 1
+
+    def set(self, position: int, dimensions: Tuple[int, int], created: Optional[datetime]):
+        """
+        Set metadata of the photo at ``position``, appending it if it is new
+        """
+        if position == len(self._data):
+            self._data = np.resize(self._data, len(self._data) * 2)
+        row = self._data[position]
+        row["width"], row["height"] = dimensions
+        row["created"] = int(created.timestamp()) if created else 0
+        if position == self.length:
+            row["flags"] = 0
+            self.length += 1
+        self.version += 1
+
+    def set_hash(self, position: int, value: str):
+        """
+        Set perceptual hash of the photo at ``position``
+        """
+        self._data[position]["phash"] = int(value, 16)
+        self._data[position]["flags"] |= HAS_HASH
+        self.version += 1
@@ -0,0 +1,129 @@
+"""
+Tracking of providers' responsiveness.
+A circuit breaker stops downloads from a provider after consecutive failures,
+and lets a single probe through once a cooldown has passed.
+"""
+import enum
+import time
+from typing import Optional
+
+from .settings import SETTINGS
+
+# weight of the newest sample in the latency moving average
+LATENCY_WEIGHT = 0.3
+# defaults of the ``health`` settings:
+# consecutive failures opening the circuit
+FAILURE_THRESHOLD = 3
+# seconds before the first probe of an open circuit, doubled after every failed probe
+COOLDOWN = 30
+MAX_COOLDOWN = 600
+
+
+class CircuitState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitOpen(Exception):
+    """
+    A download was refused because its provider is considered down
+    """
+
+
+class ProviderHealth:
+    """
+    Recent latency and failures of a provider's downloads
+    """
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.last_failure: Optional[float] = None
+        self.opened_at: Optional[float] = None
+        self.cooldown: float = SETTINGS.get("health/cooldown", COOLDOWN)
+        self._probing = False
+
+    @property
+    def state(self) -> CircuitState:
+        """
+        Circuit state: closed while healthy, open while downloads are refused,
+        half-open once the cooldown has passed and a probe may go through
+        """
+        if self.opened_at is None:
+            return CircuitState.CLOSED
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return CircuitState.OPEN
+        return CircuitState.HALF_OPEN
+
+    def allow_request(self) -> bool:
+        """
+        Whether a download may be made now.
+        In the half-open state only one probe is let through at a time.
+        """
+        state = self.state
+        if state is CircuitState.CLOSED:
+            return True
+        if state is CircuitState.OPEN or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_cancelled(self):
+        """
+        Record a request abandoned before it completed, letting another probe through
+        """
+        self._probing = False
+
+    def record_success(self, latency: float):
+        """
+        Record a successful request, closing the circuit
+        :param latency: request duration, in seconds
+        """
+        self.failures = 0
+        self._probing = False
+        if self.opened_at is not None:
+            self.opened_at = None
+            self.cooldown = SETTINGS.get("health/cooldown", COOLDOWN)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_WEIGHT * (latency - self.latency)
+
+    def record_failure(self):
+        """
+        Record a failed request, opening the circuit after too many in a row
+        or when a probe fails
+        """
+        self.failures += 1
+        self.last_failure = time.monotonic()
+        if self._probing:
+            self._probing = False
+            self.cooldown = min(
+                self.cooldown * 2, SETTINGS.get("health/max_cooldown", MAX_COOLDOWN)
+            )
+            self.opened_at = self.last_failure
+        elif self.failures >= SETTINGS.get("health/failures", FAILURE_THRESHOLD):
+            self.opened_at = self.last_failure
+
+    @property
+    def reachable(self) -> bool:
+        """
+        Whether the last request succeeded
+        """
+        return not self.failures
+
+    def degraded(self, latency_threshold: float) -> bool:
+        """
+        Whether the provider is unreachable or slower than ``latency_threshold`` seconds
+        """
+        return not self.reachable or (
+            self.latency is not None and self.latency > latency_threshold
+        )
+
+    def __str__(self):
+        latency = "unknown" if self.latency is None else f"{self.latency:.2f}s"
+        return (
+            f"latency {latency}, {self.failures} consecutive failures, "
+            f"circuit {self.state.value}"
+        )
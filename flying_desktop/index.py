@@ -0,0 +1,241 @@
+"""
+Local index of photo metadata, kept between runs so buckets
+only need to fetch what changed since the last sync
+"""
+import json
+import logging
+import os
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Iterable, Set
+
+import numpy as np
+
+from .filters import Columns, FilterCache, PhotoFilter, IndexedView, NO_HASHES
+from .providers import PhotoProvider
+from .settings import CACHE_DIR, SETTINGS
+
+INDEX_DIR = CACHE_DIR / "index"
+# default time between full reconciliation crawls, overridable by ``index/reconcile_days``
+RECONCILE_PERIOD = timedelta(days=7)
+# default age after which an interrupted crawl is started over rather than resumed,
+# overridable by ``crawl/checkpoint_hours``
+CHECKPOINT_AGE = timedelta(hours=24)
+log = logging.getLogger(__name__)
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    return value and datetime.fromisoformat(value)
+
+
+def _format_time(value: Optional[datetime]) -> Optional[str]:
+    return value and value.isoformat()
+
+
+class SyncState:
+    """
+    Times of a bucket's last syncs
+    """
+
+    synced_at: Optional[datetime] = None
+    reconciled_at: Optional[datetime] = None
+    # crawl query the photos were fetched with, as dumped by ``CrawlQuery.dump``
+    query: Optional[dict] = None
+    # progress of an interrupted crawl, as saved by ``FilledBucket.download``
+    checkpoint: Optional[dict] = None
+    # pages merged between saves of the checkpoint
+    checkpoint_pages = 10
+
+    def needs_reconcile(self, now: datetime) -> bool:
+        """
+        Whether a full crawl is due to pick up deleted photos
+        """
+        if not SETTINGS.get("index/incremental", True) or not self.reconciled_at:
+            return True
+        days = SETTINGS.get("index/reconcile_days", RECONCILE_PERIOD.days)
+        return now - self.reconciled_at > timedelta(days=days)
+
+    def resumable(self, query: dict, now: datetime) -> Optional[dict]:
+        """
+        Return checkpoint of an interrupted crawl, if it can be resumed
+        :param query: crawl query about to be used, as dumped by ``CrawlQuery.dump``
+        :param now: start time of the crawl about to be made
+        """
+        checkpoint = self.checkpoint
+        if not checkpoint or checkpoint["query"] != query:
+            return None
+        hours = SETTINGS.get("crawl/checkpoint_hours", CHECKPOINT_AGE // timedelta(hours=1))
+        if now - _parse_time(checkpoint["at"]) > timedelta(hours=hours):
+            return None
+        return checkpoint
+
+    def _load_state(self, data: dict):
+        self.synced_at = _parse_time(data.get("synced_at"))
+        self.reconciled_at = _parse_time(data.get("reconciled_at"))
+        self.query = data.get("query")
+        self.checkpoint = data.get("checkpoint")
+
+    def _dump_state(self) -> dict:
+        return {
+            "synced_at": _format_time(self.synced_at),
+            "reconciled_at": _format_time(self.reconciled_at),
+            "query": self.query,
+            "checkpoint": self.checkpoint,
+        }
+
+
+class PhotoIndex(SyncState):
+    """
+    Photo metadata of a single bucket, stored as JSON under the cache directory
+    """
+
+    def __init__(self, name: str, client: PhotoProvider):
+        """
+        :param name: bucket name
+        :param client: provider fetching the photos, for extracting their metadata
+        """
+        self.path = INDEX_DIR / f"{name.lower()}.json"
+        self.client = client
+        self.photos: List[dict] = []
+        # perceptual hashes of photos, by photo ID
+        self.hashes: Dict[str, str] = {}
+        self.columns = Columns()
+        self._filter_cache = FilterCache()
+        self._positions: Dict[str, int] = {}
+        self._seen: Optional[Set[str]] = None
+
+    def load(self):
+        """
+        Read index from disk, if it exists
+        """
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            log.warning("corrupt photo index %s, ignoring", self.path)
+            return
+        self._load_state(data)
+        # photos merged so far by an interrupted full sync
+        self._seen = set(data["seen"]) if "seen" in data else None
+        self.photos[:] = []
+        self._positions.clear()
+        self.columns.clear()
+        self.merge(data.get("photos", []))
+        self.hashes = {}
+        for photo_id, value in data.get("hashes", {}).items():
+            if photo_id in self._positions:
+                self.set_photo_hash(self.photos[self._positions[photo_id]], value)
+
+    def save(self):
+        """
+        Write index to disk
+        """
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        temp = self.path.with_suffix(".tmp")
+        data = {**self._dump_state(), "photos": self.photos, "hashes": self.hashes}
+        if self._seen is not None and self.checkpoint:
+            data["seen"] = list(self._seen)
+        with temp.open("w") as f:
+            json.dump(data, f)
+        os.replace(temp, self.path)
+
+    def clear(self):
+        """
+        Forget all photos and delete the index from disk
+        """
+        self.photos[:] = []
+        self._positions.clear()
+        self.hashes.clear()
+        self.columns.clear()
+        self.synced_at = self.reconciled_at = self.query = self.checkpoint = None
+        self._seen = None
+        with suppress(FileNotFoundError):
+            self.path.unlink()
+
+    def merge(self, photos: Iterable[dict]):
+        """
+        Add new photos and update known ones
+        """
+        for photo in photos:
+            if self._seen is not None:
+                self._seen.add(photo["id"])
+            position = self._positions.get(photo["id"])
+            if position is None:
+                position = self._positions[photo["id"]] = len(self.photos)
+                self.photos.append(photo)
+            else:
+                self.photos[position] = photo
+            self.columns.set(
+                position, self.client.dimensions(photo), self.client.created_time(photo)
+            )
+
+    def begin_full_sync(self, resume: bool = False):
+        """
+        Start tracking merged photos, so those missing from a full crawl can be pruned
+        :param resume: whether an interrupted full sync is resumed,
+            keeping track of the photos it merged
+        """
+        if not resume or self._seen is None:
+            self._seen = set()
+
+    def end_full_sync(self):
+        """
+        Remove photos which were not merged since ``begin_full_sync``
+        """
+        keep, self._seen = self._seen, None
+        removed = len(self.photos)
+        photos = [photo for photo in self.photos if photo["id"] in keep]
+        hashes = self.hashes
+        self.photos[:] = []
+        self._positions.clear()
+        self.hashes = {}
+        self.columns.clear()
+        self.merge(photos)
+        for photo in photos:
+            if photo["id"] in hashes:
+                self.set_photo_hash(photo, hashes[photo["id"]])
+        removed -= len(self.photos)
+        if removed:
+            log.info("pruned %d deleted photos from %s", removed, self.path.name)
+
+    def find(self, photo_id: str) -> Optional[dict]:
+        """
+        Return metadata of the photo with ``photo_id``, if it is in the index
+        """
+        position = self._positions.get(photo_id)
+        return None if position is None else self.photos[position]
+
+    def photo_hash(self, photo: dict) -> Optional[str]:
+        """
+        Return perceptual hash of photo, if computed
+        """
+        return self.hashes.get(photo["id"])
+
+    def set_photo_hash(self, photo: dict, value: str):
+        """
+        Store perceptual hash of photo
+        """
+        self.hashes[photo["id"]] = value
+        self.columns.set_hash(self._positions[photo["id"]], value)
+
+    def unhashed(self) -> List[dict]:
+        """
+        Return photos without a perceptual hash
+        """
+        return [photo for photo in self.photos if photo["id"] not in self.hashes]
+
+    def select(
+        self, photo_filter: PhotoFilter, exclude: np.ndarray = NO_HASHES
+    ) -> IndexedView:
+        """
+        Return photos matching ``photo_filter``
+        :param photo_filter: predicates to match
+        :param exclude: perceptual hashes of photos to leave out
+        """
+        columns = self.columns.view
+        indices = self._filter_cache.select(
+            columns, self.columns.version, photo_filter, exclude
+        )
+        return IndexedView(self.photos, indices, columns)
@@ -0,0 +1,120 @@
+"""
+Single running instance of the application.
+The first instance holds a lock file under the cache directory and listens on a local
+socket; later launches forward their command to it and exit, without starting Tk.
+Unix sockets are used where available, otherwise a loopback TCP port stored in a file.
+"""
+import logging
+import os
+import socket
+import time
+from typing import Callable, Dict, Optional, IO
+
+from .settings import CACHE_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LOCK_PATH = CACHE_DIR / "instance.lock"
+SOCKET_PATH = CACHE_DIR / "instance.sock"
+PORT_PATH = CACHE_DIR / "instance.port"
+# seconds to keep trying to reach an instance which is still starting up
+CONNECT_TIMEOUT = 3
+log = logging.getLogger(__name__)
+
+_lock_file: Optional[IO] = None
+
+
+def acquire_lock() -> bool:
+    """
+    Try to become the running instance. The lock is held until the process exits.
+    :return: whether the lock was acquired
+    """
+    global _lock_file
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    lock_file = LOCK_PATH.open("a+")
+    try:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock_file.close()
+        return False
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    _lock_file = lock_file
+    return True
+
+
+def _connect() -> socket.socket:
+    if hasattr(socket, "AF_UNIX"):
+        sock = socket.socket(socket.AF_UNIX)
+        address = str(SOCKET_PATH)
+    else:
+        sock = socket.socket()
+        address = ("127.0.0.1", int(PORT_PATH.read_text()))
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def send(command: str) -> Optional[str]:
+    """
+    Forward command to the running instance
+    :param command: command name
+    :return: the instance's reply, or ``None`` if it could not be reached in time
+    """
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while True:
+        try:
+            sock = _connect()
+            break
+        except (OSError, ValueError):
+            # the instance may still be starting up
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.1)
+    with sock, sock.makefile("rw") as stream:
+        stream.write(command + "\n")
+        stream.flush()
+        return stream.readline().strip()
+
+
+async def serve(commands: Dict[str, Callable[[], None]]) -> "asyncio.AbstractServer":
+    """
+    Accept commands from later launches. Must hold the lock.
+    :param commands: callbacks by command name, run on the event loop
+    """
+    # imported here, as forwarding a command has no use for asyncio
+    import asyncio
+
+    async def handle(reader: "asyncio.StreamReader", writer: "asyncio.StreamWriter"):
+        command = (await reader.readline()).decode().strip()
+        callback = commands.get(command)
+        if callback is None:
+            writer.write(f"unknown command: {command}\n".encode())
+        else:
+            log.info("received command %r from another launch", command)
+            callback()
+            writer.write(b"ok\n")
+        await writer.drain()
+        writer.close()
+
+    if hasattr(socket, "AF_UNIX"):
+        # left over by an instance which did not exit cleanly
+        if SOCKET_PATH.exists():
+            SOCKET_PATH.unlink()
+        return await asyncio.start_unix_server(handle, str(SOCKET_PATH))
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    PORT_PATH.write_text(str(server.sockets[0].getsockname()[1]))
+    return server
@@ -1,11 +1,20 @@
 """
-Logging utilities
+Logging utilities.
+Records are put on a queue and written by a listener thread,
+so the Tk and asyncio threads never wait for the disk or the console.
 """
+import atexit
 import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import Optional, Iterable
 
 from appdirs import user_log_dir
 from . import APP_NAME
+from .settings import SETTINGS
 
 
 LOG_FILE = Path(user_log_dir(), "flying_desktop.log")
@@ -15,19 +24,115 @@ LOG_FORMAT = logging.Formatter(
     " - ".join(f"%({x})s" for x in ["asctime", "levelname", "name", "message"]),
 )
 
+# defaults of the ``log`` settings
+LOG_LEVEL = "INFO"
+LOG_MAX_KB = 1024
+LOG_BACKUPS = 3
+DEBUG_RATE = 20
+
+_listener: Optional[QueueListener] = None
+
+
+class RateLimit(logging.Filter):
+    """
+    Let through at most ``rate`` records per second below ``level``, dropping the rest.
+    The next record let through tells how many were dropped.
+    """
+
+    def __init__(self, rate: float, level: int = logging.INFO):
+        """
+        :param rate: records per second, also the size of a burst
+        :param level: records at this level or above are never dropped
+        """
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        self.dropped = 0
+        self._allowance = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.level:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(
+                self.rate, self._allowance + (now - self._last) * self.rate
+            )
+            self._last = now
+            if self._allowance < 1:
+                self.dropped += 1
+                return False
+            self._allowance -= 1
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            record.msg = f"{record.msg} [{dropped} debug messages dropped]"
+        return True
+
 
 def logging_setup():
     """
-    Attach handlers to the application's root logger
+    Attach a queue handler to the application's root logger,
+    and start the listener writing to the console and to a rotating log file.
+    The level is set by ``log/level``; debug records are limited to ``log/debug_rate``
+    per second.
     """
+    global _listener
     main_log = logging.getLogger(APP_NAME)
-    main_log.setLevel(logging.DEBUG)
+    main_log.setLevel(SETTINGS.get("log/level", LOG_LEVEL))
     LOG_FILE.parent.mkdir(exist_ok=True, parents=True)
-    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler = RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=SETTINGS.get("log/max_kb", LOG_MAX_KB) * 1024,
+        backupCount=SETTINGS.get("log/backups", LOG_BACKUPS),
+        encoding="utf-8",
+    )
     file_handler.setLevel(logging.INFO)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.DEBUG)
-
     for handler in console_handler, file_handler:
         handler.setFormatter(LOG_FORMAT)
-        main_log.addHandler(handler)
+
+    _listener = listen(
+        main_log,
+        console_handler,
+        file_handler,
+        filters=[RateLimit(SETTINGS.get("log/debug_rate", DEBUG_RATE))],
+    )
+
+
+def listen(
+    logger: logging.Logger,
+    *handlers: logging.Handler,
+    filters: Iterable[logging.Filter] = (),
+) -> QueueListener:
+    """
+    Route records of ``logger`` through a queue to ``handlers``,
+    which are called from a listener thread.
+    The listener is stopped on exit, after writing out queued records.
+    :param logger: logger to attach a queue handler to
+    :param handlers: handlers called by the listener
+    :param filters: filters of the queue handler, applied before records are queued
+    :return: the started listener
+    """
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue()
+    queue_handler = QueueHandler(records)
+    for filter_ in filters:
+        queue_handler.addFilter(filter_)
+    logger.addHandler(queue_handler)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def add_handler(handler: logging.Handler):
+    """
+    Attach handler to the application's logs.
+    Once logging is set up, the handler is called from the listener thread.
+    """
+    if _listener is None:
+        logging.getLogger(APP_NAME).addHandler(handler)
+        return
+    _listener.handlers = (*_listener.handlers, handler)
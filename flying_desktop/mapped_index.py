@@ -0,0 +1,387 @@
+"""
+Photo index for very large libraries.
+Metadata is kept in fixed-width binary records in a memory-mapped file,
+so filtering and sampling run over the mapping instead of over objects on the heap.
+Records are read as NumPy columns straight from the mapping, without copying them.
+"""
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+from contextlib import suppress
+from pathlib import Path
+from typing import Sequence, Iterable, Iterator, Tuple, Optional, Dict
+
+import numpy as np
+
+from .filters import HAS_HASH, FilterCache, PhotoFilter, IndexedView, NO_HASHES
+from .index import INDEX_DIR, SyncState
+from .providers import PhotoProvider
+
+log = logging.getLogger(__name__)
+
+# id offset, id length, width, height, flags, creation timestamp, perceptual hash
+RECORD = struct.Struct("<QIIIIqQ")
+RECORD_COLUMNS = np.dtype(
+    [
+        ("id_offset", "<u8"),
+        ("id_length", "<u4"),
+        ("width", "<u4"),
+        ("height", "<u4"),
+        ("flags", "<u4"),
+        ("created", "<i8"),
+        ("phash", "<u8"),
+    ]
+)
+HASH_OFFSET = RECORD.size - 8
+FLAGS_OFFSET = 20
+Record = Tuple[int, int, int, int, int, int, int]
+
+
+class MappedPhotos(Sequence[dict]):
+    """
+    Read-only view of the photos in a records file and its accompanying IDs file.
+    Items are created on access and hold only the photo ID and dimensions.
+    """
+
+    def __init__(self, records_path: Path, ids_path: Path):
+        self.records_path = records_path
+        self.ids_path = ids_path
+        self._records: Optional[mmap.mmap] = None
+        self._ids: Optional[mmap.mmap] = None
+        self.remap()
+
+    @staticmethod
+    def _map(path: Path) -> Optional[mmap.mmap]:
+        if not path.exists() or not path.stat().st_size:
+            return None
+        with path.open("r+b") as f:
+            return mmap.mmap(f.fileno(), 0)
+
+    def remap(self):
+        """
+        Map the files again after they have changed
+        """
+        self.close()
+        self._records = self._map(self.records_path)
+        self._ids = self._map(self.ids_path)
+
+    def close(self):
+        """
+        Unmap the files.
+        Mappings still being iterated over are left to be unmapped once released.
+        """
+        for mapping in self._records, self._ids:
+            if mapping is not None:
+                with suppress(BufferError):
+                    mapping.close()
+        self._records = self._ids = None
+
+    def __len__(self) -> int:
+        return len(self._records) // RECORD.size if self._records is not None else 0
+
+    def record(self, position: int) -> Record:
+        """
+        Return the raw record at ``position``
+        """
+        return RECORD.unpack_from(self._records, position * RECORD.size)
+
+    @property
+    def columns(self) -> np.ndarray:
+        """
+        Records as a structured array backed by the mapping
+        """
+        if self._records is None:
+            return np.empty(0, dtype=RECORD_COLUMNS)
+        return np.frombuffer(self._records, dtype=RECORD_COLUMNS)
+
+    def records(self) -> Iterator[Tuple[int, Record]]:
+        """
+        Iterate over positions and raw records
+        """
+        if self._records is None:
+            return
+        with memoryview(self._records) as view:
+            yield from enumerate(RECORD.iter_unpack(view))
+
+    def photo_id(self, record: Record) -> str:
+        """
+        Return the photo ID a record refers to
+        """
+        offset, length = record[:2]
+        return self._ids[offset : offset + length].decode()
+
+    def photo(self, position: int, record: Record) -> dict:
+        """
+        Create photo metadata from a raw record
+        """
+        return {
+            "id": self.photo_id(record),
+            "width": record[2],
+            "height": record[3],
+            "position": position,
+        }
+
+    def __getitem__(self, position: int) -> dict:
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return self.photo(position, self.record(position))
+
+    def __iter__(self) -> Iterator[dict]:
+        for position, record in self.records():
+            yield self.photo(position, record)
+
+    def set_hash(self, position: int, value: int):
+        """
+        Store perceptual hash in the record at ``position``
+        """
+        offset = position * RECORD.size
+        (flags,) = struct.unpack_from("<I", self._records, offset + FLAGS_OFFSET)
+        struct.pack_into("<I", self._records, offset + FLAGS_OFFSET, flags | HAS_HASH)
+        struct.pack_into("<Q", self._records, offset + HASH_OFFSET, value)
+
+
+class MappedIndex(SyncState):
+    """
+    Photo metadata of a single bucket, stored as memory-mapped binary records
+    under the cache directory.
+    A full sync writes the next generation of files and switches to them when it ends,
+    as files which are still mapped can't be replaced on every platform.
+    """
+
+    # records are written as they are merged, so the checkpoint is saved with every page
+    checkpoint_pages = 1
+
+    def __init__(self, name: str, client: PhotoProvider):
+        """
+        :param name: bucket name
+        :param client: provider fetching the photos, for extracting their dimensions
+        """
+        self._base = INDEX_DIR / name.lower()
+        self.state_path = self._base.with_suffix(".state.json")
+        # number of the files in use, which is incremented by every full sync
+        self.generation = 0
+        self.records_path, self.ids_path = self._paths(self.generation)
+        self.client = client
+        self.photos = MappedPhotos(self.records_path, self.ids_path)
+        self._filter_cache = FilterCache()
+        # incremented on every change of the records
+        self._version = 0
+        self._rewriting = False
+        # positions of photos by ID, built on the first lookup
+        self._positions: Optional[Dict[str, int]] = None
+
+    def load(self):
+        """
+        Read sync state and map the records
+        """
+        with suppress(FileNotFoundError, ValueError), self.state_path.open() as f:
+            self._load_state(json.load(f))
+        self._use(self.generation)
+        self._positions = None
+        self._version += 1
+        self._delete_stale()
+
+    def save(self):
+        """
+        Write sync state; records are written as they are merged.
+        The checkpoint of a full sync records the length of the new files it covers.
+        Files of earlier generations are deleted once the state no longer refers to them.
+        """
+        if self._rewriting and self.checkpoint is not None:
+            self.checkpoint["written"] = [_size(path) for path in self._paths(self.generation + 1)]
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        with self.state_path.open("w") as f:
+            json.dump(self._dump_state(), f)
+        self._delete_stale()
+
+    def _load_state(self, data: dict):
+        super()._load_state(data)
+        self.generation = data.get("generation", 0)
+
+    def _dump_state(self) -> dict:
+        return {**super()._dump_state(), "generation": self.generation}
+
+    def clear(self):
+        """
+        Forget all photos and delete the index from disk
+        """
+        self.photos.close()
+        self._positions = None
+        self._version += 1
+        self.synced_at = self.reconciled_at = self.query = self.checkpoint = None
+        with suppress(FileNotFoundError):
+            self.state_path.unlink()
+        self._delete_stale(keep=())
+        self._use(0)
+
+    def _paths(self, generation: int) -> Tuple[Path, Path]:
+        """
+        Return the records and IDs files of ``generation``
+        """
+        name = f"{self._base.name}.{generation}" if generation else self._base.name
+        return self._base.with_name(f"{name}.records"), self._base.with_name(f"{name}.ids")
+
+    def _use(self, generation: int):
+        """
+        Map the files of ``generation``
+        """
+        self.generation = generation
+        self.records_path, self.ids_path = self._paths(generation)
+        self.photos.records_path, self.photos.ids_path = self.records_path, self.ids_path
+        self.photos.remap()
+
+    def _delete_stale(self, keep: Optional[Iterable[Path]] = None):
+        """
+        Delete records and IDs files other than the current and next generation's.
+        Files which are still mapped can't be deleted on Windows, and are left for next time.
+        :param keep: files to keep instead
+        """
+        if keep is None:
+            keep = (*self._paths(self.generation), *self._paths(self.generation + 1))
+        pattern = re.compile(rf"{re.escape(self._base.name)}(\.\d+)?\.(records|ids)")
+        with suppress(FileNotFoundError):
+            for path in INDEX_DIR.iterdir():
+                if pattern.fullmatch(path.name) and path not in keep:
+                    with suppress(OSError):
+                        path.unlink()
+
+    def _append(self, records_path: Path, ids_path: Path, photos: Iterable[dict]):
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        with records_path.open("ab") as records, ids_path.open("ab") as ids:
+            offset = ids.tell()
+            for photo in photos:
+                photo_id = photo["id"].encode()
+                width, height = self.client.dimensions(photo)
+                created = self.client.created_time(photo)
+                records.write(
+                    RECORD.pack(
+                        offset,
+                        len(photo_id),
+                        width,
+                        height,
+                        0,
+                        int(created.timestamp()) if created else 0,
+                        0,
+                    )
+                )
+                ids.write(photo_id)
+                offset += len(photo_id)
+
+    def merge(self, photos: Sequence[dict]):
+        """
+        Add new photos.
+        During a full sync photos go to new files, replacing the current ones when it ends.
+        Otherwise the mapping is scanned for the batch's IDs, which is cheap for the small
+        batches of an incremental sync.
+        """
+        if self._rewriting:
+            self._append(*self._paths(self.generation + 1), photos)
+            return
+        known = {photo["id"] for photo in photos}
+        known.intersection_update(
+            self.photos.photo_id(record) for _, record in self.photos.records()
+        )
+        added = [photo for photo in photos if photo["id"] not in known]
+        self._append(self.records_path, self.ids_path, added)
+        if self._positions is not None:
+            for position, photo in enumerate(added, len(self.photos)):
+                self._positions[photo["id"]] = position
+        self.photos.remap()
+        self._version += 1
+
+    def begin_full_sync(self, resume: bool = False):
+        """
+        Write merged photos to the next generation's files until ``end_full_sync``
+        :param resume: whether an interrupted full sync is resumed,
+            appending to the new files it wrote up to its checkpoint.
+            Pages merged after the checkpoint are cut off, as they are crawled again.
+        """
+        written = (self.checkpoint or {}).get("written") if resume else None
+        for path, length in zip(self._paths(self.generation + 1), written or (None, None)):
+            with suppress(FileNotFoundError):
+                if not resume:
+                    path.unlink()
+                elif length is not None:
+                    os.truncate(path, length)
+        self._rewriting = True
+
+    def end_full_sync(self):
+        """
+        Switch to the files written since ``begin_full_sync``,
+        carrying over computed perceptual hashes.
+        The current files may still be mapped by selections in use,
+        and are deleted when the state is saved.
+        """
+        self._rewriting = False
+        hashes: Dict[str, int] = {
+            self.photos.photo_id(record): record[6]
+            for _, record in self.photos.records()
+            if record[4] & HAS_HASH
+        }
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        for path in self._paths(self.generation + 1):
+            path.touch()
+        self._use(self.generation + 1)
+        for position, record in self.photos.records():
+            value = hashes.get(self.photos.photo_id(record))
+            if value is not None:
+                self.photos.set_hash(position, value)
+        self._positions = None
+        self._version += 1
+
+    def find(self, photo_id: str) -> Optional[dict]:
+        """
+        Return metadata of the photo with ``photo_id``, if it is in the index
+        """
+        if self._positions is None:
+            self._positions = {
+                self.photos.photo_id(record): position
+                for position, record in self.photos.records()
+            }
+        position = self._positions.get(photo_id)
+        return None if position is None else self.photos[position]
+
+    def photo_hash(self, photo: dict) -> Optional[str]:
+        """
+        Return perceptual hash of photo, if computed
+        """
+        record = self.photos.record(photo["position"])
+        return f"{record[6]:016x}" if record[4] & HAS_HASH else None
+
+    def set_photo_hash(self, photo: dict, value: str):
+        """
+        Store perceptual hash of photo
+        """
+        self.photos.set_hash(photo["position"], int(value, 16))
+        self._version += 1
+
+    def unhashed(self) -> Iterator[dict]:
+        """
+        Iterate over photos without a perceptual hash
+        """
+        for position in np.flatnonzero(~(self.photos.columns["flags"] & HAS_HASH).astype(bool)):
+            yield self.photos[int(position)]
+
+    def select(
+        self, photo_filter: PhotoFilter, exclude: np.ndarray = NO_HASHES
+    ) -> IndexedView:
+        """
+        Return photos matching ``photo_filter``
+        :param photo_filter: predicates to match
+        :param exclude: perceptual hashes of photos to leave out
+        """
+        columns = self.photos.columns
+        indices = self._filter_cache.select(columns, self._version, photo_filter, exclude)
+        return IndexedView(self.photos, indices, columns)
+
+
+def _size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
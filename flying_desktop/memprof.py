@@ -0,0 +1,138 @@
+"""
+On-demand memory profiling.
+Once started, ``tracemalloc`` records allocation sites. Each request for a snapshot,
+by SIGUSR1 or by Ctrl+Alt+M in the main window, writes to the log directory
+the top allocation sites, their growth since the previous snapshot,
+and counts of photo metadata, downloaded photos and Tk widgets.
+Profiling starts at launch when ``memprof/enabled`` is set, otherwise on the first request.
+"""
+import gc
+import logging
+import signal
+import tkinter as tk
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Callable, Iterable
+
+from appdirs import user_log_dir
+
+from .providers import Photo
+from .settings import SETTINGS
+from .utils import executors, error_handler, DISK_POOL
+
+SNAPSHOT_DIR = Path(user_log_dir(), "memprof")
+# defaults of the ``memprof`` settings:
+# stack frames recorded per allocation
+FRAMES = 10
+# allocation sites listed per report
+TOP = 25
+KEY_BINDING = "<Control-Alt-m>"
+# milliseconds between returns to Python while Tk waits for events,
+# letting signal handlers run
+SIGNAL_POLL = 250
+log = logging.getLogger(__name__)
+
+_previous: Optional[tracemalloc.Snapshot] = None
+_taken = 0
+
+
+def widget_count(widget: tk.Misc) -> int:
+    return 1 + sum(widget_count(child) for child in widget.winfo_children())
+
+
+def object_counts(root: tk.Misc, buckets: Iterable) -> Dict[str, int]:
+    """
+    Count objects suspected of piling up. Must be called from Tk's thread.
+    :param root: main window
+    :param buckets: filled buckets, whose photo metadata is counted
+    """
+    counts = {
+        f"photo metadata ({bucket.name})": len(bucket._photos) for bucket in buckets
+    }
+    counts["Photo instances"] = sum(isinstance(obj, Photo) for obj in gc.get_objects())
+    counts["Tk widgets"] = widget_count(root)
+    return counts
+
+
+def start():
+    """
+    Start recording allocations, if not recording yet
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(SETTINGS.get("memprof/frames", FRAMES))
+        log.info("memory profiling started")
+
+
+def write_snapshot(counts: Dict[str, int]) -> Path:
+    """
+    Take a snapshot and write the report to the snapshot directory
+    :param counts: object counts to include in the report
+    :return: path of the report
+    """
+    global _previous, _taken
+    top = SETTINGS.get("memprof/top", TOP)
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        )
+    )
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [
+        f"traced memory: {current / 2 ** 20:.1f} MB, peak {peak / 2 ** 20:.1f} MB",
+        "",
+        "object counts:",
+        *(f"  {name}: {count}" for name, count in counts.items()),
+        "",
+        f"top {top} allocation sites:",
+        *(f"  {stat}" for stat in snapshot.statistics("lineno")[:top]),
+    ]
+    if _previous is not None:
+        lines += [
+            "",
+            f"top {top} changes since the previous snapshot:",
+            *(f"  {stat}" for stat in snapshot.compare_to(_previous, "lineno")[:top]),
+        ]
+    _previous = snapshot
+    _taken += 1
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    path = SNAPSHOT_DIR / f"memprof-{datetime.now():%Y%m%d-%H%M%S}-{_taken}.txt"
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    log.info("memory snapshot written to %s", path)
+    return path
+
+
+def request_snapshot(root: tk.Misc, buckets: Callable[[], Iterable]):
+    """
+    Start profiling, or write a snapshot if already profiling.
+    Must be called from Tk's thread; the snapshot is written from the disk pool.
+    """
+    if not tracemalloc.is_tracing():
+        start()
+        log.info("request again for a memory snapshot")
+        return
+    future = executors[DISK_POOL].submit(write_snapshot, object_counts(root, buckets()))
+    future.add_done_callback(error_handler)
+
+
+def memprof_setup(root: tk.Tk, buckets: Callable[[], Iterable]):
+    """
+    Let snapshots be requested by SIGUSR1 and by a key binding of the main window
+    :param root: main window
+    :param buckets: returns filled buckets, whose photo metadata is counted
+    """
+    if SETTINGS.get("memprof/enabled", False):
+        start()
+    root.bind_all(KEY_BINDING, lambda _: request_snapshot(root, buckets))
+    if hasattr(signal, "SIGUSR1"):
+        # Python runs the handler in the main thread, which is Tk's
+        signal.signal(
+            signal.SIGUSR1, lambda *_: root.after(0, request_snapshot, root, buckets)
+        )
+        _poll_signals(root)
+
+
+def _poll_signals(root: tk.Misc):
+    # handlers only run between bytecodes, and an idle Tk stays in Tcl
+    root.after(SIGNAL_POLL, _poll_signals, root)
@@ -0,0 +1,246 @@
+"""
+Mirror of the photos matching the current filters into a folder, made with
+``flydesk mirror DIR``, for seeding photo caches of machines without access to the accounts.
+Photos are downloaded a few at a time per provider and recorded in a manifest once
+written. Photos whose file is present with the recorded size are skipped,
+so an interrupted mirror resumes where it stopped. A provider's downloads stop
+once its circuit opens.
+"""
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import suppress
+from pathlib import Path
+from typing import Dict, Tuple, Iterator, Sequence
+
+import attr
+
+from .budget import BudgetExhausted
+from .buckets import FilledBucket, select_photos
+from .filters import PhotoFilter
+from .health import CircuitOpen
+from .photo_cache import PHOTO_CACHE, make_dirs
+from .registry import fill_enabled
+from .settings import SETTINGS
+from .utils import delegate, save_photo, DISK_POOL
+
+MANIFEST = "mirror.jsonl"
+# defaults of the ``mirror`` settings:
+# downloads at once, across providers
+CONCURRENCY = 8
+# downloads at once from a single provider
+PER_PROVIDER = 4
+# seconds between progress reports
+REPORT_INTERVAL = 10
+log = logging.getLogger(__name__)
+
+
+def file_name(name: str) -> str:
+    """
+    Return ``name`` with characters unsafe in file names replaced
+    """
+    return re.sub(r"[^\w.-]", "_", name)
+
+
+@attr.s(auto_attribs=True)
+class Progress:
+    """
+    Counts of mirrored photos
+    :param total: photos to mirror
+    """
+
+    total: int
+    downloaded: int = 0
+    present: int = 0
+    failed: int = 0
+    size: int = 0
+    started: float = attr.ib(factory=time.monotonic)
+
+    def __str__(self):
+        elapsed = max(time.monotonic() - self.started, 1e-3)
+        megabytes = self.size / 2 ** 20
+        return (
+            f"{self.downloaded + self.present + self.failed}/{self.total} photos "
+            f"({self.downloaded} downloaded, {self.present} present, {self.failed} failed), "
+            f"{megabytes:.1f} MB in {elapsed:.0f}s, "
+            f"{megabytes / elapsed:.2f} MB/s, {self.downloaded / elapsed:.2f} photos/s"
+        )
+
+
+class Manifest:
+    """
+    Photos written to the mirror, appended as JSON lines once their file is complete
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.path = directory / MANIFEST
+        self.entries: Dict[Tuple[str, str], dict] = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        with suppress(FileNotFoundError), self.path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of a mirror interrupted while writing it
+                    continue
+                self.entries[entry["bucket"], entry["id"]] = entry
+
+    def present(self, bucket: str, photo_id: str) -> bool:
+        """
+        Whether photo was mirrored and its file still has the recorded size
+        """
+        entry = self.entries.get((bucket, photo_id))
+        if entry is None:
+            return False
+        try:
+            return (self.directory / entry["file"]).stat().st_size == entry["size"]
+        except FileNotFoundError:
+            return False
+
+    def add(self, bucket: str, photo_id: str, path: Path):
+        """
+        Record mirrored photo
+        """
+        entry = {
+            "bucket": bucket,
+            "id": photo_id,
+            "file": path.relative_to(self.directory).as_posix(),
+            "size": path.stat().st_size,
+        }
+        with self._lock, self.path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.entries[bucket, photo_id] = entry
+
+
+class Mirror:
+    """
+    Downloads of photos of several buckets into a folder, with a subfolder per bucket
+    """
+
+    def __init__(self, directory: Path, buckets: Sequence[FilledBucket]):
+        """
+        :param directory: target folder
+        :param buckets: buckets whose matching photos are mirrored
+        """
+        self.directory = directory
+        self.buckets = buckets
+        self.manifest = Manifest(directory)
+        self.progress = Progress(total=0)
+
+    async def run(self, photo_filter: PhotoFilter) -> Progress:
+        """
+        Mirror photos matching ``photo_filter``. Photos with the same perceptual hash
+        are mirrored once. A spent data budget stops the mirror.
+        """
+        await delegate(make_dirs, self.directory, pool=DISK_POOL)
+        await delegate(self.manifest.load, pool=DISK_POOL)
+        selection = select_photos(self.buckets, photo_filter, prefer_cached=False)
+        self.progress = Progress(total=len(selection))
+        limit = asyncio.Semaphore(SETTINGS.get("mirror/concurrency", CONCURRENCY))
+        workers = []
+        for bucket, photos in selection.parts:
+            # workers of a bucket share an iterator over its photos
+            remaining = iter(photos)
+            workers += [
+                asyncio.ensure_future(self.worker(bucket, remaining, limit))
+                for _ in range(SETTINGS.get("mirror/per_provider", PER_PROVIDER))
+            ]
+        reporter = asyncio.ensure_future(self.report())
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + [reporter]:
+                task.cancel()
+        return self.progress
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            log.info("mirrored %s", self.progress)
+
+    async def worker(
+        self, bucket: FilledBucket, photos: Iterator[dict], limit: asyncio.Semaphore
+    ):
+        for meta_photo in photos:
+            try:
+                await self.mirror_photo(bucket, meta_photo, limit)
+            except CircuitOpen as e:
+                # taking the photos left stops the bucket's other workers too
+                skipped = 1 + sum(1 for _ in photos)
+                log.warning("not mirroring %d photos: %s", skipped, e)
+                self.progress.failed += skipped
+                return
+
+    async def mirror_photo(
+        self, bucket: FilledBucket, meta_photo: dict, limit: asyncio.Semaphore
+    ):
+        """
+        Download photo into the bucket's subfolder, unless it is present.
+        Cached photos are copied from the photo cache.
+        :raises CircuitOpen: if the bucket's provider is failing
+        """
+        photo_id = meta_photo["id"]
+        if await delegate(self.manifest.present, bucket.name, photo_id, pool=DISK_POOL):
+            self.progress.present += 1
+            return
+        async with limit:
+            try:
+                photo = await PHOTO_CACHE.get(bucket.name, photo_id)
+                if photo is None:
+                    photo = await bucket.download_photo(meta_photo)
+                directory = self.directory / file_name(bucket.name)
+                await delegate(make_dirs, directory, pool=DISK_POOL)
+                path = await save_photo(photo, directory, file_name(photo_id))
+                await delegate(self.manifest.add, bucket.name, photo_id, path, pool=DISK_POOL)
+            except (asyncio.CancelledError, BudgetExhausted, CircuitOpen):
+                raise
+            except Exception as e:
+                log.warning("cannot mirror %s photo %s: %r", bucket.name, photo_id, e)
+                self.progress.failed += 1
+                return
+        self.progress.downloaded += 1
+        self.progress.size += len(photo.data)
+
+
+async def mirror(directory: Path) -> Progress:
+    """
+    Log in to the enabled providers, sync their metadata, hash their photos
+    for skipping duplicates, and mirror matching photos
+    """
+    buckets = await fill_enabled()
+    try:
+        for bucket in buckets:
+            async for _ in bucket.download():
+                pass
+            log.info("%s: %d photos", bucket.name, len(bucket.photos))
+            await bucket.hash_photos()
+        mirror_ = Mirror(directory, buckets)
+        try:
+            return await mirror_.run(PhotoFilter.from_settings())
+        finally:
+            print(f"mirrored {mirror_.progress}")
+    finally:
+        for bucket in buckets:
+            bucket.client.close()
+
+
+async def run_mirror(directory: Path) -> int:
+    """
+    Mirror photos matching the current filters into ``directory``, until done or cancelled
+    :return: exit status, non-zero if some photos could not be mirrored
+    """
+    try:
+        progress = await mirror(directory)
+    except asyncio.CancelledError:
+        print("interrupted, mirror again to resume")
+        return 1
+    except BudgetExhausted as e:
+        print(f"data budget spent: {e}")
+        return 1
+    return 1 if progress.failed else 0
@@ -0,0 +1,178 @@
+"""
+Downloaded photos kept on disk, so wallpapers can rotate
+while providers are slow or unreachable
+"""
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Tuple, Optional, Set, List
+
+import aiofiles
+
+from .providers import Photo
+from .settings import CACHE_DIR, SETTINGS
+from .utils import delegate, DISK_POOL
+
+PHOTOS_DIR = CACHE_DIR / "photos"
+# default cache size limit, overridable by ``cache/max_mb``
+DEFAULT_MAX_MB = 500
+log = logging.getLogger(__name__)
+# bucket name and digest of photo ID
+Key = Tuple[str, str]
+
+
+class PhotoCache:
+    """
+    Photos stored under a directory per bucket.
+    Least recently used photos are evicted once the size limit is exceeded.
+    """
+
+    def __init__(self, directory: Path = PHOTOS_DIR, max_bytes: int = None):
+        """
+        :param directory: cache directory
+        :param max_bytes: cache size limit
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes or SETTINGS.get("cache/max_mb", DEFAULT_MAX_MB) << 20
+        self._entries: Dict[Key, Path] = {}
+        self.size = 0
+        # incremented whenever photos are added or removed
+        self.version = 0
+        self._evicting = False
+        self.load()
+
+    @staticmethod
+    def digest(photo_id: str) -> str:
+        """
+        Return the name of a photo's file, without suffix
+        """
+        return hashlib.sha1(photo_id.encode()).hexdigest()
+
+    @classmethod
+    def _key(cls, bucket: str, photo_id: str) -> Key:
+        return bucket.lower(), cls.digest(photo_id)
+
+    def load(self):
+        """
+        Scan cache directory for photos
+        """
+        self._entries.clear()
+        self.size = 0
+        for path in self.directory.glob("*/*.*"):
+            if path.suffix == ".tmp":
+                continue
+            self._entries[path.parent.name, path.stem] = path
+            self.size += path.stat().st_size
+        self.version += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def contains(self, bucket: str, photo_id: str) -> bool:
+        """
+        Whether photo is cached
+        """
+        return self._key(bucket, photo_id) in self._entries
+
+    def digests(self, bucket: str) -> Set[str]:
+        """
+        Return digests of the IDs of the cached photos of ``bucket``
+        """
+        bucket = bucket.lower()
+        return {digest for name, digest in self._entries if name == bucket}
+
+    async def get(self, bucket: str, photo_id: str) -> Optional[Photo]:
+        """
+        Return cached photo, if it is cached
+        """
+        path = self._entries.get(self._key(bucket, photo_id))
+        if path is None:
+            return None
+        try:
+            async with aiofiles.open(path, "rb") as f:
+                data = await f.read()
+            await delegate(os.utime, path, pool=DISK_POOL)
+        except FileNotFoundError:
+            self._entries.pop(self._key(bucket, photo_id), None)
+            self.version += 1
+            return None
+        return Photo(path.suffix[1:], data)
+
+    async def put(self, bucket: str, photo_id: str, photo: Photo):
+        """
+        Store photo, evicting least recently used photos if needed
+        """
+        key = self._key(bucket, photo_id)
+        if key in self._entries:
+            return
+        path = self.directory.joinpath(*key).with_suffix(f".{photo.suffix}")
+        temp = path.with_suffix(".tmp")
+        await delegate(make_dirs, path.parent, pool=DISK_POOL)
+        async with aiofiles.open(temp, "wb") as f:
+            await f.write(photo.data)
+        await delegate(os.replace, temp, path, pool=DISK_POOL)
+        self._entries[key] = path
+        self.size += len(photo.data)
+        self.version += 1
+        if not self._evicting:
+            await self._evict_excess()
+
+    async def _evict_excess(self):
+        """
+        Evict least recently used photos while the size limit is exceeded,
+        including by photos added meanwhile
+        """
+        self._evicting = True
+        try:
+            while self.size > self.max_bytes:
+                evicted = await delegate(
+                    _evict, list(self._entries.items()), self.size - self.max_bytes,
+                    pool=DISK_POOL,
+                )
+                if not evicted:
+                    return
+                # entries are only changed on the event loop's thread
+                for key, size in evicted:
+                    if self._entries.pop(key, None) is not None:
+                        self.size -= size
+                        self.version += 1
+        finally:
+            self._evicting = False
+
+
+def make_dirs(path: Path):
+    """
+    Create directory and its parents, if missing
+    """
+    path.mkdir(parents=True, exist_ok=True)
+
+
+def _evict(entries: List[Tuple[Key, Path]], excess: int) -> List[Tuple[Key, int]]:
+    """
+    Delete least recently used photos until ``excess`` bytes are freed
+    :param entries: cached photos' keys and paths
+    :return: keys and sizes of deleted photos, including ones already gone
+    """
+    evicted = []
+    for key, path in sorted(entries, key=lambda item: _mtime(item[1])):
+        if excess <= 0:
+            break
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            size = 0
+        excess -= size
+        evicted.append((key, size))
+    return evicted
+
+
+def _mtime(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+PHOTO_CACHE = PhotoCache()
@@ -3,9 +3,10 @@ Providers are the application's interface to different picture sources
 """
 import abc
 import json
+from datetime import datetime, timezone
 from http import HTTPStatus
 from pathlib import Path
-from typing import AsyncIterator, Sequence, Iterable
+from typing import AsyncIterator, Sequence, Optional, Tuple, Iterable
 
 import aiohttp
 import attr
@@ -13,6 +14,8 @@ from oauth2client import client, tools
 from oauth2client.client import Credentials
 
 from flying_desktop.settings import SETTINGS
+from flying_desktop.tracing import traced
+from .cassette import active_cassette
 
 
 class AbstractClassProperty:
@@ -33,6 +36,120 @@ class Photo:
     data: bytes = attr.ib(repr=False)
 
 
+class MetaPage(list):
+    """
+    Page of photo metadata, with the cursor of the following page,
+    for resuming an interrupted crawl after it
+    """
+
+    def __init__(self, photos: Iterable[dict] = (), cursor: Optional[str] = None):
+        super().__init__(photos)
+        self.cursor = cursor
+
+
+def parse_setting_time(value: Optional[str]) -> Optional[datetime]:
+    """
+    Parse a time stored in the settings in ISO format, if set
+    """
+    return datetime.fromisoformat(value) if value else None
+
+
+# content categories crawled unless ``crawl/categories`` is set,
+# the ones the application crawled before it had settings for them
+DEFAULT_CATEGORIES = ("PEOPLE",)
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class CrawlQuery:
+    """
+    Restrictions on the photos crawled, for providers to push into their API queries.
+    Providers ignore restrictions their API cannot express.
+    :param categories: content categories to include, all categories if empty
+    :param excluded_categories: content categories to leave out
+    :param media_types: kinds of media to include
+    :param date_from: earliest creation time
+    :param date_to: latest creation time
+    """
+
+    categories: Tuple[str, ...] = DEFAULT_CATEGORIES
+    excluded_categories: Tuple[str, ...] = ()
+    media_types: Tuple[str, ...] = ("PHOTO",)
+    date_from: Optional[datetime] = None
+    date_to: Optional[datetime] = None
+
+    @classmethod
+    def from_settings(cls) -> "CrawlQuery":
+        """
+        Build query from the ``crawl`` settings and the date range of the ``filter`` settings
+        """
+        return cls(
+            categories=tuple(SETTINGS.get("crawl/categories", DEFAULT_CATEGORIES)),
+            excluded_categories=tuple(SETTINGS.get("crawl/excluded_categories", [])),
+            media_types=tuple(SETTINGS.get("crawl/media_types", ["PHOTO"])),
+            date_from=parse_setting_time(SETTINGS.get("filter/date_from")),
+            date_to=parse_setting_time(SETTINGS.get("filter/date_to")),
+        )
+
+    def start(self, since: Optional[datetime] = None) -> Optional[datetime]:
+        """
+        Return earliest creation time to crawl
+        :param since: time of the last sync, for incremental syncs
+        """
+        times = [value for value in (since, self.date_from) if value]
+        return max(times, key=datetime.timestamp) if times else None
+
+    def dump(self) -> dict:
+        """
+        Return query as JSON-serializable data, for detecting changes between runs
+        """
+        return {
+            key: value.isoformat() if isinstance(value, datetime) else list(value)
+            for key, value in attr.asdict(self).items()
+            if value is not None
+        }
+
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def http_session() -> aiohttp.ClientSession:
+    """
+    Return the HTTP session shared by all photo downloads, creating it on first use.
+    Must be called from the event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=SETTINGS.get("http/connections", 8))
+        )
+    return _session
+
+
+async def close_http_session():
+    """
+    Close the shared HTTP session and its connections
+    """
+    if _session is not None:
+        await _session.close()
+
+
+async def _fetch(url: str) -> Tuple[int, str, bytes]:
+    """
+    Download from ``url`` through the shared HTTP session
+    :return: response status, content type and content
+    """
+    async with http_session().get(url) as response:
+        return response.status, response.headers["Content-Type"], await response.read()
+
+
+def parse_timestamp(value: str) -> datetime:
+    """
+    Parse an API timestamp such as ``2019-01-01T12:00:00Z`` or ``2019-01-01T12:00:00+0000``,
+    ignoring fractions of seconds
+    """
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+
+
 class SettingsStorage(client.Storage):
     """
     Qt credentials storage for oauth2 tokens
@@ -59,43 +176,92 @@ class PhotoProvider(metaclass=abc.ABCMeta):
     """
     @abc.abstractmethod
     def __init__(self, credentials: client.OAuth2Credentials):
+        self.credentials = credentials
+
+    @abc.abstractmethod
+    def refresh_credentials(self):
+        """
+        Renew the access token and persist the new credentials.
+        Blocks, so it is run in an executor.
+        """
         pass
 
     @abc.abstractmethod
-    async def download_meta_photos(self) -> AsyncIterator[Sequence[dict]]:
+    async def download_meta_photos(
+        self,
+        since: Optional[datetime] = None,
+        query: CrawlQuery = CrawlQuery(),
+        cursor: Optional[str] = None,
+    ) -> AsyncIterator[Sequence[dict]]:
         """
-        Download photo metadata
+        Download photo metadata.
+        Providers which can resume a crawl yield ``MetaPage`` batches.
+        :param since: only download photos added after this time
+        :param query: restrictions on the photos downloaded
+        :param cursor: cursor of a ``MetaPage`` yielded by an interrupted crawl
+            with the same arguments, to resume from the following page.
+            ``CursorExpired`` is raised if the API no longer accepts it.
         """
         pass
 
     @abc.abstractmethod
-    async def download_photo(self, meta_photo: dict) -> Photo:
+    async def download_photo(
+        self, meta_photo: dict, max_size: Optional[Tuple[int, int]] = None
+    ) -> Photo:
         """
         Retrieve photo data from photo metadata
+        :param meta_photo: photo metadata
+        :param max_size: width and height of the smallest rendition that is large enough,
+            the original photo if ``None``
+        """
+        pass
+
+    async def resolve_thumbnails(self, meta_photos: Sequence[dict]) -> Sequence[dict]:
+        """
+        Return metadata to pass to ``download_thumbnail`` for each photo, in the same order.
+        Providers which look up thumbnails' addresses before downloading them
+        resolve a batch of photos with few requests.
+        """
+        return meta_photos
+
+    async def download_thumbnail(self, meta_photo: dict) -> Photo:
+        """
+        Retrieve a small rendition of the photo, for perceptual hashing.
+        Providers without small renditions return the photo itself.
+        """
+        return await self.download_photo(meta_photo)
+
+    @staticmethod
+    @abc.abstractmethod
+    def dimensions(meta_photo: dict) -> Tuple[int, int]:
+        """
+        Return width and height of photo
         """
         pass
 
     @staticmethod
     @abc.abstractmethod
-    def filter_meta_photos(photos: Iterable[dict], min_width: int) -> Sequence[dict]:
+    def created_time(meta_photo: dict) -> Optional[datetime]:
         """
-        Filter meta photos by width
-        :param photos: list of meta photos
-        :param min_width: return all photos with width more than or equal to this value
-        :return: list of matching photos
+        Return time the photo was created, if known
         """
         pass
 
     @staticmethod
+    @traced("download")
     async def _download_from_url(url: str) -> Photo:
         """
         Download photo at ``url``, parsing its content type
         """
-        async with aiohttp.ClientSession() as session, session.get(url) as response:
-            general_type, suffix = response.headers["Content-Type"].split("/")
-            if response.status != HTTPStatus.OK or general_type != "image":
-                raise BadResponse(response)
-            return Photo(suffix, await response.read())
+        cassette = active_cassette()
+        if cassette is None:
+            status, content_type, data = await _fetch(url)
+        else:
+            status, content_type, data = await cassette.fetch(url, _fetch)
+        general_type, _, suffix = content_type.partition("/")
+        if status != HTTPStatus.OK or general_type != "image":
+            raise BadResponse(f"{status} {content_type} from {url}")
+        return Photo(suffix, data)
 
     @classmethod
     def clear(cls):
@@ -104,9 +270,17 @@ class PhotoProvider(metaclass=abc.ABCMeta):
         """
         cls.storage.delete()
 
+    def close(self):
+        """
+        Stop background work of the provider, once it is no longer used
+        """
+        self.refresher.stop()
+
     storage: SettingsStorage = AbstractClassProperty()
     client_secrets: Path = AbstractClassProperty()
     scope: str = AbstractClassProperty()
+    # whether thumbnails are downloaded to detect duplicate photos
+    hashable = True
 
     @classmethod
     def authorization_code_grant(cls, pkce: bool = True) -> client.OAuth2Credentials:
@@ -137,3 +311,9 @@ class BadResponse(Exception):
     An unexpected response or one indicating an error
     """
     response = attr.ib()
+
+
+class CursorExpired(Exception):
+    """
+    A crawl could not be resumed, as its cursor is no longer valid
+    """
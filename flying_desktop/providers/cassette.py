@@ -0,0 +1,381 @@
+"""
+Recording and replay of providers' HTTP traffic.
+A cassette holds API responses and photo downloads of a recorded session,
+with access tokens and client secrets scrubbed, as gzipped JSON lines.
+Replayed, it lets the real providers crawl and download with no network or account,
+with the recorded latency scaled by ``time_scale``.
+
+The cassette in use covers the Google API transport, the Facebook Graph API session
+and photo downloads. The application records to ``cassette/record``, or replays
+``cassette/replay`` with ``cassette/time_scale``, when set. Workers of isolated
+providers use their own file, named after the provider, e.g. ``session-GooglePhotos.gz``.
+
+Record a session with a real account:
+    python -m flying_desktop.providers.cassette {google,facebook} FILE [--pages N] [--photos N]
+"""
+import argparse
+import asyncio
+import atexit
+import base64
+import gzip
+import json
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Optional, Dict, Deque, Tuple, Callable, Awaitable, List, TYPE_CHECKING
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from flying_desktop.settings import SETTINGS
+
+if TYPE_CHECKING:
+    import requests
+
+# query parameters and response fields which are never recorded
+SECRET_PARAMS = ("access_token", "appsecret_proof", "client_secret", "refresh_token")
+SECRET = re.compile(rf"((?:{'|'.join(SECRET_PARAMS)})=)[^&\"'\s]+")
+SECRET_FIELD = re.compile(rf'("(?:{"|".join(SECRET_PARAMS)})"\s*:\s*")[^"]*')
+SCRUBBED = "scrubbed"
+# token exchanges, whose responses are credentials
+SKIPPED_PATHS = ("/oauth/access_token", "/token")
+
+Download = Tuple[int, str, bytes]
+
+
+class NotRecorded(Exception):
+    """
+    A request was replayed which the cassette doesn't hold
+    """
+
+
+def scrub_url(url: str) -> str:
+    """
+    Remove secrets from ``url``, and sort its query so it matches regardless of order
+    """
+    parts = urlsplit(url)
+    query = sorted(
+        (key, SCRUBBED if key in SECRET_PARAMS else value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+    )
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def scrub(text: str) -> str:
+    """
+    Remove secrets from form encoded or JSON ``text``
+    """
+    return SECRET_FIELD.sub(rf"\1{SCRUBBED}", SECRET.sub(rf"\1{SCRUBBED}", text))
+
+
+def _text(value) -> Optional[str]:
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value
+
+
+class Cassette:
+    """
+    Recorded HTTP exchanges.
+    Replayed exchanges are matched by method, URL and body; the same request
+    made several times gets its recorded responses in order, then the last one again.
+    """
+
+    def __init__(self, path: Path, recording: bool = False, time_scale: float = 1.0):
+        """
+        :param path: cassette file
+        :param recording: whether to record traffic, rather than replay the file
+        :param time_scale: factor of recorded latencies when replaying, 0 for none
+        """
+        self.path = Path(path)
+        self.recording = recording
+        self.time_scale = time_scale
+        self.interactions: List[dict] = []
+        self._lock = threading.Lock()
+        self._replays: Dict[tuple, Deque[dict]] = defaultdict(deque)
+        if not recording:
+            self.load()
+
+    @staticmethod
+    def _key(method: str, url: str, body: Optional[str]) -> tuple:
+        return method.upper(), scrub_url(url), scrub(body or "")
+
+    def load(self):
+        """
+        Read cassette file
+        """
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            self.interactions = [json.loads(line) for line in f]
+        self._replays.clear()
+        for interaction in self.interactions:
+            key = self._key(interaction["method"], interaction["url"], interaction["body"])
+            self._replays[key].append(interaction)
+
+    def save(self):
+        """
+        Write recorded exchanges to the cassette file.
+        Nothing is written if nothing was recorded, so a session which made
+        no requests doesn't overwrite an earlier recording.
+        """
+        if not self.interactions:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, gzip.open(self.path, "wt", encoding="utf-8") as f:
+            for interaction in self.interactions:
+                f.write(json.dumps(interaction) + "\n")
+
+    def record(
+        self,
+        method: str,
+        url: str,
+        body,
+        status: int,
+        content_type: str,
+        content: bytes,
+        elapsed: float,
+    ):
+        """
+        Record an exchange, unless it exchanges credentials
+        """
+        if urlsplit(url).path.endswith(SKIPPED_PATHS):
+            return
+        method, url, body = self._key(method, url, _text(body))
+        try:
+            text, encoding = scrub(content.decode("utf-8")), "utf-8"
+        except UnicodeDecodeError:
+            text, encoding = base64.b64encode(content).decode("ascii"), "base64"
+        with self._lock:
+            self.interactions.append(
+                {
+                    "method": method,
+                    "url": url,
+                    "body": body or None,
+                    "status": status,
+                    "content_type": content_type,
+                    "content": text,
+                    "encoding": encoding,
+                    "elapsed": round(elapsed, 4),
+                }
+            )
+
+    def find(self, method: str, url: str, body) -> Tuple[dict, bytes]:
+        """
+        Return recorded exchange matching a request, and its response content
+        """
+        key = self._key(method, url, _text(body))
+        with self._lock:
+            replays = self._replays.get(key)
+            if not replays:
+                raise NotRecorded(f"{key[0]} {key[1]}")
+            interaction = replays.popleft() if len(replays) > 1 else replays[0]
+        if interaction["encoding"] == "base64":
+            content = base64.b64decode(interaction["content"])
+        else:
+            content = interaction["content"].encode("utf-8")
+        return interaction, content
+
+    def play(self, method: str, url: str, body) -> Tuple[dict, bytes]:
+        """
+        Replay a request from a thread, waiting for its scaled latency
+        """
+        interaction, content = self.find(method, url, body)
+        time.sleep(interaction["elapsed"] * self.time_scale)
+        return interaction, content
+
+    async def fetch(self, url: str, fetch: Callable[[str], Awaitable[Download]]) -> Download:
+        """
+        Download from ``url`` through the cassette
+        :param url: URL to download
+        :param fetch: coroutine function downloading for real,
+            returning status, content type and content
+        """
+        if self.recording:
+            started = time.perf_counter()
+            status, content_type, content = await fetch(url)
+            self.record(
+                "GET", url, None, status, content_type, content, time.perf_counter() - started
+            )
+            return status, content_type, content
+        interaction, content = self.find("GET", url, None)
+        await asyncio.sleep(interaction["elapsed"] * self.time_scale)
+        return interaction["status"], interaction["content_type"], content
+
+    def session(self) -> "requests.Session":
+        """
+        Return a ``requests`` session going through the cassette
+        """
+        # imported here so setting up a cassette, or none, doesn't pay for requests
+        import requests
+
+        session = requests.Session()
+        adapter = CassetteAdapter(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+class CassetteHttp:
+    """
+    Stand-in for ``httplib2.Http`` going through a cassette
+    """
+
+    def __init__(self, cassette: Cassette, http=None):
+        """
+        :param cassette: cassette to record to or replay from
+        :param http: transport making requests while recording
+        """
+        self.cassette = cassette
+        self.http = http
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        """
+        Same as ``httplib2.Http.request``
+        """
+        if self.cassette.recording:
+            started = time.perf_counter()
+            response, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+            self.cassette.record(
+                method,
+                uri,
+                body,
+                response.status,
+                response.get("content-type", ""),
+                content,
+                time.perf_counter() - started,
+            )
+            return response, content
+        from httplib2 import Response
+
+        interaction, content = self.cassette.play(method, uri, body)
+        response = Response(
+            {"status": interaction["status"], "content-type": interaction["content_type"]}
+        )
+        return response, content
+
+
+class CassetteAdapter:
+    """
+    ``requests`` transport adapter going through a cassette,
+    with the ``send`` and ``close`` of ``requests.adapters.BaseAdapter``
+    """
+
+    def __init__(self, cassette: Cassette):
+        from requests.adapters import HTTPAdapter
+
+        self.cassette = cassette
+        self.adapter = HTTPAdapter()
+
+    def send(self, request: "requests.PreparedRequest", **kwargs) -> "requests.Response":
+        import requests
+        from requests.structures import CaseInsensitiveDict
+
+        if self.cassette.recording:
+            started = time.perf_counter()
+            response = self.adapter.send(request, **kwargs)
+            self.cassette.record(
+                request.method,
+                request.url,
+                request.body,
+                response.status_code,
+                response.headers.get("content-type", ""),
+                response.content,
+                time.perf_counter() - started,
+            )
+            return response
+        interaction, content = self.cassette.play(request.method, request.url, request.body)
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response.headers = CaseInsensitiveDict({"content-type": interaction["content_type"]})
+        response._content = content
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+_cassette: Optional[Cassette] = None
+
+
+def use_cassette(cassette: Optional[Cassette]):
+    """
+    Send providers created from now on through ``cassette``, or through the network if ``None``
+    """
+    global _cassette
+    _cassette = cassette
+
+
+def active_cassette() -> Optional[Cassette]:
+    return _cassette
+
+
+def _worker_path(path: Path, worker: str) -> Path:
+    name, dot, suffixes = path.name.partition(".")
+    return path.with_name(f"{name}-{worker}{dot}{suffixes}")
+
+
+def cassette_setup(worker: Optional[str] = None) -> Optional[Cassette]:
+    """
+    Record to ``cassette/record`` or replay ``cassette/replay``, if either is set
+    :param worker: name of the worker process setting up, whose cassette file
+        is named after it so workers don't overwrite each other's recordings
+    :return: the cassette in use, if any
+    """
+    record, replay = SETTINGS.get("cassette/record"), SETTINGS.get("cassette/replay")
+    path = record or replay
+    if not path:
+        return None
+    path = Path(path) if worker is None else _worker_path(Path(path), worker)
+    if record:
+        cassette = Cassette(path, recording=True)
+        atexit.register(cassette.save)
+    else:
+        cassette = Cassette(path, time_scale=SETTINGS.get("cassette/time_scale", 1.0))
+    use_cassette(cassette)
+    return cassette
+
+
+async def record_session(provider_class, pages: int, photos: int):
+    """
+    Log in, crawl some metadata pages and download some photos and thumbnails
+    """
+    from flying_desktop.utils import delegate, AUTH_POOL
+
+    provider = await delegate(provider_class.from_code_grant, pool=AUTH_POOL)
+    meta_photos = []
+    async for batch in provider.download_meta_photos():
+        meta_photos.extend(batch)
+        pages -= 1
+        if not pages:
+            break
+    downloaded = meta_photos[:photos]
+    for meta_photo in downloaded:
+        await provider.download_photo(meta_photo)
+        await provider.download_thumbnail(meta_photo)
+    print(f"recorded {len(meta_photos)} photos' metadata, {len(downloaded)} downloads")
+
+
+def main():
+    # the providers import this module
+    from flying_desktop.providers.facebook import FacebookPhotos
+    from flying_desktop.providers.google import GooglePhotos
+    from flying_desktop.utils import loop
+
+    providers = {"google": GooglePhotos, "facebook": FacebookPhotos}
+    parser = argparse.ArgumentParser(description="Record a provider session to a cassette")
+    parser.add_argument("provider", choices=providers)
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--pages", type=int, default=5, help="metadata pages to crawl")
+    parser.add_argument("--photos", type=int, default=5, help="photos to download")
+    args = parser.parse_args()
+    cassette = Cassette(args.path, recording=True)
+    use_cassette(cassette)
+    loop.run_until_complete(record_session(providers[args.provider], args.pages, args.photos))
+    cassette.save()
+    print(f"{len(cassette.interactions)} exchanges saved to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,46 @@
 """
 Facebook photos provider
 """
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import AsyncIterator, Sequence, Iterable
+from typing import AsyncIterator, Sequence, Optional, Tuple, List, Set
 
 import attr
 import facebook
 from furl import Path as URLPath
 
+from flying_desktop.settings import SETTINGS
 from flying_desktop.utils import delegate
-from ...providers import Photo, SettingsStorage, PhotoProvider
+from ...providers import (
+    Photo,
+    SettingsStorage,
+    PhotoProvider,
+    CrawlQuery,
+    CursorExpired,
+    MetaPage,
+    parse_timestamp,
+)
+from ..cassette import active_cassette
+from ..refresh import TokenRefresher
 
 HERE = Path(__file__).parent
+log = logging.getLogger(__name__)
 
 ACCESS_TOKEN_EXPIRED = 190
+# error code of requests with an invalid parameter, such as an expired cursor
+INVALID_PARAMETER = 100
+
+
+def graph_api(access_token: str) -> facebook.GraphAPI:
+    """
+    Return Graph API client, going through the active cassette if any
+    """
+    cassette = active_cassette()
+    session = cassette.session() if cassette is not None else None
+    return facebook.GraphAPI(access_token=access_token, version=3.1, session=session)
 
 
 @attr.s(frozen=True)
@@ -34,10 +61,10 @@ class APIPath:
         try:
             return self.provider.api.request(str(self.path), args=kwargs)
         except facebook.GraphAPIError as ex:
-            print(ex.result)
+            log.warning("Graph API error: %s", ex.result)
             if not self.retries or ex.code != ACCESS_TOKEN_EXPIRED:
                 raise
-        self.provider.renew_token()
+        self.provider.refresher.refresh_blocking()
         # one retry
         return attr.evolve(self, retries=self.retries - 1)(**kwargs)
 
@@ -61,8 +88,9 @@ class FacebookPhotos(PhotoProvider):
     def __init__(self, credentials):
         # super().__init__(credentials)
         super().__init__(credentials)
-        self.api = facebook.GraphAPI(access_token=credentials.access_token, version=3.1)
+        self.api = graph_api(credentials.access_token)
         self.graph = APIPath(self)
+        self.refresher = TokenRefresher(self)
 
     def renew_token(self):
         """
@@ -71,37 +99,186 @@ class FacebookPhotos(PhotoProvider):
         self.storage.delete()
         credentials = self.authorization_code_grant()
         super().__init__(credentials)
-        self.api = facebook.GraphAPI(access_token=credentials.access_token, version=3.1)
+        self.api = graph_api(credentials.access_token)
+
+    def refresh_credentials(self):
+        """
+        Exchange the access token for a new long-lived one.
+        Falls back to logging in again if the token cannot be exchanged.
+        """
+        with self.client_secrets.open() as f:
+            secrets = json.load(f)["installed"]
+        try:
+            result = self.api.extend_access_token(
+                secrets["client_id"], secrets["client_secret"]
+            )
+        except facebook.GraphAPIError as ex:
+            if ex.code != ACCESS_TOKEN_EXPIRED:
+                raise
+            self.renew_token()
+            return
+        self.credentials.access_token = result["access_token"]
+        if "expires_in" in result:
+            self.credentials.token_expiry = datetime.utcnow() + timedelta(
+                seconds=int(result["expires_in"])
+            )
+        self.storage.put(self.credentials)
+        self.api = graph_api(self.credentials.access_token)
+
+    async def images(self, meta_photo: dict) -> List[dict]:
+        """
+        Return renditions of photo, sorted by decreasing size.
+        Metadata from a mapped index only has the photo ID, in which case they are fetched.
+        """
+        if "images" in meta_photo:
+            return meta_photo["images"]
+        await self.refresher.ensure_fresh()
+        result = await delegate(
+            lambda: getattr(self.graph, meta_photo["id"])(fields="images")
+        )
+        return result["images"]
 
-    async def download_photo(self, meta_photo: dict) -> Photo:
-        return await self._download_from_url(meta_photo["images"][0]["source"])
+    async def download_photo(
+        self, meta_photo: dict, max_size: Optional[Tuple[int, int]] = None
+    ) -> Photo:
+        images = await self.images(meta_photo)
+        image = images[0]
+        if max_size:
+            width, height = max_size
+            # smallest rendition covering the size, or the largest one
+            for candidate in images:
+                if candidate["width"] >= width and candidate["height"] >= height:
+                    image = candidate
+        return await self._download_from_url(image["source"])
 
-    async def download_meta_photos(self) -> AsyncIterator[Sequence[dict]]:
-        result = await self.download_meta_photos_page()
-        yield result["data"]
-        while "next" in result["paging"]:
-            result = await self.download_meta_photos_page(
-                result["paging"]["cursors"]["after"]
+    async def download_thumbnail(self, meta_photo: dict) -> Photo:
+        return await self._download_from_url((await self.images(meta_photo))[-1]["source"])
+
+    async def download_meta_photos(
+        self,
+        since: Optional[datetime] = None,
+        query: CrawlQuery = CrawlQuery(),
+        cursor: Optional[str] = None,
+    ) -> AsyncIterator[Sequence[dict]]:
+        # the Graph API only lists photos, and has no content categories
+        since, until = query.start(since), query.date_to
+        if SETTINGS.get("facebook/album_crawl", False):
+            # albums are crawled concurrently, with no single cursor to resume from
+            async for batch in self.download_album_photos(since=since, until=until):
+                yield batch
+            return
+        try:
+            result = await self.download_meta_photos_page(cursor, since=since, until=until)
+        except facebook.GraphAPIError as ex:
+            if cursor and ex.code == INVALID_PARAMETER:
+                raise CursorExpired(cursor) from ex
+            raise
+        while True:
+            paging = result.get("paging", {})
+            after = paging["cursors"]["after"] if "next" in paging else None
+            yield MetaPage(result["data"], after)
+            if after is None:
+                return
+            result = await self.download_meta_photos_page(after, since=since, until=until)
+
+    async def download_albums(self) -> List[str]:
+        """
+        Return IDs of the user's albums
+        """
+        albums = []
+        cursor = None
+        while True:
+            await self.refresher.ensure_fresh()
+            result = await delegate(
+                lambda: self.graph.me.albums(
+                    **(dict(after=cursor) if cursor else {}),
+                    fields="id",
+                    limit=self.batch_size,
+                )
             )
-            yield result["data"]
+            albums.extend(album["id"] for album in result["data"])
+            if "next" not in result.get("paging", {}):
+                return albums
+            cursor = result["paging"]["cursors"]["after"]
 
-    async def download_meta_photos_page(self, cursor=None) -> dict:
+    async def download_album_photos(
+        self, since: Optional[datetime] = None, until: Optional[datetime] = None
+    ) -> AsyncIterator[Sequence[dict]]:
+        """
+        Download photo metadata album by album, paginating several albums at once.
+        Pages are yielded as they arrive, without photos already yielded from other albums.
+        The amount of requests in flight is limited by ``facebook/album_concurrency``.
+        :param since: only retrieve photos uploaded after this time
+        :param until: only retrieve photos uploaded before this time
+        """
+        albums = await self.download_albums()
+        semaphore = asyncio.Semaphore(SETTINGS.get("facebook/album_concurrency", 4))
+        pages: "asyncio.Queue[Optional[List[dict]]]" = asyncio.Queue()
+
+        async def crawl_album(album_id: str):
+            cursor = None
+            while True:
+                async with semaphore:
+                    result = await self.download_meta_photos_page(
+                        cursor, since=since, until=until, album_id=album_id
+                    )
+                await pages.put(result["data"])
+                if "next" not in result.get("paging", {}):
+                    return
+                cursor = result["paging"]["cursors"]["after"]
+
+        tasks = [asyncio.ensure_future(crawl_album(album_id)) for album_id in albums]
+        crawled = asyncio.gather(*tasks)
+        # wake the consumer when all albums are done, or as soon as one fails
+        crawled.add_done_callback(lambda _: pages.put_nowait(None))
+        seen: Set[str] = set()
+        try:
+            while True:
+                page = await pages.get()
+                if page is None:
+                    break
+                batch = [photo for photo in page if photo["id"] not in seen]
+                seen.update(photo["id"] for photo in batch)
+                yield batch
+            await crawled
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def download_meta_photos_page(
+        self, cursor=None, since=None, until=None, album_id=None
+    ) -> dict:
         """
         Retrieve one page of photo metadata
         :param cursor: cursor returned in previous request
+        :param since: only retrieve photos uploaded after this time
+        :param until: only retrieve photos uploaded before this time
+        :param album_id: retrieve photos of this album instead of all uploaded photos
         :return: next page of photo metadata
         """
+        if album_id:
+            edge, kwargs = getattr(self.graph, album_id).photos, {}
+        else:
+            edge, kwargs = self.graph.me.photos, dict(type="uploaded")
+        await self.refresher.ensure_fresh()
         return await delegate(
-            lambda: self.graph.me.photos(
-                type="uploaded",
+            lambda: edge(
+                **kwargs,
                 **(dict(after=cursor) if cursor else {}),
-                fields="images",
+                **(dict(since=int(since.timestamp())) if since else {}),
+                **(dict(until=int(until.timestamp())) if until else {}),
+                fields="images,created_time",
                 limit=self.batch_size,
             )
         )
 
     @staticmethod
-    def filter_meta_photos(photos: Iterable[dict], min_width: int) -> Sequence[dict]:
-        return list(
-            filter(lambda photo: photo["images"][0]["width"] >= min_width, photos)
-        )
+    def dimensions(meta_photo: dict) -> Tuple[int, int]:
+        if "images" not in meta_photo:
+            return meta_photo["width"], meta_photo["height"]
+        return meta_photo["images"][0]["width"], meta_photo["images"][0]["height"]
+
+    @staticmethod
+    def created_time(meta_photo: dict) -> Optional[datetime]:
+        value = meta_photo.get("created_time")
+        return value and parse_timestamp(value)
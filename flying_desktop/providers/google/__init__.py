@@ -1,15 +1,31 @@
 """
 Google Photos Provider
 """
+from datetime import datetime, date
+from http import HTTPStatus
 from pathlib import Path
-from typing import AsyncIterator, Sequence, Iterable
+from typing import AsyncIterator, Sequence, Optional, Tuple
 
 from googleapiclient.discovery import build
-from googleapiclient.http import HttpRequest as GoogleHttpRequest
+from googleapiclient.errors import HttpError
 from httplib2 import Http
 
+from flying_desktop.settings import SETTINGS
+from flying_desktop.tracing import traced
 from flying_desktop.utils import delegate
-from .. import PhotoProvider, Photo, SettingsStorage, BadResponse
+from .. import (
+    PhotoProvider,
+    Photo,
+    SettingsStorage,
+    BadResponse,
+    CrawlQuery,
+    CursorExpired,
+    MetaPage,
+    parse_timestamp,
+)
+from ..cassette import active_cassette, CassetteHttp
+from ..refresh import TokenRefresher
+from ..transport import PooledHttp
 
 HERE = Path(__file__).parent
 
@@ -20,21 +36,43 @@ class GooglePhotos(PhotoProvider):
     """
 
     max_batch_size = 100
+    # photos looked up at once by ``mediaItems.batchGet``
+    max_batch_get = 50
     storage = SettingsStorage("google/token.json")
     client_secrets = HERE / "credentials.json"
     scope = "https://www.googleapis.com/auth/photoslibrary.readonly"
 
-    def __init__(self, credentials):
+    # discovery document location, ``None`` for the client library's default
+    discovery_url = None
+
+    def __init__(self, credentials, http=None):
+        """
+        :param credentials: oauth2 credentials
+        :param http: transport for all API requests,
+            by default a pool of connections authorized by ``credentials``.
+            It goes through the active cassette, if any.
+        """
         super().__init__(credentials)
+        self.refresher = TokenRefresher(self)
+        self.http = http or PooledHttp(
+            lambda: credentials.authorize(Http()),
+            size=SETTINGS.get("google/connections", 4),
+        )
+        cassette = active_cassette()
+        if cassette is not None:
+            self.http = CassetteHttp(cassette, self.http)
         self.service = build(
             "photoslibrary",
             "v1",
-            credentials=credentials,
-            requestBuilder=lambda _, *args, **kwargs: GoogleHttpRequest(
-                credentials.authorize(Http()), *args, **kwargs
-            ),
+            http=self.http,
+            **({"discoveryServiceUrl": self.discovery_url} if self.discovery_url else {}),
         )
 
+    def refresh_credentials(self):
+        self.credentials.refresh(Http())
+        self.storage.put(self.credentials)
+
+    @traced("google.get_photo")
     async def get_photo(self, photo_id, fields=None):
         """
         Get metadata for photo
@@ -42,46 +80,108 @@ class GooglePhotos(PhotoProvider):
         :param fields: fields to include in response
         :return: photo metadata
         """
+        await self.refresher.ensure_fresh()
         return await delegate(
             lambda: self.service.mediaItems()
             .get(mediaItemId=photo_id, fields=fields)
             .execute()
         )
 
-    async def download_photo(self, meta_photo: dict) -> Photo:
+    async def download_photo(
+        self, meta_photo: dict, max_size: Optional[Tuple[int, int]] = None
+    ) -> Photo:
         photo_id = meta_photo["id"]
-        url = (await self.get_photo(photo_id, fields="baseUrl"))["baseUrl"] + "=d"
+        # the API scales photos down to fit within the given width and height
+        suffix = f"=w{max_size[0]}-h{max_size[1]}" if max_size else "=d"
+        url = (await self.get_photo(photo_id, fields="baseUrl"))["baseUrl"] + suffix
         return await self._download_from_url(url)
 
-    async def download_meta_photos(self) -> AsyncIterator[Sequence[dict]]:
-        result = await self.download_meta_photos_page()
-        yield result["mediaItems"]
+    @traced("google.get_photos")
+    async def get_photos(self, photo_ids: Sequence[str], fields=None) -> dict:
+        """
+        Get metadata for several photos
+        :param photo_ids: IDs of photos, ``max_batch_get`` at most
+        :param fields: fields to include in response
+        :return: metadata of the photos found, by ID
+        """
+        await self.refresher.ensure_fresh()
+        result = await delegate(
+            lambda: self.service.mediaItems()
+            .batchGet(mediaItemIds=list(photo_ids), fields=fields)
+            .execute()
+        )
+        return {
+            item["mediaItem"]["id"]: item["mediaItem"]
+            for item in result.get("mediaItemResults", [])
+            if "mediaItem" in item
+        }
+
+    async def resolve_thumbnails(self, meta_photos: Sequence[dict]) -> Sequence[dict]:
+        """
+        Look up the base URLs of photos, ``max_batch_get`` at a time.
+        Photos which were not found are looked up again one by one when downloaded.
+        """
+        found = {}
+        for start in range(0, len(meta_photos), self.max_batch_get):
+            chunk = meta_photos[start : start + self.max_batch_get]
+            found.update(
+                await self.get_photos(
+                    [photo["id"] for photo in chunk],
+                    fields="mediaItemResults(mediaItem(id,baseUrl))",
+                )
+            )
+        return [found.get(photo["id"], photo) for photo in meta_photos]
+
+    async def download_thumbnail(self, meta_photo: dict) -> Photo:
+        base_url = meta_photo.get("baseUrl")
+        if base_url is None:
+            base_url = (await self.get_photo(meta_photo["id"], fields="baseUrl"))["baseUrl"]
+        return await self._download_from_url(base_url + "=w64-h64")
+
+    async def download_meta_photos(
+        self,
+        since: Optional[datetime] = None,
+        query: CrawlQuery = CrawlQuery(),
+        cursor: Optional[str] = None,
+    ) -> AsyncIterator[Sequence[dict]]:
+        filters = search_filters(query, since)
+        try:
+            result = await self.download_meta_photos_page(cursor, filters=filters)
+        except HttpError as ex:
+            # page tokens are rejected once they expire
+            if cursor and ex.resp.status == HTTPStatus.BAD_REQUEST:
+                raise CursorExpired(cursor) from ex
+            raise
+        # date filtered searches yield an empty response when nothing is new
+        yield MetaPage(result.get("mediaItems", []), result.get("nextPageToken"))
         while "nextPageToken" in result:
-            result = await self.download_meta_photos_page(result["nextPageToken"])
+            result = await self.download_meta_photos_page(
+                result["nextPageToken"], filters=filters
+            )
             if not result:
                 continue
             try:
-                yield result["mediaItems"]
+                yield MetaPage(result["mediaItems"], result.get("nextPageToken"))
             except KeyError:
                 raise BadResponse(result)
 
-    async def download_meta_photos_page(self, page_token=None):
+    async def download_meta_photos_page(self, page_token=None, filters=None):
         """
         Retrieve one page of photo metadata
         :param page_token: token returned in previous request
+        :param filters: search filters, as returned by ``search_filters``
         :return: next page of photo metadata
         """
-        fields = "nextPageToken,mediaItems(id,mediaMetadata(width,height))"
+        fields = "nextPageToken,mediaItems(id,mediaMetadata(creationTime,width,height))"
+        filters = filters if filters is not None else search_filters(CrawlQuery())
+        await self.refresher.ensure_fresh()
         return await delegate(
             lambda: (
                 self.service.mediaItems()
                 .search(
                     fields=fields,
                     body={
-                        "filters": {
-                            "contentFilter": {"includedContentCategories": ["PEOPLE"]},
-                            "mediaTypeFilter": {"mediaTypes": ["PHOTO"]},
-                        },
+                        "filters": filters,
                         "pageSize": self.max_batch_size,
                         **({"pageToken": page_token} if page_token else {}),
                     },
@@ -91,12 +191,50 @@ class GooglePhotos(PhotoProvider):
         )
 
     @staticmethod
-    def filter_meta_photos(photos: Iterable[dict], min_width: int) -> Sequence[dict]:
-        return list(
-            filter(
-                lambda photo: int(photo["mediaMetadata"]["width"]) >= min_width, photos
-            )
-        )
+    def dimensions(meta_photo: dict) -> Tuple[int, int]:
+        if "mediaMetadata" not in meta_photo:
+            return meta_photo["width"], meta_photo["height"]
+        metadata = meta_photo["mediaMetadata"]
+        return int(metadata["width"]), int(metadata["height"])
+
+    @staticmethod
+    def created_time(meta_photo: dict) -> Optional[datetime]:
+        value = meta_photo.get("mediaMetadata", {}).get("creationTime")
+        return value and parse_timestamp(value)
+
+
+def search_filters(query: CrawlQuery, since: Optional[datetime] = None) -> dict:
+    """
+    Translate crawl query to the filters of a media items search
+    :param query: restrictions on the photos searched
+    :param since: time of the last sync, for incremental syncs
+    """
+    filters = {"mediaTypeFilter": {"mediaTypes": list(query.media_types)}}
+    content_filter = {}
+    if query.categories:
+        content_filter["includedContentCategories"] = list(query.categories)
+    if query.excluded_categories:
+        content_filter["excludedContentCategories"] = list(query.excluded_categories)
+    if content_filter:
+        filters["contentFilter"] = content_filter
+    start = query.start(since)
+    if start or query.date_to:
+        filters["dateFilter"] = {
+            "ranges": [
+                {
+                    "startDate": api_date(start.date() if start else date.min),
+                    "endDate": api_date(query.date_to.date() if query.date_to else date.today()),
+                }
+            ]
+        }
+    return filters
+
+
+def api_date(day: date) -> dict:
+    """
+    Convert date to the API's date representation
+    """
+    return {"year": day.year, "month": day.month, "day": day.day}
 
 
 def make_url(photo: dict):
@@ -0,0 +1,105 @@
+"""
+Background renewal of providers' oauth2 tokens
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, TYPE_CHECKING
+
+from flying_desktop.utils import delegate, loop, AUTH_POOL
+
+if TYPE_CHECKING:
+    from . import PhotoProvider
+
+log = logging.getLogger(__name__)
+
+# seconds to wait before retrying a failed refresh
+RETRY_DELAY = 60
+
+
+class TokenRefresher:
+    """
+    Renews a provider's access token shortly before it expires.
+    Concurrent callers needing a fresh token share a single refresh.
+    """
+
+    def __init__(self, provider: "PhotoProvider", margin: timedelta = timedelta(minutes=5)):
+        """
+        :param provider: provider whose credentials are refreshed
+        :param margin: how long before expiry tokens are refreshed
+        """
+        self.provider = provider
+        self.margin = margin
+        self._in_flight: Optional[asyncio.Future] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def expiry(self) -> Optional[datetime]:
+        """
+        Expiry time of the current access token, in UTC, if it expires
+        """
+        return self.provider.credentials.token_expiry
+
+    def expires_soon(self) -> bool:
+        """
+        Whether the access token expires within the margin
+        """
+        return self.expiry is not None and datetime.utcnow() + self.margin >= self.expiry
+
+    async def refresh(self):
+        """
+        Refresh the access token, joining a refresh already in flight
+        """
+        if self._in_flight is None:
+            self._in_flight = loop.create_task(self._refresh())
+        await asyncio.shield(self._in_flight)
+
+    async def _refresh(self):
+        try:
+            log.info("refreshing %s token", type(self.provider).__name__)
+            await delegate(self.provider.refresh_credentials, pool=AUTH_POOL)
+        finally:
+            self._in_flight = None
+
+    def refresh_blocking(self):
+        """
+        Refresh the access token from a thread other than the event loop's
+        """
+        asyncio.run_coroutine_threadsafe(self.refresh(), loop).result()
+
+    async def ensure_fresh(self):
+        """
+        Refresh the access token if it is about to expire
+        """
+        if self.expires_soon():
+            await self.refresh()
+
+    async def run(self):
+        """
+        Refresh the access token before every expiry
+        """
+        while self.expiry is not None:
+            delay = (self.expiry - self.margin - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.error("cannot refresh %s token: %s", type(self.provider).__name__, e)
+                await asyncio.sleep(RETRY_DELAY)
+
+    def start(self):
+        """
+        Start refreshing in the background
+        """
+        if self._task is None:
+            self._task = loop.create_task(self.run())
+
+    def stop(self):
+        """
+        Stop refreshing in the background. May be called from any thread.
+        """
+        if self._task is not None:
+            # cancelling wakes the loop only when done from its own thread
+            loop.call_soon_threadsafe(self._task.cancel)
+            self._task = None
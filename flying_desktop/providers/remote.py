@@ -0,0 +1,116 @@
+"""
+Photos of a Flying Desktop service, started with ``flydesk serve`` on another machine.
+The service crawls and downloads the libraries it is logged in to, so desktops
+using this provider make no provider API calls of their own.
+The service's address is set in ``remote/url``.
+
+Register it in the ``providers/extra`` setting:
+    [{"name": "Shared", "provider": "flying_desktop.providers.remote:RemotePhotos"}]
+"""
+from datetime import datetime
+from http import HTTPStatus
+from typing import AsyncIterator, Sequence, Optional, Tuple
+from urllib.parse import urlencode
+
+import attr
+
+from flying_desktop.settings import SETTINGS
+from . import (
+    PhotoProvider,
+    Photo,
+    BadResponse,
+    CrawlQuery,
+    CursorExpired,
+    MetaPage,
+    http_session,
+)
+from .refresh import TokenRefresher
+
+# default address of the service, overridable by ``remote/url``
+DEFAULT_URL = "http://127.0.0.1:8737"
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class ServiceAddress:
+    """
+    Stands in for credentials: the service needs no login, and nothing expires
+    :param url: root URL of the service
+    """
+
+    url: str
+    token_expiry: Optional[datetime] = None
+
+
+class RemotePhotos(PhotoProvider):
+    """
+    Provider of the photos selected by a Flying Desktop service
+    """
+
+    storage = client_secrets = scope = None
+    # the service returns photos with the same perceptual hash once
+    hashable = False
+
+    def __init__(self, credentials: ServiceAddress):
+        super().__init__(credentials)
+        self.url = credentials.url.rstrip("/")
+        self.refresher = TokenRefresher(self)
+
+    @classmethod
+    def from_code_grant(cls):
+        return cls(ServiceAddress(SETTINGS.get("remote/url", DEFAULT_URL)))
+
+    @classmethod
+    def clear(cls):
+        pass
+
+    def refresh_credentials(self):
+        pass
+
+    async def download_meta_photos(
+        self,
+        since: Optional[datetime] = None,
+        query: CrawlQuery = CrawlQuery(),
+        cursor: Optional[str] = None,
+    ) -> AsyncIterator[Sequence[dict]]:
+        """
+        Download metadata of all photos of the service within the query's dates.
+        The service doesn't track when photos were added, so ``since`` is ignored.
+        """
+        params = {
+            name: value.isoformat()
+            for name, value in (("date_from", query.date_from), ("date_to", query.date_to))
+            if value
+        }
+        while True:
+            if cursor:
+                params["cursor"] = cursor
+            async with http_session().get(f"{self.url}/photos", params=params) as response:
+                # cursors name libraries, which the service may no longer have
+                if cursor and response.status == HTTPStatus.BAD_REQUEST:
+                    raise CursorExpired(cursor)
+                if response.status != HTTPStatus.OK:
+                    raise BadResponse(f"{response.status} from {response.url}")
+                page = await response.json()
+            cursor = page.get("cursor")
+            yield MetaPage(page["photos"], cursor)
+            if not cursor:
+                return
+
+    async def download_photo(
+        self, meta_photo: dict, max_size: Optional[Tuple[int, int]] = None
+    ) -> Photo:
+        """
+        Download photo through the service's photo cache.
+        The service chooses renditions by its own data budget, so ``max_size`` is ignored.
+        """
+        query = urlencode({"id": meta_photo["id"]})
+        return await self._download_from_url(f"{self.url}/photo?{query}")
+
+    @staticmethod
+    def dimensions(meta_photo: dict) -> Tuple[int, int]:
+        return meta_photo["width"], meta_photo["height"]
+
+    @staticmethod
+    def created_time(meta_photo: dict) -> Optional[datetime]:
+        created = meta_photo.get("created")
+        return datetime.fromisoformat(created) if created else None
@@ -0,0 +1,60 @@
+"""
+HTTP transports shared by provider API clients
+"""
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from httplib2 import Http
+
+
+class PooledHttp:
+    """
+    Thread-safe stand-in for ``httplib2.Http``.
+    Requests borrow an idle ``Http`` from a bounded pool, so their keep-alive
+    connections are reused across requests and threads.
+    """
+
+    def __init__(self, factory: Callable[[], Http], size: int = 4):
+        """
+        :param factory: creates a new ``Http``, e.g. an authorized one
+        :param size: maximum amount of ``Http`` objects, and so of concurrent requests
+        """
+        self.factory = factory
+        self.size = size
+        self._idle: "queue.LifoQueue[Http]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self) -> Iterator[Http]:
+        """
+        Borrow an ``Http`` from the pool, waiting if all are in use
+        """
+        with self._slots:
+            try:
+                http = self._idle.get_nowait()
+            except queue.Empty:
+                http = self.factory()
+            try:
+                yield http
+            finally:
+                self._idle.put(http)
+
+    def request(self, *args, **kwargs):
+        """
+        Same as ``httplib2.Http.request``
+        """
+        with self.connection() as http:
+            return http.request(*args, **kwargs)
+
+    def close(self):
+        """
+        Close idle connections
+        """
+        while True:
+            try:
+                http = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            http.close()
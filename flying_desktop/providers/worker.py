@@ -0,0 +1,386 @@
+"""
+Providers running in worker processes.
+Crawls parse large API responses and hold the GIL for long stretches; in a worker
+process they leave the Tk thread alone and use another core.
+``IsolatedProvider`` stands in for the provider in the application's process,
+forwarding calls over a pipe and streaming metadata pages back.
+Enabled by ``providers/isolated``.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import pickle
+import threading
+import traceback
+from datetime import datetime
+from multiprocessing.connection import Connection
+from typing import AsyncIterator, Sequence, Optional, Tuple, Type, Dict, Callable, Any
+
+from flying_desktop import APP_NAME
+from flying_desktop.settings import SETTINGS
+from flying_desktop.utils import delegate, error_handler, executors, loop, AUTH_POOL
+from . import PhotoProvider, Photo, CrawlQuery, MetaPage
+from .cassette import cassette_setup
+
+# calls forwarded to the worker
+PROXIED = (
+    "download_meta_photos",
+    "download_photo",
+    "resolve_thumbnails",
+    "download_thumbnail",
+)
+# request answered once the worker's provider is logged in
+LOGIN = 0
+# seconds given to a worker to exit before it is killed
+STOP_TIMEOUT = 5
+# fork is unsafe with the Tk and event loop threads running
+_context = multiprocessing.get_context("spawn")
+log = logging.getLogger(__name__)
+
+
+class WorkerError(Exception):
+    """
+    A worker failed in a way which could not be sent back as is
+    """
+
+
+class PipeHandler(logging.Handler):
+    """
+    Send log records of a worker to the application's process
+    """
+
+    def __init__(self, send: Callable[[str, Optional[int], Any], None]):
+        super().__init__()
+        self.send = send
+
+    def emit(self, record: logging.LogRecord):
+        fields = dict(record.__dict__)
+        fields["msg"] = record.getMessage()
+        fields["args"] = None
+        if record.exc_info:
+            fields["exc_text"] = "".join(traceback.format_exception(*record.exc_info))
+        fields["exc_info"] = None
+        self.send("log", None, fields)
+
+
+def portable(ex: Exception) -> Exception:
+    """
+    Return exception if it can be sent back to the application's process,
+    otherwise a ``WorkerError`` describing it
+    """
+    try:
+        pickle.loads(pickle.dumps(ex))
+    except Exception:
+        return WorkerError(f"{type(ex).__name__}: {ex}")
+    return ex
+
+
+def compact(provider: PhotoProvider, batch: Sequence[dict]) -> MetaPage:
+    """
+    Return a page with only the fields kept by the mapped index:
+    ID, dimensions and creation time in ISO format
+    """
+    photos = []
+    for photo in batch:
+        width, height = provider.dimensions(photo)
+        created = provider.created_time(photo)
+        photos.append(
+            {
+                "id": photo["id"],
+                "width": width,
+                "height": height,
+                "created": created and created.isoformat(),
+            }
+        )
+    return MetaPage(photos, getattr(batch, "cursor", None))
+
+
+async def handle(
+    provider: PhotoProvider,
+    send: Callable[[str, Optional[int], Any], None],
+    request_id: int,
+    method: str,
+    args: tuple,
+    kwargs: dict,
+    compact_pages: bool = False,
+):
+    """
+    Run a forwarded call and send its result, or every page of a crawl
+    :param compact_pages: whether to send pages of a crawl made ``compact``
+    """
+    try:
+        if method == "download_meta_photos":
+            async for batch in provider.download_meta_photos(*args, **kwargs):
+                send("page", request_id, compact(provider, batch) if compact_pages else batch)
+            result = None
+        else:
+            result = await getattr(provider, method)(*args, **kwargs)
+    except asyncio.CancelledError:
+        raise
+    except Exception as ex:
+        send("error", request_id, ex)
+    else:
+        send("done", request_id, result)
+
+
+def serve(provider_class: Type[PhotoProvider], conn: Connection, compact_pages: bool):
+    """
+    Entry point of a worker process: log in, then run forwarded calls until stopped
+    :param provider_class: provider to run
+    :param conn: worker's end of the pipe
+    :param compact_pages: whether to send pages of a crawl made ``compact``
+    """
+    lock = threading.Lock()
+
+    def send(kind: str, request_id: Optional[int], payload: Any):
+        if kind == "error":
+            payload = portable(payload)
+        with lock:
+            try:
+                conn.send((kind, request_id, payload))
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # pickling failed before anything was written
+                conn.send(("error", request_id, WorkerError(repr(payload))))
+
+    app_log = logging.getLogger(APP_NAME)
+    app_log.setLevel(SETTINGS.get("log/level", "INFO"))
+    app_log.addHandler(PipeHandler(send))
+    # daemonic workers are terminated without running atexit handlers,
+    # so the recording is saved as soon as the worker is stopped
+    cassette = cassette_setup(worker=provider_class.__name__)
+    try:
+        _serve(provider_class, conn, send, compact_pages)
+    finally:
+        if cassette is not None and cassette.recording:
+            cassette.save()
+
+
+def _serve(
+    provider_class: Type[PhotoProvider],
+    conn: Connection,
+    send: Callable[[str, Optional[int], Any], None],
+    compact_pages: bool,
+):
+    """
+    Log in, then run forwarded calls until stopped
+    """
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    try:
+        provider = provider_class.from_code_grant()
+    except Exception as ex:
+        send("error", LOGIN, ex)
+        return
+    loop.call_soon_threadsafe(provider.refresher.start)
+    send("done", LOGIN, None)
+    calls: Dict[int, "asyncio.Future"] = {}
+    while True:
+        try:
+            kind, request_id, payload = conn.recv()
+        except EOFError:
+            break
+        if kind == "stop":
+            break
+        if kind == "cancel":
+            call = calls.get(request_id)
+            if call is not None:
+                call.cancel()
+            continue
+        method, args, kwargs = payload
+        if method not in PROXIED:
+            send("error", request_id, WorkerError(f"{method} is not forwarded"))
+            continue
+        call = asyncio.run_coroutine_threadsafe(
+            handle(provider, send, request_id, method, args, kwargs, compact_pages), loop
+        )
+        calls[request_id] = call
+        call.add_done_callback(lambda _, request_id=request_id: calls.pop(request_id, None))
+    loop.call_soon_threadsafe(provider.refresher.stop)
+
+
+class IsolatedProvider(PhotoProvider):
+    """
+    Provider running in a worker process.
+    Metadata is read by the provider class in this process, which only parses
+    the photo dictionaries sent back. With the mapped index, which keeps little of them,
+    the worker sends ``compact`` dictionaries instead, so less is pickled over the pipe.
+    """
+
+    storage = client_secrets = scope = None
+
+    def __init__(self, provider_class: Type[PhotoProvider]):
+        """
+        :param provider_class: provider to run in the worker
+        """
+        # credentials stay in the worker
+        super().__init__(credentials=None)
+        self.provider_class = provider_class
+        self.hashable = provider_class.hashable
+        self.compact_pages = SETTINGS.get("index/mapped", False)
+        self._conn, self._child_conn = _context.Pipe()
+        self.process = _context.Process(
+            target=serve,
+            args=(provider_class, self._child_conn, self.compact_pages),
+            name=f"{provider_class.__name__} worker",
+            daemon=True,
+        )
+        self._ids = itertools.count(LOGIN + 1)
+        self._replies: Dict[int, asyncio.Queue] = {LOGIN: asyncio.Queue()}
+        self._send_lock = threading.Lock()
+        self._exited = False
+
+    @classmethod
+    async def start(cls, provider_class: Type[PhotoProvider]) -> "IsolatedProvider":
+        """
+        Start a worker and wait for its provider to log in
+        :param provider_class: provider to run in the worker
+        """
+        provider = cls(provider_class)
+        await delegate(provider.process.start, pool=AUTH_POOL)
+        # only the worker holds its end, so the pipe closes when the worker exits
+        provider._child_conn.close()
+        threading.Thread(
+            target=provider._read, name=f"{provider.process.name} reader", daemon=True
+        ).start()
+        try:
+            await provider._reply(LOGIN)
+        except BaseException:
+            provider.close()
+            raise
+        finally:
+            del provider._replies[LOGIN]
+        log.info("started %s, pid %d", provider.process.name, provider.process.pid)
+        return provider
+
+    def refresh_credentials(self):
+        # tokens are refreshed in the worker
+        pass
+
+    def _send(self, kind: str, request_id: int, payload: Any = None):
+        with self._send_lock:
+            self._conn.send((kind, request_id, payload))
+
+    def _read(self):
+        """
+        Receive replies and log records from the worker until it exits
+        """
+        while True:
+            try:
+                kind, request_id, payload = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            except Exception:
+                log.exception("cannot read message from %s", self.process.name)
+                continue
+            if kind == "log":
+                record = logging.makeLogRecord(payload)
+                logging.getLogger(record.name).handle(record)
+            else:
+                loop.call_soon_threadsafe(self._deliver, request_id, kind, payload)
+        self._exited = True
+        error = WorkerError(f"{self.process.name} exited")
+        for request_id in list(self._replies):
+            loop.call_soon_threadsafe(self._deliver, request_id, "error", error)
+
+    def _deliver(self, request_id: int, kind: str, payload: Any):
+        replies = self._replies.get(request_id)
+        if replies is not None:
+            replies.put_nowait((kind, payload))
+
+    def _call(self, method: str, *args, **kwargs) -> int:
+        if self._exited:
+            raise WorkerError(f"{self.process.name} exited")
+        request_id = next(self._ids)
+        self._replies[request_id] = asyncio.Queue()
+        self._send("call", request_id, (method, args, kwargs))
+        return request_id
+
+    async def _reply(self, request_id: int) -> Tuple[str, Any]:
+        """
+        Wait for the next reply to a request, raising errors sent back
+        """
+        kind, payload = await self._replies[request_id].get()
+        if kind == "error":
+            raise payload
+        return kind, payload
+
+    async def _result(self, method: str, *args, **kwargs) -> Any:
+        request_id = self._call(method, *args, **kwargs)
+        try:
+            _, result = await self._reply(request_id)
+            return result
+        except asyncio.CancelledError:
+            self._send("cancel", request_id)
+            raise
+        finally:
+            del self._replies[request_id]
+
+    async def download_meta_photos(
+        self,
+        since: Optional[datetime] = None,
+        query: CrawlQuery = CrawlQuery(),
+        cursor: Optional[str] = None,
+    ) -> AsyncIterator[Sequence[dict]]:
+        request_id = self._call("download_meta_photos", since, query, cursor)
+        done = False
+        try:
+            while True:
+                kind, payload = await self._reply(request_id)
+                if kind == "done":
+                    done = True
+                    return
+                yield payload
+        except Exception:
+            done = True
+            raise
+        finally:
+            # the crawl was abandoned
+            if not done:
+                self._send("cancel", request_id)
+            del self._replies[request_id]
+
+    async def download_photo(
+        self, meta_photo: dict, max_size: Optional[Tuple[int, int]] = None
+    ) -> Photo:
+        return await self._result("download_photo", meta_photo, max_size)
+
+    async def resolve_thumbnails(self, meta_photos: Sequence[dict]) -> Sequence[dict]:
+        return await self._result("resolve_thumbnails", meta_photos)
+
+    async def download_thumbnail(self, meta_photo: dict) -> Photo:
+        return await self._result("download_thumbnail", meta_photo)
+
+    def dimensions(self, meta_photo: dict) -> Tuple[int, int]:
+        if self.compact_pages:
+            return meta_photo["width"], meta_photo["height"]
+        return self.provider_class.dimensions(meta_photo)
+
+    def created_time(self, meta_photo: dict) -> Optional[datetime]:
+        if self.compact_pages:
+            created = meta_photo["created"]
+            return datetime.fromisoformat(created) if created else None
+        return self.provider_class.created_time(meta_photo)
+
+    def clear(self):
+        self.provider_class.clear()
+
+    def close(self):
+        """
+        Stop the worker without waiting for it.
+        It is joined in a pool, and killed if it doesn't exit in time.
+        """
+        if not self.process.is_alive():
+            return
+        try:
+            self._send("stop", LOGIN)
+        except OSError:
+            pass
+        # submitted from any thread; pool threads are joined before the application exits,
+        # so the worker has time to save its recording before daemonic processes are terminated
+        executors[AUTH_POOL].submit(self._join).add_done_callback(error_handler)
+
+    def _join(self):
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            log.warning("%s did not stop, killing it", self.process.name)
+            self.process.kill()
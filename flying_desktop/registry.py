@@ -0,0 +1,98 @@
+"""
+Registry of available providers.
+Providers are found by name and import path only, so none is imported
+before its bucket is filled. Besides the bundled providers, packages can
+register providers under the ``flying_desktop.providers`` entry point group,
+and more can be listed in the ``providers/extra`` setting.
+"""
+import logging
+from typing import List, Tuple, Collection
+
+from .buckets import BucketFactory, FilledBucket
+from .settings import SETTINGS
+
+ENTRY_POINT_GROUP = "flying_desktop.providers"
+log = logging.getLogger(__name__)
+
+# bundled providers, also listed when package metadata is missing, e.g. in frozen builds
+BUILTIN = [
+    BucketFactory(
+        name="Google",
+        description="Connect to Google Photos",
+        provider="flying_desktop.providers.google:GooglePhotos",
+    ),
+    BucketFactory(
+        name="Facebook",
+        description="Connect to your Facebook photos",
+        provider="flying_desktop.providers.facebook:FacebookPhotos",
+    ),
+]
+
+
+def _entry_points() -> List[Tuple[str, str]]:
+    """
+    Return names and import paths of providers registered as entry points
+    """
+    try:
+        from importlib import metadata
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+
+        return [
+            (ep.name, f"{ep.module_name}:{'.'.join(ep.attrs)}")
+            for ep in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+        ]
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        group = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        group = entry_points.get(ENTRY_POINT_GROUP, [])
+    return [(ep.name, ep.value) for ep in group]
+
+
+def bucket_factories() -> List[BucketFactory]:
+    """
+    Return factories of all available providers, bundled ones first.
+    Later registrations of an existing name are ignored.
+    """
+    factories = {factory.name: factory for factory in BUILTIN}
+    registered = [
+        BucketFactory(name=name, description=f"Connect to {name}", provider=path)
+        for name, path in _entry_points()
+    ]
+    configured = [
+        BucketFactory(
+            name=entry["name"],
+            description=entry.get("description", f"Connect to {entry['name']}"),
+            provider=entry["provider"],
+        )
+        for entry in SETTINGS.get("providers/extra", [])
+    ]
+    for factory in registered + configured:
+        if factory.name in factories:
+            if factory.provider != factories[factory.name].provider:
+                log.warning("provider name %s is already registered", factory.name)
+            continue
+        factories[factory.name] = factory
+    return list(factories.values())
+
+
+async def fill_enabled(exclude: Collection[str] = ()) -> List[FilledBucket]:
+    """
+    Fill buckets of the enabled providers which were logged in to, as the
+    providers dialog does at launch, for commands running without the window.
+    Providers which cannot log in are skipped.
+    :param exclude: import paths of providers to leave out
+    """
+    buckets = []
+    for factory in bucket_factories():
+        bucket = factory.new()
+        if factory.provider in exclude or not (bucket.has_credentials() and bucket.checked):
+            continue
+        try:
+            buckets.append(await bucket.fill())
+        except Exception:
+            log.exception("cannot log in to %s", factory.name)
+    if not buckets:
+        log.warning("no provider is logged in, log in with the application first")
+    return buckets
@@ -0,0 +1,255 @@
+"""
+Photo service shared by many desktops, started with ``flydesk serve``.
+The service crawls the libraries it is logged in to, keeps their indexes and the
+photo cache, and serves selections and photos over HTTP to desktops using the
+``flying_desktop.providers.remote:RemotePhotos`` provider, so provider API calls
+and downloads grow with the number of libraries rather than of desktops.
+
+Log in to the providers with the application first, on the machine running the service.
+The service listens on ``serve/host`` and ``serve/port``, with no authentication.
+
+API:
+- ``GET /photos``: page of photos matching the ``PhotoFilter`` fields given as query
+  parameters, dates in ISO format, without duplicates across libraries.
+  Pages have ``limit`` photos at most; the ``cursor`` of a page requests the next one.
+  Cursors name the library and index position of the page's last photo, so photos added
+  by crawls while paging don't shift the following pages. The service's preference
+  for cached photos doesn't apply, as desktops have their own.
+- ``GET /photo?id=ID``: photo data, with the ID given in a page
+- ``GET /status``: libraries, their health and the data budget
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Callable, Any, Optional, Tuple
+
+import numpy as np
+from aiohttp import web
+
+from .budget import BUDGET, BudgetExhausted
+from .buckets import FilledBucket, REFRESH_PERIOD, select_photos
+from .filters import PhotoFilter, ORIENTATIONS
+from .health import CircuitOpen
+from .photo_cache import PHOTO_CACHE
+from .registry import fill_enabled
+from .settings import SETTINGS
+
+# defaults of the ``serve`` settings
+HOST = "127.0.0.1"
+PORT = 8737
+# photos per page, unless fewer are requested
+PAGE_SIZE = 500
+# providers which are never filled by the service, as they would query the service itself
+REMOTE_PROVIDER = "flying_desktop.providers.remote:RemotePhotos"
+# seconds before retrying a failed sync
+RETRY_DELAY = 60
+# query parameters of ``GET /photos``, with their parsers
+FILTER_PARAMS: Dict[str, Callable[[str], Any]] = {
+    "min_width": int,
+    "max_width": int,
+    "min_height": int,
+    "max_height": int,
+    "min_aspect": float,
+    "max_aspect": float,
+    "orientation": str,
+    "date_from": datetime.fromisoformat,
+    "date_to": datetime.fromisoformat,
+}
+log = logging.getLogger(__name__)
+
+
+def parse_filter(query) -> PhotoFilter:
+    """
+    Build photo filter from query parameters
+    :raises web.HTTPBadRequest: if a parameter is invalid
+    """
+    values = {}
+    for name, parse in FILTER_PARAMS.items():
+        if name in query:
+            try:
+                values[name] = parse(query[name])
+            except ValueError:
+                raise web.HTTPBadRequest(text=f"invalid {name}: {query[name]}")
+    if "orientation" in values and values["orientation"] not in ORIENTATIONS:
+        raise web.HTTPBadRequest(text=f"orientation must be one of {', '.join(ORIENTATIONS)}")
+    return PhotoFilter(**values)
+
+
+def parse_cursor(cursor: str) -> Tuple[str, int]:
+    """
+    Return library name and index position of the photo a cursor follows
+    :raises web.HTTPBadRequest: if the cursor is invalid
+    """
+    name, _, position = cursor.rpartition(":")
+    try:
+        return name, int(position)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"invalid cursor: {cursor}")
+
+
+def _created(timestamp: int) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+
+class PhotoService:
+    """
+    Buckets kept in sync, and the web application serving them
+    """
+
+    def __init__(self):
+        self.buckets: Dict[str, FilledBucket] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    async def fill(self):
+        """
+        Fill the buckets of enabled providers which were logged in to, and keep them in sync
+        """
+        for bucket in await fill_enabled(exclude=(REMOTE_PROVIDER,)):
+            self.buckets[bucket.name] = bucket
+            self._tasks.append(asyncio.ensure_future(self.keep_synced(bucket)))
+
+    @staticmethod
+    async def keep_synced(bucket: FilledBucket):
+        """
+        Crawl metadata and hash photos of ``bucket`` every ``REFRESH_PERIOD``
+        """
+        while True:
+            try:
+                async for _ in bucket.download():
+                    pass
+                log.info("%s: %d photos", bucket.name, len(bucket.photos))
+                await bucket.hash_photos()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("cannot sync %s", bucket.name)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            await asyncio.sleep(REFRESH_PERIOD.total_seconds())
+
+    async def photos(self, request: web.Request) -> web.Response:
+        photo_filter = parse_filter(request.query)
+        try:
+            limit = min(int(request.query.get("limit", PAGE_SIZE)), PAGE_SIZE)
+        except ValueError:
+            raise web.HTTPBadRequest(text="limit must be an integer")
+        if limit < 1:
+            raise web.HTTPBadRequest(text="limit must be positive")
+        after = parse_cursor(request.query["cursor"]) if "cursor" in request.query else None
+        if after and after[0] not in self.buckets:
+            raise web.HTTPBadRequest(text=f"no library {after[0]}")
+        selection = select_photos(self.buckets.values(), photo_filter, prefer_cached=False)
+        page = []
+        result = {"photos": page}
+        # selected photos are read from the index columns, and only paged ones are described
+        for bucket, view in selection.parts:
+            indices = view.indices
+            if after:
+                if bucket.name != after[0]:
+                    continue
+                indices = indices[np.searchsorted(indices, after[1], side="right") :]
+                after = None
+            if len(page) == limit:
+                if len(indices):
+                    result["cursor"] = cursor
+                    break
+                continue
+            taken = indices[: limit - len(page)]
+            for position in taken:
+                row = view.columns[position]
+                page.append(
+                    {
+                        "id": f"{bucket.name}/{view.photos[int(position)]['id']}",
+                        "width": int(row["width"]),
+                        "height": int(row["height"]),
+                        "created": _created(int(row["created"])),
+                    }
+                )
+            if len(taken):
+                cursor = f"{bucket.name}:{taken[-1]}"
+            if len(taken) < len(indices):
+                result["cursor"] = cursor
+                break
+        return web.json_response(result)
+
+    async def photo(self, request: web.Request) -> web.Response:
+        name, _, photo_id = request.query.get("id", "").partition("/")
+        bucket = self.buckets.get(name)
+        meta_photo = bucket and bucket.find(photo_id)
+        if not meta_photo:
+            raise web.HTTPNotFound(text=f"no photo {name}/{photo_id}")
+        try:
+            photo = await bucket.fetch_photo(meta_photo)
+        except (CircuitOpen, BudgetExhausted) as e:
+            raise web.HTTPServiceUnavailable(text=str(e))
+        except asyncio.TimeoutError:
+            raise web.HTTPGatewayTimeout(text=f"{name} did not respond in time")
+        except Exception as e:
+            log.warning("cannot download %s/%s: %r", name, photo_id, e)
+            raise web.HTTPBadGateway(text=f"cannot download from {name}")
+        return web.Response(body=photo.data, content_type=f"image/{photo.suffix}")
+
+    async def status(self, _: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "libraries": [
+                    {
+                        "name": bucket.name,
+                        "photos": len(bucket.photos),
+                        "synced_at": bucket.index.synced_at
+                        and bucket.index.synced_at.isoformat(),
+                        "health": str(bucket.health),
+                    }
+                    for bucket in self.buckets.values()
+                ],
+                "cached_photos": len(PHOTO_CACHE),
+                "budget": str(BUDGET),
+            }
+        )
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/photos", self.photos),
+                web.get("/photo", self.photo),
+                web.get("/status", self.status),
+            ]
+        )
+        return app
+
+    async def start(self, host: str, port: int):
+        """
+        Start serving, then fill the buckets
+        """
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        log.info("serving photos on http://%s:%d", host, port)
+        await self.fill()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for bucket in self.buckets.values():
+            bucket.client.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+async def run_service() -> int:
+    """
+    Run the service until cancelled
+    :return: exit status
+    """
+    service = PhotoService()
+    try:
+        await service.start(SETTINGS.get("serve/host", HOST), SETTINGS.get("serve/port", PORT))
+        await asyncio.Event().wait()
+    except asyncio.CancelledError:
+        log.info("stopping service")
+    finally:
+        await service.stop()
+    return 0
@@ -3,7 +3,9 @@ Utilities for storing and retrieving application settings
 """
 import json
 import logging
+import os
 from configparser import ConfigParser
+from contextlib import contextmanager
 from pathlib import Path
 
 from appdirs import user_cache_dir
@@ -11,9 +13,39 @@ from appdirs import user_cache_dir
 from flying_desktop import APP_NAME
 
 version = "0.1.0"
-PATH = Path(user_cache_dir(appname=APP_NAME, version=version), "cache.ini")
+CACHE_DIR = Path(user_cache_dir(appname=APP_NAME, version=version))
+PATH = CACHE_DIR / "cache.ini"
+# held while the file is read, changed and written, by processes sharing the settings
+LOCK_PATH = CACHE_DIR / "settings.lock"
 log = logging.getLogger(__name__)
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def _file_lock():
+    """
+    Hold the settings lock, waiting for other processes to release it
+    """
+    with LOCK_PATH.open("a+") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
 
 class Settings:
     """
@@ -34,21 +66,36 @@ class Settings:
         """
         Retrieve settings value
         """
-        value = self._settings.get(*self._make_key(item), fallback=default)
-        value = json.loads(value)
-        return value
+        section, key = self._make_key(item)
+        if not self._settings.has_option(section, key):
+            return default
+        return json.loads(self._settings.get(section, key))
 
     __getitem__ = get
 
+    def _reload(self):
+        settings = ConfigParser()
+        settings.read(PATH)
+        self._settings = settings
+
+    def _write(self):
+        # readers see either the old or the new file, never a partly written one
+        temp = PATH.with_name(f"{PATH.name}.{os.getpid()}.tmp")
+        with temp.open("w") as f:
+            self._settings.write(f)
+        os.replace(temp, PATH)
+
     def set(self, key, value):
         """
-        Set settings value
+        Set settings value.
+        The file is read again first, keeping values written by other processes.
         """
         log.debug(f"settings: {key} = {value}")
         value = json.dumps(value)
-        self._settings.set(*self._make_key(key), value)
-        with PATH.open("w") as f:
-            self._settings.write(f)
+        with _file_lock():
+            self._reload()
+            self._settings.set(*self._make_key(key), value)
+            self._write()
 
     __setitem__ = set
 
@@ -56,7 +103,12 @@ class Settings:
         """
         Unset settings value
         """
-        return self._settings.remove_option(*self._make_key(key))
+        with _file_lock():
+            self._reload()
+            removed = self._settings.remove_option(*self._make_key(key))
+            if removed:
+                self._write()
+        return removed
 
 
 SETTINGS = Settings()
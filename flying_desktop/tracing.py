@@ -0,0 +1,262 @@
+"""
+Lightweight span tracing of the wallpaper pipeline.
+The current span is kept in a context variable, so spans opened in coroutines,
+in executor threads (through ``delegate``) and in the Tk thread find their parent.
+Finished spans are written as JSON lines to a rotating file, through a queue.
+
+Summarize traces with:
+    python -m flying_desktop.tracing [--slowest N] [FILE ...]
+"""
+import argparse
+import inspect
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Optional, Iterator, Dict, List, Iterable
+
+from appdirs import user_log_dir
+
+from . import APP_NAME
+from .log import listen
+from .settings import SETTINGS
+
+TRACE_FILE = Path(user_log_dir(), "traces.jsonl")
+# defaults of the ``trace`` settings
+TRACE_MAX_KB = 2048
+TRACE_BACKUPS = 2
+
+_trace_log = logging.getLogger(f"{APP_NAME}.traces")
+_trace_log.propagate = False
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+_enabled = False
+
+
+class Span:
+    """
+    Timed stage of a trace
+    """
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attrs", "start", "_started")
+
+    def __init__(self, name: str, parent: Optional["Span"], attrs: dict):
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.parent_id = parent.span_id if parent else None
+        self.attrs = attrs
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def finish(self, error: Optional[BaseException] = None):
+        """
+        Write span to the trace file
+        """
+        record = {
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "ms": round((time.perf_counter() - self._started) * 1000, 3),
+            "thread": threading.current_thread().name,
+        }
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if error is not None:
+            record["error"] = type(error).__name__
+        _trace_log.info(json.dumps(record, default=str))
+
+
+def current_span() -> Optional[Span]:
+    """
+    Return the innermost open span, if tracing is enabled
+    """
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """
+    Time the enclosed block as a child of the current span
+    :param name: stage name
+    :param attrs: details to record with the span
+    """
+    if not _enabled:
+        yield None
+        return
+    new = Span(name, _current.get(), attrs)
+    token = _current.set(new)
+    try:
+        yield new
+    except BaseException as ex:
+        new.finish(ex)
+        raise
+    else:
+        new.finish()
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def detached() -> Iterator[None]:
+    """
+    Hide the current span in the enclosed block,
+    so background work started there begins traces of its own
+    """
+    token = _current.set(None)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def traced(name: str):
+    """
+    Decorate function or coroutine function to run in a span
+    :param name: stage name
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+
+        else:
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def tracing_setup():
+    """
+    Start writing spans to the trace file, unless ``trace/enabled`` is off
+    """
+    global _enabled
+    if not SETTINGS.get("trace/enabled", True):
+        return
+    TRACE_FILE.parent.mkdir(exist_ok=True, parents=True)
+    handler = RotatingFileHandler(
+        TRACE_FILE,
+        maxBytes=SETTINGS.get("trace/max_kb", TRACE_MAX_KB) * 1024,
+        backupCount=SETTINGS.get("trace/backups", TRACE_BACKUPS),
+        encoding="utf-8",
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _trace_log.setLevel(logging.INFO)
+    listen(_trace_log, handler)
+    _enabled = True
+
+
+def read_spans(paths: Iterable[Path]) -> List[dict]:
+    spans = []
+    for path in paths:
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+    return spans
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Return value at ``fraction`` of sorted ``values``, by nearest rank
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(spans: List[dict]) -> str:
+    """
+    Format latency percentiles per stage
+    """
+    durations: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    for record in spans:
+        durations.setdefault(record["name"], []).append(record["ms"])
+        if "error" in record:
+            errors[record["name"]] = errors.get(record["name"], 0) + 1
+    lines = [
+        f"{'stage':<28}{'count':>7}{'errors':>7}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"
+    ]
+    for name, values in sorted(
+        durations.items(), key=lambda item: -percentile(sorted(item[1]), 0.9)
+    ):
+        values.sort()
+        lines.append(
+            f"{name:<28}{len(values):>7}{errors.get(name, 0):>7}"
+            + "".join(
+                f"{percentile(values, fraction):>10.1f}" for fraction in (0.5, 0.9, 0.99)
+            )
+            + f"{values[-1]:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def format_trace(spans: List[dict], root: dict) -> str:
+    """
+    Format the spans of one trace as an indented tree
+    """
+    children: Dict[Optional[str], List[dict]] = {}
+    for record in spans:
+        if record["trace"] == root["trace"]:
+            children.setdefault(record["parent"], []).append(record)
+    lines = []
+
+    def add(record: dict, depth: int):
+        error = f" ({record['error']})" if "error" in record else ""
+        lines.append(
+            f"{'  ' * depth}{record['name']}: {record['ms']:.1f}ms [{record['thread']}]{error}"
+        )
+        for child in sorted(children.get(record["span"], []), key=lambda r: r["start"]):
+            add(child, depth + 1)
+
+    add(root, 0)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize wallpaper pipeline traces")
+    parser.add_argument(
+        "files",
+        nargs="*",
+        type=Path,
+        help=f"trace files, by default {TRACE_FILE} and its rotated files",
+    )
+    parser.add_argument(
+        "--slowest", type=int, default=3, help="amount of slowest switches to show"
+    )
+    args = parser.parse_args()
+    paths = args.files or sorted(
+        TRACE_FILE.parent.glob(TRACE_FILE.name + "*"), reverse=True
+    )
+    spans = read_spans(paths)
+    if not spans:
+        print("no traces found")
+        return
+    print(summarize(spans))
+    roots = [record for record in spans if record["name"] == "switch"]
+    for root in sorted(roots, key=lambda r: -r["ms"])[: args.slowest]:
+        print()
+        print(format_trace(spans, root))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,20 +4,26 @@ General utilities
 import asyncio
 import logging
 import platform
+import threading
+import time
 import traceback
 from asyncio import Future, Handle, Protocol, Transport
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
+from contextvars import copy_context
 from functools import partial, wraps
 from pathlib import Path
 from socket import socket
-from typing import Union, AsyncGenerator, Any, TypeVar
+from typing import Union, AsyncGenerator, Any, TypeVar, Dict, List, Sequence, Iterator
 
 import aiofiles
 import attr
 import pprintpp as pprintpp
 
 from flying_desktop.providers import Photo
+from flying_desktop.settings import SETTINGS
+from flying_desktop.tracing import current_span, traced
 
 
 @attr.s(auto_attribs=True)
@@ -124,6 +130,7 @@ def change_linux(path: Path):
 PathLike = Union[str, Path]
 
 
+@traced("save_photo")
 async def save_photo(photo: Photo, directory: PathLike, name: PathLike):
     """
     Download photo to path
@@ -136,19 +143,144 @@ async def save_photo(photo: Photo, directory: PathLike, name: PathLike):
         await f.write(photo.data)
     path_with_suffix = destination.with_suffix(f".{photo.suffix}")
     with suppress(FileNotFoundError):
-        await delegate(path_with_suffix.unlink)
-    await delegate(destination.rename, path_with_suffix)
+        await delegate(path_with_suffix.unlink, pool=DISK_POOL)
+    await delegate(destination.rename, path_with_suffix, pool=DISK_POOL)
     return path_with_suffix
 
 
-executor = ThreadPoolExecutor()
+@attr.s(auto_attribs=True, frozen=True)
+class PoolStats:
+    """
+    Snapshot of an executor pool's load
+    :param name: pool name
+    :param max_workers: amount of worker threads
+    :param queued: tasks waiting for a free worker
+    :param running: tasks currently running
+    :param max_wait: longest wait, in seconds, among recent tasks
+    :param mean_wait: mean wait, in seconds, among recent tasks
+    """
+
+    name: str
+    max_workers: int
+    queued: int
+    running: int
+    max_wait: float
+    mean_wait: float
+
+    @property
+    def saturated(self) -> bool:
+        """
+        Whether tasks are waiting for a worker
+        """
+        return self.queued > 0 and self.running >= self.max_workers
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """
+    Thread pool keeping track of its queue depth and of how long tasks
+    wait for a free worker
+    """
+
+    def __init__(self, name: str, max_workers: int, wait_warning: float = 1.0):
+        """
+        :param name: pool name, also used for naming worker threads
+        :param max_workers: amount of worker threads
+        :param wait_warning: log a warning for tasks waiting longer than this, in seconds
+        """
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+        self.wait_warning = wait_warning
+        self.queued = 0
+        self.running = 0
+        self.waits = deque(maxlen=100)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        submitted = time.monotonic()
+        with self._lock:
+            self.queued += 1
+
+        def run():
+            wait = time.monotonic() - submitted
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.waits.append(wait)
+            if wait > self.wait_warning:
+                log.warning(
+                    "%s pool: task waited %.2fs for a worker (%d queued)",
+                    self.name,
+                    wait,
+                    self.queued,
+                )
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+        return super().submit(run)
+
+    def stats(self) -> PoolStats:
+        """
+        Return a snapshot of the pool's load
+        """
+        with self._lock:
+            waits = list(self.waits)
+            return PoolStats(
+                name=self.name,
+                max_workers=self._max_workers,
+                queued=self.queued,
+                running=self.running,
+                max_wait=max(waits, default=0.0),
+                mean_wait=sum(waits) / len(waits) if waits else 0.0,
+            )
+
+
+AUTH_POOL = "auth"
+API_POOL = "api"
+DISK_POOL = "disk"
+DESKTOP_POOL = "desktop"
 
+# default amount of workers per pool, overridable by settings ``executors/<pool>``
+POOL_SIZES = {AUTH_POOL: 2, API_POOL: 8, DISK_POOL: 2, DESKTOP_POOL: 1}
 
-def delegate(func, *args) -> Future:
+executors: Dict[str, InstrumentedExecutor] = {
+    name: InstrumentedExecutor(name, SETTINGS.get(f"executors/{name}", size))
+    for name, size in POOL_SIZES.items()
+}
+
+
+def pool_stats() -> List[PoolStats]:
+    """
+    Return load snapshots of all executor pools
+    """
+    return [executor.stats() for executor in executors.values()]
+
+
+async def monitor_pools(interval: float = 10):
+    """
+    Periodically log saturated executor pools
+    :param interval: time between checks, in seconds
+    """
+    while True:
+        for stats in pool_stats():
+            if stats.saturated:
+                log.warning("executor pool saturated: %s", stats)
+        await asyncio.sleep(interval)
+
+
+def delegate(func, *args, pool: str = API_POOL) -> Future:
     """
     Run coroutine in executor
+    :param func: blocking function to run
+    :param args: positional arguments for ``func``
+    :param pool: name of executor pool suitable for the workload
     """
-    return loop.run_in_executor(executor, func, *args)
+    if current_span() is not None:
+        func = traced(f"{pool}.{getattr(func, '__name__', 'call')}")(func)
+    # executor threads see the caller's current span
+    return loop.run_in_executor(executors[pool], copy_context().run, func, *args)
 
 
 T = TypeVar("T")
@@ -160,3 +292,28 @@ def pack(widget: T) -> T:
     """
     widget.pack()
     return widget
+
+
+class Chain(Sequence[T]):
+    """
+    Read-only concatenation of sequences, without copying them
+    """
+
+    def __init__(self, parts: Sequence[Sequence[T]]):
+        self.parts = parts
+
+    def __len__(self) -> int:
+        return sum(map(len, self.parts))
+
+    def __getitem__(self, index: int) -> T:
+        if index < 0:
+            index += len(self)
+        for part in self.parts:
+            if 0 <= index < len(part):
+                return part[index]
+            index -= len(part)
+        raise IndexError(index)
+
+    def __iter__(self) -> Iterator[T]:
+        for part in self.parts:
+            yield from part
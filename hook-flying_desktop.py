@@ -0,0 +1,8 @@
+"""
+Hook adding the bundled providers, which are imported by name only
+when their buckets are filled, so pyinstaller cannot find them
+"""
+hiddenimports = [
+    "flying_desktop.providers.google",
+    "flying_desktop.providers.facebook",
+]
@@ -20,6 +20,12 @@ setup(
     author="Roee Nizan",
     author_email="roeen30@gmail.com",
     description="Download wallpapers from your social media accounts",
-    entry_points={"gui_scripts": ["flydesk = flying_desktop.__main__:main"]},
+    entry_points={
+        "gui_scripts": ["flydesk = flying_desktop.__main__:main"],
+        "flying_desktop.providers": [
+            "Google = flying_desktop.providers.google:GooglePhotos",
+            "Facebook = flying_desktop.providers.facebook:FacebookPhotos",
+        ],
+    },
     package_data={"flying_desktop": ["providers/*/credentials.json"]},
 )